@@ -9,7 +9,8 @@
 
 ##################
 
-import json, requests
+import json
+import http_client
 
 SPOTIFY_URL_AUTH = 'https://accounts.spotify.com/authorize/?'
 SPOTIFY_URL_TOKEN = 'https://accounts.spotify.com/api/token/'
@@ -32,7 +33,7 @@ def getToken(code, client_id, client_secret, redirect_uri):
 
     headers = {"Content-Type" : HEADER} 
 
-    post = requests.post(SPOTIFY_URL_TOKEN, params=body, headers=headers)
+    post = http_client.post(SPOTIFY_URL_TOKEN, params=body, headers=headers)
     return handleToken(json.loads(post.text))
     
 def handleToken(response):
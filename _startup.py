@@ -21,20 +21,17 @@ CLIENT_SECRET = os.environ['CLIENT_SECRET']
 # uncomment when deploying
 CALLBACK_URL = "https://musophile.herokuapp.com"
 SCOPE = "user-read-private user-read-playback-state user-read-playback-position user-modify-playback-state user-read-email user-read-currently-playing"
-TOKEN_DATA = []
 
 def getUser():
     return getAuth(CLIENT_ID, "{}/callback/".format(CALLBACK_URL), SCOPE)
 
+# The caller stores the returned tokens for the logged-in user (see spotify_tokens.save_token)
 def getUserToken(code):
-    global TOKEN_DATA
-    TOKEN_DATA = getToken(code, CLIENT_ID, CLIENT_SECRET, "{}/callback/".format(CALLBACK_URL))
+    return getToken(code, CLIENT_ID, CLIENT_SECRET, "{}/callback/".format(CALLBACK_URL))
 
-# This function, along with the refreshAuth function in _flask_spotify_auth, was rewritten into get_refresh_auth in the helper file
+# This function, along with the refreshAuth function in _flask_spotify_auth, was rewritten into spotify_tokens.get_refresh_token,
+# which spotify_tokens.get_access_token calls shortly before a token expires
 
 # def refreshToken(time):
 #     time.sleep(time)
 #     TOKEN_DATA = refreshAuth()
-
-def getAccessToken():
-    return TOKEN_DATA
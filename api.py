@@ -0,0 +1,236 @@
+import json
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, Response, abort, g, request
+from sqlalchemy.orm import load_only, selectinload, with_expression, with_loader_criteria
+
+from models import User, Playlist, Recording, Tag, Library, PlaylistRecording, RecordingTag
+from helpers import get_playlist_tags
+from pagination import get_page_args, paginate
+from query_stats import query_budget
+
+API_VERSION = 1
+
+api = Blueprint('api', __name__, url_prefix=f'/api/v{API_VERSION}')
+
+# Fields each resource can have, and the default when ?fields isn't given. The id is always included
+USER_FIELDS = ('id', 'username', 'role', 'img_url', 'revision', 'updated_at')
+PLAYLIST_FIELDS = ('id', 'name', 'description', 'user_id', 'revision', 'updated_at')
+RECORDING_FIELDS = ('id', 'mbid', 'title', 'artist', 'release', 'spotify_uri', 'spotify_image_url', 'spotify_duration_ms',
+    'spotify_preview_url', 'revision', 'updated_at')
+# Library listings add the user's own comments on each recording
+LIBRARY_FIELDS = RECORDING_FIELDS + ('comments',)
+TAG_FIELDS = ('id', 'name', 'revision', 'updated_at')
+
+# Related rows that can be asked for with ?include. Each one is a single select-in query however many rows there are
+RECORDING_INCLUDES = ('tags', 'playlists')
+PLAYLIST_INCLUDES = ('tags',)
+
+
+def json_response(body, status=200):
+    """JSON without the whitespace jsonify adds in debug mode"""
+    return Response(json.dumps(body, separators=(',', ':'), default=_encode), status=status, mimetype='application/json')
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def api_error(status, field, message):
+    abort(json_response({'errors': {field: [message]}}, status))
+
+
+def api_login_required(f):
+    """Like login_required, but answers with a 401 instead of redirecting"""
+    @wraps(f)
+    def func(*args, **kwargs):
+        if not g.user:
+            api_error(401, 'auth', 'You must be logged in to do that.')
+        return f(*args, **kwargs)
+    return func
+
+
+@api.errorhandler(404)
+def not_found(e):
+    return json_response({'errors': {'id': ['Not found']}}, 404)
+
+
+def get_list_arg(name, allowed):
+    """Parse a comma separated query string argument, rejecting names that aren't allowed. None when not given"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    names = list(dict.fromkeys(n.strip() for n in value.split(',') if n.strip()))
+    unknown = [n for n in names if n not in allowed]
+    if unknown:
+        api_error(400, name, f'Unknown {name}: {", ".join(unknown)}. Choose from {", ".join(allowed)}')
+    return names
+
+
+def get_fields(allowed):
+    fields = get_list_arg('fields', allowed)
+    if fields is None:
+        return list(allowed)
+    return ['id'] + [f for f in fields if f != 'id']
+
+
+def get_includes(allowed):
+    return get_list_arg('include', allowed) or []
+
+
+def only(model, fields):
+    """Load just the selected columns"""
+    return load_only(*[getattr(model, f) for f in fields])
+
+
+def serialize(row, fields):
+    return {f: getattr(row, f) for f in fields}
+
+
+def serialize_recording(recording, fields, includes):
+    """A recording with the related rows asked for"""
+    data = serialize(recording, fields)
+    if 'tags' in includes:
+        data['tags'] = [{'id': t.id, 'name': t.name} for t in recording.tags]
+    if 'playlists' in includes:
+        data['playlists'] = [{'id': p.id, 'name': p.name} for p in recording.playlists]
+    return data
+
+
+def page_response(page, serialize_item):
+    return json_response({
+        'data': [serialize_item(item) for item in page],
+        'next': page.next_after,
+        'links': {'next': page.next_url}
+    })
+
+
+def recording_options(fields, includes):
+    """Loader options for recordings: the selected columns, and one select-in query per include.
+    Comments come from the Library row the query joins"""
+    options = [only(Recording, [f for f in fields if f != 'comments'])]
+    if 'comments' in fields:
+        options.append(with_expression(Recording.comments, Library.comments))
+    if 'tags' in includes:
+        options.append(selectinload(Recording.tags).load_only(Tag.id, Tag.name))
+    if 'playlists' in includes:
+        options.append(selectinload(Recording.playlists).load_only(Playlist.id, Playlist.name, Playlist.user_id))
+    return options
+
+
+def recordings_page(query, allowed_fields=RECORDING_FIELDS):
+    """A page of recordings with the selected fields and includes"""
+    fields = get_fields(allowed_fields)
+    includes = get_includes(RECORDING_INCLUDES)
+    page = paginate(query.options(*recording_options(fields, includes)), Recording.id, *get_page_args())
+    return page_response(page, lambda r: serialize_recording(r, fields, includes))
+
+
+def get_or_404(model, id):
+    """Check a row exists, loading only its id"""
+    return model.query.options(load_only(model.id)).filter_by(id=id).first_or_404()
+
+
+###########
+# Users
+###########
+
+@api.route('/users/<int:user_id>')
+@api_login_required
+@query_budget(1)
+def get_user(user_id):
+    """A user's public profile"""
+    fields = get_fields(USER_FIELDS)
+    user = User.query.options(only(User, fields)).filter_by(id=user_id).first_or_404()
+    return json_response({'data': serialize(user, fields)})
+
+@api.route('/users/<int:user_id>/library')
+@api_login_required
+@query_budget(4)
+def get_library(user_id):
+    """A page of a user library, with the user's comments. ?include=tags,playlists, where playlists are the user's own"""
+    get_or_404(User, user_id)
+    return recordings_page(
+        Recording.query.join(Library, Library.recording_id == Recording.id).filter(Library.user_id == user_id).options(
+            with_loader_criteria(Playlist, Playlist.user_id == user_id)
+        ),
+        LIBRARY_FIELDS
+    )
+
+@api.route('/users/<int:user_id>/playlists')
+@api_login_required
+@query_budget(2)
+def get_user_playlists(user_id):
+    """A page of a user's playlists"""
+    get_or_404(User, user_id)
+    fields = get_fields(PLAYLIST_FIELDS)
+    page = paginate(
+        Playlist.query.options(only(Playlist, fields)).filter_by(user_id=user_id),
+        Playlist.id,
+        *get_page_args()
+    )
+    return page_response(page, lambda p: serialize(p, fields))
+
+###########
+# Playlists
+###########
+
+@api.route('/playlists/<int:playlist_id>')
+@api_login_required
+@query_budget(2)
+def get_playlist(playlist_id):
+    """A playlist. ?include=tags adds the tags on its songs with how many songs have each"""
+    fields = get_fields(PLAYLIST_FIELDS)
+    includes = get_includes(PLAYLIST_INCLUDES)
+    playlist = Playlist.query.options(only(Playlist, fields)).filter_by(id=playlist_id).first_or_404()
+    data = serialize(playlist, fields)
+    if 'tags' in includes:
+        data['tags'] = get_playlist_tags(playlist.id)
+    return json_response({'data': data})
+
+@api.route('/playlists/<int:playlist_id>/recordings')
+@api_login_required
+@query_budget(4)
+def get_playlist_recordings(playlist_id):
+    """A page of a playlist's recordings. ?include=tags,playlists"""
+    get_or_404(Playlist, playlist_id)
+    return recordings_page(
+        Recording.query.join(PlaylistRecording, PlaylistRecording.recording_id == Recording.id)
+            .filter(PlaylistRecording.playlist_id == playlist_id)
+    )
+
+###########
+# Recordings and tags
+###########
+
+@api.route('/recordings/<int:recording_id>')
+@api_login_required
+@query_budget(3)
+def get_recording(recording_id):
+    """A recording. ?include=tags,playlists"""
+    fields = get_fields(RECORDING_FIELDS)
+    includes = get_includes(RECORDING_INCLUDES)
+    recording = Recording.query.options(*recording_options(fields, includes)).filter_by(id=recording_id).first_or_404()
+    return json_response({'data': serialize_recording(recording, fields, includes)})
+
+@api.route('/tags/<int:tag_id>')
+@api_login_required
+@query_budget(1)
+def get_tag(tag_id):
+    """A tag"""
+    fields = get_fields(TAG_FIELDS)
+    tag = Tag.query.options(only(Tag, fields)).filter_by(id=tag_id).first_or_404()
+    return json_response({'data': serialize(tag, fields)})
+
+@api.route('/tags/<int:tag_id>/recordings')
+@api_login_required
+@query_budget(4)
+def get_tag_recordings(tag_id):
+    """A page of the recordings with a tag. ?include=tags,playlists"""
+    get_or_404(Tag, tag_id)
+    return recordings_page(
+        Recording.query.join(RecordingTag, RecordingTag.recording_id == Recording.id).filter(RecordingTag.tag_id == tag_id)
+    )
@@ -1,18 +1,37 @@
-from flask import Flask, redirect, render_template, flash, g, session, request
+from flask import Flask, Response, redirect, render_template, flash, g, session, request, abort, jsonify, stream_with_context
 from functools import wraps
+import click
 from flask_debugtoolbar import DebugToolbarExtension
 import _startup, os
 import musicbrainzngs as mb
 
-from models import db, connect_db, User, Playlist, Recording, Tag
-from forms import RegisterForm, LoginForm, EditRecordingForm, PlaylistForm, AddToPlaylistForm
-from helpers import create_tag, get_recording_info, get_spotify_info, get_refresh_token
+from models import db, connect_db, User, Playlist, Recording, Tag, Library, PlaylistRecording, RecordingTag, ImportJob
+from forms import RegisterForm, LoginForm, EditRecordingForm, PlaylistForm, AddToPlaylistForm, ImportForm
+from helpers import SPOTIFY_MISS_TTL, SPOTIFY_TRACK_ID_RE, SPOTIFY_TRACKS_BATCH_SIZE, add_tags, bump_recording_versions, bump_versions, get_or_create_recording, get_playlist_tags, invalidate_playlist_tags, invalidate_playlist_tags_for_recordings, library_search_match, library_search_rank, search_catalog, get_spotify_info, get_spotify_info_batch, get_spotify_track_id, search_musicbrainz, update_search_vectors, update_spotify_tracks, mb_governor, MUSICBRAINZ_SEARCH_TYPES, SEARCH_CONFIG
+from spotify_tokens import save_token, get_access_token
+from cache import cache_stats
+from assets import init_assets
+from compression import init_compression
+from conditional import cacheable, check_not_modified, init_conditional, not_cacheable
+from fragments import fragment_stats, render_fragment
+from http_client import http_stats
+from importer import parse_import, create_import_job, run_import, start_import
+from api import api
+from exporter import export_chunks, gzip_chunks, library_export_query, playlist_export_query, CONTENT_TYPES
+from pagination import get_page_args, paginate, paginate_ranked, rank_cursor
+from query_stats import init_query_stats, query_budget, unindexed_relationship_loads, DEFAULT_QUERY_BUDGET
+from sqlalchemy import and_, exists, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, with_expression, with_loader_criteria
+from werkzeug.utils import secure_filename
 
 CURR_USER_KEY = 'curr_user'
-ACCESS_TOKEN = 'access_token'
+CURR_USERNAME_KEY = 'curr_username'
 
-TOKEN = ''
+# Most search results a single batch lookup will resolve
+MAX_BATCH_SIZE = 100
+MAX_SEARCH_LIMIT = 100
 
 app = Flask(__name__)
 
@@ -20,7 +39,9 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgres
 if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
 	app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+# Statement logging is slow and noisy. Per-request query counts and N+1 warnings come from query_stats instead
+app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO') == '1'
+app.config['SQL_QUERY_BUDGET'] = int(os.environ.get('SQL_QUERY_BUDGET', DEFAULT_QUERY_BUDGET))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'kepler-victoria')
 
 
@@ -28,6 +49,12 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'kepler-victoria')
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 connect_db(app)
+# Registered first so it runs last, once every other hook has finished the response
+init_compression(app)
+init_query_stats(app)
+init_conditional(app)
+init_assets(app)
+app.register_blueprint(api)
 debug = DebugToolbarExtension(app)
 
 mb.set_useragent('Musophile', '0.1')
@@ -37,11 +64,36 @@ mb.set_format(fmt='json')
 # Route helpers
 ###########
 
+class CurrentUser:
+    """The logged-in user as the session knows them. The id and username come from the signed session cookie,
+    anything else loads the User row the first time it's used"""
+
+    def __init__(self, id, username=None):
+        self.id = id
+        self._username = username
+        self._user = None
+
+    @property
+    def user(self):
+        """The full User, loaded on first use"""
+        if self._user is None:
+            self._user = User.query.get_or_404(self.id)
+        return self._user
+
+    @property
+    def username(self):
+        return self._username or self.user.username
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
 @app.before_request
 def add_user_to_g():
-    """Add logged-in user to Flask global to easily get user info"""
+    """Add logged-in user to Flask global to easily get user info. Static files don't need it"""
+    if request.endpoint == 'static':
+        return
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = CurrentUser(session[CURR_USER_KEY], session.get(CURR_USERNAME_KEY))
     else:
         g.user = None
 
@@ -58,6 +110,23 @@ def login_required(f):
 def do_login(user):
     """Login function"""
     session[CURR_USER_KEY] = user.id
+    session[CURR_USERNAME_KEY] = user.username
+
+def export_response(make_query, title, filename):
+    """Stream an export in the ?format asked for, gzipped when the client accepts it.
+    Rows come in recording id order, and ?after=<recording id> resumes after the last one received"""
+    fmt = request.args.get('format', 'jsonl')
+    after = request.args.get('after', type=int)
+    try:
+        chunks = export_chunks(make_query(after), fmt, title, resumed=after is not None)
+    except ValueError as e:
+        return {'errors': {'format': [str(e)]}}, 400
+
+    headers = {'Content-Disposition': f'attachment; filename="{secure_filename(filename)}.{fmt}"', 'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), content_type=CONTENT_TYPES[fmt], headers=headers)
 
 ###########
 # Landing page and error pages
@@ -73,29 +142,34 @@ def not_found(e):
     """404 page"""
     return render_template('404.html'), 404
 
+@app.route('/stats')
+@login_required
+def show_stats():
+    """Cache hit/miss counters, render time saved by fragments, outbound HTTP metrics and rate limiter waits for this worker"""
+    return {
+        'caches': cache_stats(),
+        'fragments': fragment_stats(),
+        'http': http_stats(),
+        'rate_limits': {'musicbrainz': mb_governor.stats()}
+    }
+
 ###########
 # Spotify auth routes
 ###########
 
 @app.route('/auth')
+@login_required
 def start_auth():
     response = _startup.getUser()
     return redirect(response)
 
 @app.route('/callback/')
+@login_required
 def auth_spotify():
-    _startup.getUserToken(request.args['code'])
+    access_token, _, expires_in, refresh_token = _startup.getUserToken(request.args['code'])
+    save_token(g.user.id, access_token, refresh_token, expires_in)
     return redirect('/search')
 
-@app.route('/reauth')
-def reauthorize_spotify():
-    refresh_token = session[ACCESS_TOKEN][3]
-    token = get_refresh_token(refresh_token)
-    token.append(refresh_token)
-    session[ACCESS_TOKEN] = token
-
-    return {'reauth': True}
-
 ###########
 # Basic user routes (login/registration/search)
 ###########
@@ -148,6 +222,7 @@ def login():
 def logout():
     """Log out of account"""
     session.pop(CURR_USER_KEY)
+    session.pop(CURR_USERNAME_KEY, None)
     flash("Goodbye for now!", 'primary')
     return redirect('/')
 
@@ -158,65 +233,160 @@ def logout():
 @app.route('/search')
 @login_required
 def search_page():
-    """Search page"""
-    token = _startup.getAccessToken()
-    if token and (ACCESS_TOKEN not in session):
-        session[ACCESS_TOKEN] = token
-    return render_template('search.html')
+    """Search page. A stored token only counts as connected if it can still be used, so a revoked one asks to connect again"""
+    return render_template('search.html', has_token=get_access_token(g.user.id) is not None)
+
+@app.route('/search/local')
+@login_required
+@query_budget(2)
+def search_local():
+    """Typo-tolerant search of the recordings already on Musophile by title or artist. Unlike MusicBrainz it's free and not rate limited"""
+    search_type = request.args.get('type')
+    term = request.args.get('q', '').strip()
+    limit = request.args.get('limit', 25, type=int)
+    if search_type not in (None, 'recording', 'artist') or not term:
+        return {'error': {'status': 400, 'message': 'Search needs a term, and a type of recording or artist'}}, 400
+
+    results = search_catalog(term, search_type, min(max(limit, 1), MAX_SEARCH_LIMIT))
+    return {'recordings': [{
+        'mbid': recording.mbid,
+        'title': recording.title,
+        'artist': recording.artist,
+        'release': recording.release,
+        'spotify_uri': recording.spotify_uri,
+        'tags': [tag.name for tag in recording.tags],
+        'similarity': round(similarity, 3)
+    } for recording, similarity in results]}
+
+@app.route('/search/mb')
+@login_required
+def search_mb():
+    """Proxy for MusicBrainz recording searches so they can be cached and kept under the rate limit"""
+    search_type = request.args.get('type', 'recording')
+    term = request.args.get('q', '').strip()
+    limit = request.args.get('limit', 25, type=int)
+    if search_type not in MUSICBRAINZ_SEARCH_TYPES or not term:
+        return {'error': {'status': 400, 'message': 'Search needs a type and a term'}}, 400
+
+    try:
+        recordings = search_musicbrainz(search_type, term, min(max(limit, 1), MAX_SEARCH_LIMIT))
+    except mb.WebServiceError:
+        return {'error': {'status': 502, 'message': 'MusicBrainz is unavailable'}}, 502
+
+    return {'recordings': recordings}
 
 @app.route('/search/api/<title>/<artist>')
 @login_required
 def get_info(title, artist):
-    spotify_info = get_spotify_info(title, artist, session[ACCESS_TOKEN][0])
+    """Spotify search for one recording. Uses the app token, so the user doesn't need to connect Spotify first.
+    Results can be kept by the browser as long as the shortest time they're cached here, errors can't"""
+    spotify_info = get_spotify_info(title, artist)
+    if 'tracks' not in spotify_info:
+        return not_cacheable(jsonify(spotify_info))
+    return cacheable(jsonify(spotify_info), SPOTIFY_MISS_TTL)
+
+@app.route('/search/api/batch', methods=['POST'])
+@login_required
+def get_info_batch():
+    """Find Spotify tracks for a whole list of search results in one request.
+    Takes {"items": [{"mbid", "title", "artist"}, ...]} and returns {"tracks": {mbid: track id or null}}"""
+    body = request.get_json(silent=True)
+    items = body.get('items') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return {'error': {'status': 400, 'message': 'Batch lookup needs a list of items'}}, 400
+
+    items = [
+        {'mbid': item['mbid'], 'title': item['title'], 'artist': item.get('artist') or ''}
+        for item in items[:MAX_BATCH_SIZE]
+        if item.get('mbid') and item.get('title') and all(isinstance(item.get(key) or '', str) for key in ('mbid', 'title', 'artist'))
+    ]
 
-    if 'error' in spotify_info:
-        if spotify_info['error']['status'] == 401:
-            reauth = redirect('/reauth')
-            return reauth
+    responses = get_spotify_info_batch(items)
 
-    return spotify_info
+    # Lookups that failed come back as null tracks, indistinguishable from misses, so the answer isn't kept
+    return not_cacheable(jsonify({'tracks': {mbid: get_spotify_track_id(res) for mbid, res in responses.items()}}))
 
 @app.route('/user/<int:user_id>')
 @login_required
+@query_budget(3)
 def user_page(user_id):
-    """User page"""
-    user = User.query.get_or_404(user_id)
-    return render_template('user/user.html', user=user)
+    """User page. The playlists and library are rendered once per version of the user"""
+    user = User.query.filter_by(id=user_id).first_or_404()
+    check_not_modified(user)
+    music = render_fragment('user/user-music.html', user, lambda: {
+        'user': user,
+        'playlists': user.playlists,
+        'library': user.library
+    })
+    return render_template('user/user.html', user=user, music=music)
 
 ###########
 # User library routes
 
 @app.route('/user/<int:user_id>/library')
 @login_required
+@query_budget(4)
 def show_user_library(user_id):
-    """Display the user library"""
-    user = User.query.get_or_404(user_id)
-    return render_template('user/library.html', user=user)
+    """Display a page of the user library"""
+    user = User.query.filter_by(id=user_id).first_or_404()
+    check_not_modified(user)
+    after, limit = get_page_args()
+    recordings = render_fragment('user/library-recordings.html', user, lambda: {
+        'user': user,
+        'recordings': paginate(
+            Recording.query.join(Library, Library.recording_id == Recording.id).filter(Library.user_id == user_id).options(
+                with_expression(Recording.comments, Library.comments),
+                selectinload(Recording.tags),
+                # Recordings are shared, so without this every user's playlists with the song would be loaded
+                selectinload(Recording.playlists),
+                with_loader_criteria(Playlist, Playlist.user_id == user_id)
+            ),
+            Recording.id,
+            after,
+            limit
+        )
+    }, after=after, limit=limit, is_owner=user.id == g.user.id)
+    return render_template('user/library.html', user=user, recordings=recordings)
+
+@app.route('/user/<int:user_id>/library/search')
+@login_required
+@query_budget(3)
+def search_user_library(user_id):
+    """Full-text search of a user library by title, artist, release, tags and comments, best matches first"""
+    user = User.query.filter_by(id=user_id).first_or_404()
+    q = request.args.get('q', '').strip()
+    if not q:
+        return redirect(f'/user/{user_id}/library')
+
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    recordings = paginate_ranked(
+        Recording.query.join(Library, Library.recording_id == Recording.id).filter(
+            Library.user_id == user_id,
+            library_search_match(tsquery)
+        ).options(with_expression(Recording.comments, Library.comments), selectinload(Recording.tags)),
+        library_search_rank(tsquery),
+        Recording.id,
+        *get_page_args(rank_cursor)
+    )
+    return render_template('user/library-search.html', user=user, q=q, recordings=recordings)
 
 @app.route('/user/add-recording/<recording_id>/<spotify_uri>', methods = ['POST'])
 @login_required
 def add_recording_to_library(recording_id, spotify_uri):
-    """Add a recording to user's library"""
-    
-    recording_data = get_recording_info(recording_id)
-
-    recording = Recording(
-        mbid = recording_id,
-        title = recording_data['title'],
-        artist = recording_data['artist'],
-        release = recording_data['release'] if recording_data['release'] else None,
-        spotify_uri = spotify_uri if spotify_uri != '0' else None
-    )
-    db.session.add(recording)
-    db.session.commit()
+    """Add a recording to user's library. Recordings are shared, so one that's already in the database is reused"""
+    if spotify_uri != '0' and not SPOTIFY_TRACK_ID_RE.fullmatch(spotify_uri):
+        abort(400)
+    recording = get_or_create_recording(recording_id, spotify_uri if spotify_uri != '0' else None)
+    update_spotify_tracks([recording])
 
-    tags = recording_data['tags'] if recording_data['tags'] else None
-    if tags:
-        for tag in tags:
-            create_tag(tag, recording)
-    
-    user = User.query.get(session[CURR_USER_KEY])
-    user.library.append(recording)
+    if Library.query.get((g.user.id, recording.id)):
+        db.session.commit()
+        flash(f'{recording.title} is already in your library', 'warning')
+        return redirect(f'/user/{g.user.id}')
+
+    # Adding the row directly doesn't load the rest of the library
+    db.session.add(Library(user_id=g.user.id, recording_id=recording.id))
+    bump_versions(User, [g.user.id])
 
     db.session.commit()
     flash(f'{recording.title} successfully added to your library!', 'success')
@@ -225,15 +395,16 @@ def add_recording_to_library(recording_id, spotify_uri):
 @app.route('/user/<int:user_id>/library/<int:recording_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_recording(user_id, recording_id):
-    """Edit the information on a recording"""
+    """Edit the comments and tags on a recording in your library. Comments are the user's own, tags are shared"""
+    if g.user.id != user_id:
+        abort(403)
+    entry = Library.query.get_or_404((user_id, recording_id))
     recording = Recording.query.get_or_404(recording_id)
     form = EditRecordingForm()
     if form.validate_on_submit():
-        recording.comments = form.comments.data
-        for tag in form.tags.data.split(', '):
-            if tag not in [tag.name for tag in recording.tags]:
-                create_tag(tag, recording)
-        db.session.commit()
+        entry.comments = form.comments.data
+        bump_versions(User, [user_id])
+        add_tags(recording, form.tags.data.split(', '))
         flash(f'Successfully updated {recording.title} in your library!', 'success')
         return redirect(f'/user/{user_id}/library')
     
@@ -242,36 +413,124 @@ def edit_recording(user_id, recording_id):
 @app.route('/user/<int:user_id>/library/<int:recording_id>/delete', methods=['POST'])
 @login_required
 def delete_recording(recording_id, user_id):
-    """Remove a recording from a user's library"""
+    """Remove a recording from a user's library and playlists. The shared recording itself stays"""
     recording = Recording.query.get_or_404(recording_id)
 
-    db.session.delete(recording)
+    invalidate_playlist_tags_for_recordings([recording.id])
+    bump_versions(User, [user_id])
+    Library.query.filter_by(user_id=user_id, recording_id=recording.id).delete()
+    PlaylistRecording.query.filter(
+        PlaylistRecording.recording_id == recording.id,
+        PlaylistRecording.playlist_id.in_(db.session.query(Playlist.id).filter_by(user_id=user_id))
+    ).delete(synchronize_session=False)
     db.session.commit()
     flash('Successfully removed!', 'success')
     return redirect(f'/user/{user_id}/library')
 
+@app.route('/user/<int:user_id>/library/export')
+@login_required
+def export_library(user_id):
+    """Download a user library as JSONL, CSV, M3U or XSPF"""
+    user = User.query.filter_by(id=user_id).first_or_404()
+    return export_response(
+        lambda after: library_export_query(user.id, after),
+        f"{user.username}'s Library",
+        f'{user.username}-library'
+    )
+
+###########
+# Bulk import routes
+
+@app.route('/user/<int:user_id>/imports', methods=['GET', 'POST'])
+@login_required
+def import_to_library(user_id):
+    """Import a list of MBIDs or title/artist rows into the user's library in the background"""
+    if g.user.id != user_id:
+        abort(403)
+    form = ImportForm()
+    if request.method == 'GET':
+        return render_template('user/import.html', form=form)
+
+    if not form.validate_on_submit():
+        return {'errors': form.errors}, 400
+    try:
+        rows = parse_import(form.file.data.read().decode('utf8'), form.format.data)
+    except (ValueError, UnicodeDecodeError) as e:
+        return {'errors': {'file': [str(e)]}}, 400
+
+    job = create_import_job(user_id, rows)
+    start_import(app, job.id)
+    return {'job': job.to_dict()}, 202, {'Location': f'/user/{user_id}/imports/{job.id}'}
+
+@app.route('/user/<int:user_id>/imports/<int:job_id>')
+@login_required
+def import_status(user_id, job_id):
+    """Progress of a bulk import, for polling"""
+    job = ImportJob.query.filter_by(id=job_id, user_id=user_id).first_or_404()
+    return {'job': job.to_dict()}
+
+@app.route('/user/<int:user_id>/imports/<int:job_id>/resume', methods=['POST'])
+@login_required
+def resume_import(user_id, job_id):
+    """Restart an import that failed or was interrupted. Finished items are not redone.
+    A running job is only restarted once it has stalled"""
+    if g.user.id != user_id:
+        abort(403)
+    job = ImportJob.query.filter_by(id=job_id, user_id=user_id).first_or_404()
+    if job.status != 'done' and start_import(app, job.id) is None:
+        return {'errors': {'job': ['This import is still running']}, 'job': job.to_dict()}, 409
+    return {'job': job.to_dict()}, 202
+
 ###########
 # Playlist routes
 
 @app.route('/user/<int:user_id>/playlists')
 @login_required
+@query_budget(3)
 def show_user_playlists(user_id):
-    """Show a user's playlists"""
-    user = User.query.get_or_404(user_id)
-    return render_template('user/playlists.html', user=user)
+    """Show a page of a user's playlists"""
+    user = User.query.filter_by(id=user_id).first_or_404()
+    check_not_modified(user)
+    playlists = paginate(
+        Playlist.query.filter_by(user_id=user_id).options(selectinload(Playlist.recordings)),
+        Playlist.id,
+        *get_page_args()
+    )
+    return render_template('user/playlists.html', user=user, playlists=playlists)
 
 
 @app.route('/playlists/<int:playlist_id>')
 @login_required
+@query_budget(3)
 def show_playlist(playlist_id):
-    """Show a playlist"""
-    playlist = Playlist.query.get(playlist_id)
-    tags = []
-    for recording in playlist.recordings:
-        for tag in recording.tags:
-            tags.append(tag)
-
-    return render_template('playlist/playlist.html', playlist=playlist, tags=tags)
+    """Show a playlist, a page of recordings at a time"""
+    playlist = Playlist.query.filter_by(id=playlist_id).first_or_404()
+    check_not_modified(playlist)
+    after, limit = get_page_args()
+    recordings = render_fragment('playlist/playlist-recordings.html', playlist, lambda: {
+        'playlist': playlist,
+        'recordings': paginate(
+            Recording.query.join(PlaylistRecording, PlaylistRecording.recording_id == Recording.id).filter(PlaylistRecording.playlist_id == playlist_id),
+            Recording.id,
+            after,
+            limit
+        ),
+        # Tags cover the whole playlist, not just the page shown
+        'tags': get_playlist_tags(playlist_id)
+    }, after=after, limit=limit, is_owner=playlist.user_id == g.user.id)
+
+    return render_template('playlist/playlist.html', playlist=playlist, recordings=recordings)
+
+@app.route('/playlists/<int:playlist_id>/export')
+@login_required
+def export_playlist(playlist_id):
+    """Download a playlist as JSONL, CSV, M3U or XSPF"""
+    playlist = Playlist.query.filter_by(id=playlist_id).first_or_404()
+    return export_response(
+        lambda after: playlist_export_query(playlist, after),
+        playlist.name,
+        f'playlist-{playlist.id}'
+    )
 
 @app.route('/user/<int:user_id>/playlists/new', methods=['GET', 'POST'])
 @login_required
@@ -290,6 +549,7 @@ def new_playlist(user_id):
             user_id = user_id
         )
         db.session.add(new_playlist)
+        bump_versions(User, [user_id])
         db.session.commit()
 
         flash(f'Playlist {new_playlist.name} successfully made', 'success')
@@ -299,17 +559,30 @@ def new_playlist(user_id):
 @app.route('/playlists/<int:playlist_id>/add', methods=['GET', 'POST'])
 @login_required
 def add_recording_to_playlist(playlist_id):
-    """Add recording to a playlist"""
+    """Add recordings from the user's library to a playlist"""
     playlist = Playlist.query.get_or_404(playlist_id)
-    form = AddToPlaylistForm(obj=g.user)
-    form.recording.choices = [(r.id, r.title) for r in g.user.library if r not in playlist.recordings]
+    form = AddToPlaylistForm()
+    # Library recordings that aren't in the playlist yet, as one anti-join
+    form.recording.choices = (db.session.query(Recording.id, Recording.title)
+        .join(Library, Library.recording_id == Recording.id)
+        .filter(Library.user_id == g.user.id)
+        .filter(~exists().where(and_(
+            PlaylistRecording.playlist_id == playlist.id,
+            PlaylistRecording.recording_id == Recording.id
+        )))
+        .order_by(Recording.title, Recording.id)
+        .all())
     
     if form.validate_on_submit():
-        recording = Recording.query.get_or_404(form.recording.data)
-        playlist.recordings.append(recording)
+        db.session.execute(insert(PlaylistRecording.__table__).on_conflict_do_nothing(), [
+            {'playlist_id': playlist.id, 'recording_id': recording_id} for recording_id in form.recording.data
+        ])
+        invalidate_playlist_tags([playlist.id])
+        bump_versions(User, [playlist.user_id])
         db.session.commit()
         
-        flash(f'Successfully added {recording.title} to {playlist.name}', 'success')
+        count = len(form.recording.data)
+        flash(f'Successfully added {count} song{"s" if count != 1 else ""} to {playlist.name}', 'success')
         return redirect(f'/playlists/{playlist.id}')
 
     return render_template('playlist/add-to-playlist.html', playlist=playlist, form=form)
@@ -321,6 +594,8 @@ def remove_recording_from_playlist(playlist_id, recording_id):
     playlist = Playlist.query.get_or_404(playlist_id)
     recording = Recording.query.get_or_404(recording_id)
     playlist.recordings.remove(recording)
+    invalidate_playlist_tags([playlist.id])
+    bump_versions(User, [playlist.user_id])
     db.session.commit()
     flash(f'Successfully removed recording from {playlist.name}', 'success')
     return redirect(f'/playlists/{playlist_id}')
@@ -334,6 +609,8 @@ def edit_playlist(playlist_id):
     if form.validate_on_submit():
         playlist.name = form.name.data
         playlist.description = form.description.data
+        bump_versions(Playlist, [playlist.id])
+        bump_versions(User, [playlist.user_id])
         db.session.commit()
 
         flash(f'Successfully edited {playlist.name}', 'success')
@@ -348,6 +625,8 @@ def delete_playlist(playlist_id):
     playlist = Playlist.query.get_or_404(playlist_id)
     user = User.query.get_or_404(playlist.user_id)
     db.session.delete(playlist)
+    invalidate_playlist_tags([playlist.id])
+    bump_versions(User, [user.id])
     db.session.commit()
 
     flash(f'Successfully deleted playlist', 'success')
@@ -359,18 +638,91 @@ def delete_playlist(playlist_id):
 
 @app.route('/tags/<int:tag_id>')
 @login_required
+@query_budget(2)
 def show_songs_with_tag(tag_id):
-    """Show all songs on the Musophile database with the tag"""
-    tag = Tag.query.get_or_404(tag_id)
-    return render_template('tag.html', tag=tag)
+    """Show a page of the songs on the Musophile database with the tag"""
+    tag = Tag.query.filter_by(id=tag_id).first_or_404()
+    check_not_modified(tag)
+    after, limit = get_page_args()
+    recordings = render_fragment('tag-recordings.html', tag, lambda: {
+        'recordings': paginate(
+            Recording.query.join(RecordingTag, RecordingTag.recording_id == Recording.id).filter(RecordingTag.tag_id == tag_id),
+            Recording.id,
+            after,
+            limit
+        )
+    }, after=after, limit=limit)
+    return render_template('tag.html', tag=tag, recordings=recordings)
 
 @app.route('/tags/<int:tag_id>/remove/<int:recording_id>', methods=['POST'])
 @login_required
 def remove_tag(tag_id, recording_id):
-    """Remove tag from a recording"""
+    """Remove tag from a recording. Tags are shared with everyone who has the song, so only users with it in their library can"""
     tag = Tag.query.get_or_404(tag_id)
     recording = Recording.query.get_or_404(recording_id)
+    if not Library.query.get((g.user.id, recording.id)):
+        abort(403)
+    if tag not in recording.tags:
+        abort(404)
     recording.tags.remove(tag)
+    update_search_vectors([recording.id])
+    invalidate_playlist_tags_for_recordings([recording.id])
+    bump_versions(Tag, [tag.id])
+    bump_recording_versions([recording.id])
     db.session.commit()
     flash(f'Successfully removed {tag.name} tag from {recording.title}', 'success')
-    return redirect(f'/user/{g.user.id}/library')
\ No newline at end of file
+    return redirect(f'/user/{g.user.id}/library')
+
+###########
+# CLI commands
+###########
+
+@app.cli.command('import-library')
+@click.argument('user_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['mbids', 'csv', 'jsonl']), default='mbids')
+def import_library_command(user_id, path, fmt):
+    """Import a file of MBIDs or title/artist rows into a user's library"""
+    if User.query.get(user_id) is None:
+        raise click.BadParameter(f'No user with id {user_id}', param_hint='USER_ID')
+    with open(path, encoding='utf8') as f:
+        rows = parse_import(f.read(), fmt)
+    job = create_import_job(user_id, rows)
+    click.echo(f'Import {job.id}: {job.total} rows')
+    job = run_import(job.id)
+    click.echo(f'{job.status}: {job.added} added, {job.skipped} already in library, {job.failed} failed')
+
+@app.cli.command('resume-imports')
+def resume_imports_command():
+    """Finish every import that was interrupted or failed"""
+    for job in ImportJob.query.filter(ImportJob.status != 'done').order_by(ImportJob.id).all():
+        job = run_import(job.id)
+        click.echo(f'Import {job.id} {job.status}: {job.added} added, {job.skipped} already in library, {job.failed} failed')
+
+@app.cli.command('fetch-spotify-tracks')
+def fetch_spotify_tracks_command():
+    """Store Spotify metadata for every recording on Spotify that doesn't have it yet, committing a batch at a time"""
+    query = Recording.query.filter(Recording.spotify_uri.isnot(None), Recording.spotify_fetched_at.is_(None)).order_by(Recording.id)
+    after = 0
+    total = 0
+    while True:
+        batch = query.filter(Recording.id > after).limit(SPOTIFY_TRACKS_BATCH_SIZE).all()
+        if not batch:
+            break
+        after = batch[-1].id
+        total += update_spotify_tracks(batch)
+        db.session.commit()
+    click.echo(f'{total} recordings updated')
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """EXPLAIN every relationship load in models.py and fail if any of them scans a whole table"""
+    unindexed = unindexed_relationship_loads(db)
+    db.session.rollback()
+    for name, plan in unindexed.items():
+        click.echo(f'{name} is not indexed:')
+        for line in plan:
+            click.echo(f'    {line}')
+    if unindexed:
+        raise SystemExit(1)
+    click.echo('Every relationship load uses an index')
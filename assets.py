@@ -0,0 +1,156 @@
+"""Static asset build and serving. Run `python assets.py` after changing anything in static/.
+Heroku runs it on deploy from bin/post_compile"""
+
+import hashlib, json, mimetypes, os, posixpath, re, shutil
+
+from flask import current_app, send_from_directory
+from rcssmin import cssmin
+from rjsmin import jsmin
+from werkzeug.utils import safe_join
+
+from compression import BUILD_LEVELS, COMPRESSIBLE_TYPES, ENCODINGS, accepted_encodings, compress
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Built files go in this folder under static/, named by a hash of their content, next to a manifest of
+# source name -> built name. It isn't kept in git
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# A built file's name changes whenever its content does, so browsers can keep it for a year without checking
+ASSET_MAX_AGE = 60 * 60 * 24 * 365
+
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+###########
+# Build
+###########
+
+def source_files(static_dir):
+    """Paths of the files to build, relative to static_dir with forward slashes"""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    for root, dirs, names in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != build_dir)
+        for name in sorted(names):
+            yield os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, '/')
+
+
+def hashed_name(name, data):
+    stem, ext = posixpath.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+
+def rewrite_css_urls(name, css, manifest):
+    """Point url()s in a stylesheet at the built files they refer to. Other URLs are left as they are"""
+    def rewrite(match):
+        quote, url = match.groups()
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), url))
+        if target not in manifest:
+            return match.group(0)
+        built = posixpath.relpath(manifest[target], posixpath.join(BUILD_DIR, posixpath.dirname(name)))
+        return f'url({quote}{built}{quote})'
+
+    return CSS_URL_RE.sub(rewrite, css)
+
+
+def minify(name, data, manifest):
+    """Minified JavaScript and CSS. Other files are returned unchanged"""
+    ext = posixpath.splitext(name)[1]
+    if ext == '.js':
+        return jsmin(data.decode('utf8')).encode('utf8')
+    if ext == '.css':
+        return rewrite_css_urls(name, cssmin(data.decode('utf8')), manifest).encode('utf8')
+    return data
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_assets(static_dir=STATIC_DIR):
+    """Rebuild static/build: every static file minified, renamed with a hash of its content,
+    and for text files gzip and brotli copies where they come out smaller. Returns the manifest"""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+    manifest = {}
+    # Stylesheets go last so their url()s can use the built names of the images they show
+    for name in sorted(source_files(static_dir), key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = minify(name, f.read(), manifest)
+        built = hashed_name(name, data)
+        write_file(os.path.join(build_dir, built), data)
+        manifest[name] = f'{BUILD_DIR}/{built}'
+
+        if mimetypes.guess_type(name)[0] in COMPRESSIBLE_TYPES:
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding, BUILD_LEVELS[encoding])
+                if len(compressed) < len(data):
+                    write_file(os.path.join(build_dir, built + ENCODING_SUFFIXES[encoding]), compressed)
+
+    write_file(os.path.join(build_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf8'))
+    return manifest
+
+
+###########
+# Serving
+###########
+
+def load_manifest(static_dir):
+    """The manifest from the last build, or an empty one when the assets haven't been built"""
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def manifest_version(manifest):
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def serve_static(filename):
+    """Flask's static view, except that built files are sent precompressed when the client accepts it and cached for good.
+    Files that aren't built keep Flask's defaults"""
+    if not filename.startswith(BUILD_DIR + '/'):
+        return current_app.send_static_file(filename)
+
+    static_dir = current_app.static_folder
+    for encoding in accepted_encodings():
+        path = safe_join(static_dir, filename + ENCODING_SUFFIXES[encoding])
+        if path and os.path.isfile(path):
+            response = send_from_directory(static_dir, filename + ENCODING_SUFFIXES[encoding],
+                mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(static_dir, filename, max_age=ASSET_MAX_AGE)
+
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    """Make url_for('static') give the built name of a file when there is one, and serve built files"""
+    app.config.setdefault('ASSET_MANIFEST', load_manifest(app.static_folder))
+    # Pages link to built names, so their ETags change with the build
+    app.config.setdefault('ASSET_VERSION', manifest_version(app.config['ASSET_MANIFEST']))
+
+    @app.url_defaults
+    def use_built_assets(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in app.config['ASSET_MANIFEST']:
+            values['filename'] = app.config['ASSET_MANIFEST'][values['filename']]
+
+    app.view_functions['static'] = serve_static
+
+
+if __name__ == '__main__':
+    manifest = build_assets()
+    print(f'Built {len(manifest)} static files into static/{BUILD_DIR}')
@@ -0,0 +1,303 @@
+import fcntl, hashlib, json, os, tempfile, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Every gunicorn worker on a host points at the same directory, so the file tier is shared between them
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'musophile-cache'))
+
+# Registry of named caches so their stats can be reported in one place
+CACHES = {}
+
+
+def cache_stats():
+    """Return the hit/miss counters of every registered cache"""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path that every process on the host respects"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MemoryCache:
+    """In-process LRU store of (value, expires_at) entries. A max_size of 0 stores nothing"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, value, expires_at):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileCache:
+    """Directory-backed store of JSON entries that every worker on the host can share.
+    Once it holds more than max_files entries the least recently written ones are removed"""
+
+    # Check the directory size once every this many writes rather than on every write
+    PRUNE_INTERVAL = 100
+
+    # Keys share this many lock files, so the directory doesn't fill up with one per key
+    LOCK_STRIPES = 256
+
+    def __init__(self, directory, max_files=None):
+        self.directory = directory
+        self.max_files = max_files
+        self.evictions = 0
+        self._writes = 0
+        self._lock_dir = os.path.join(directory, 'locks')
+        os.makedirs(self._lock_dir, exist_ok=True)
+
+    def _hash(self, key):
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, self._hash(key) + '.json')
+
+    def lock(self, key):
+        """An exclusive lock on key across every worker on the host"""
+        stripe = int(self._hash(key), 16) % self.LOCK_STRIPES
+        return file_lock(os.path.join(self._lock_dir, f'{stripe}.lock'))
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['value'], entry['expires_at']
+
+    def set(self, key, value, expires_at):
+        # Write to a temp file and rename it so readers in other workers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'value': value, 'expires_at': expires_at}, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+        self._writes += 1
+        if self.max_files and self._writes % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove the oldest entries until at most max_files are left"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.json'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        excess = len(entries) - self.max_files
+        if excess <= 0:
+            return
+        for _, path in sorted(entries)[:excess]:
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class _PendingLoad:
+    """A load in progress that other requests for the same key wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Cache:
+    """Two-tier TTL cache: an LRU memory tier in front of an optional shared file tier.
+
+    Entries are fresh for `ttl` seconds. For `stale_ttl` seconds after that they are
+    still served while a background thread reloads them (stale-while-revalidate).
+
+    Concurrent misses for a key share one load: a thread lock covers this worker, and with a shared tier
+    a file lock covers the other workers on the host. Without one, each worker loads for itself.
+
+    Deleting a key can't reach other workers' memory tiers, so caches that are invalidated
+    on writes use max_size=0 and keep their entries in the shared tier alone."""
+
+    def __init__(self, name, ttl, max_size=1024, stale_ttl=0, directory=None, max_files=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.memory = MemoryCache(max_size)
+        self.shared = FileCache(directory, max_files) if directory else None
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.load_errors = 0
+        self.coalesced = 0
+        self._refreshing = set()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+        CACHES[name] = self
+
+    def _lookup(self, key):
+        """Find an entry in memory, then in the shared tier. Returns (value, expires_at) or None"""
+        entry = self.memory.get(key)
+        if entry is None and self.shared:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.memory.set(key, *entry)
+        return entry
+
+    def get(self, key, default=None):
+        """Return a fresh value for key, or default"""
+        entry = self._lookup(key)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Store value in both tiers. ttl overrides the cache's default for this entry"""
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self.memory.set(key, value, expires_at)
+        if self.shared:
+            self.shared.set(key, value, expires_at)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.shared:
+            self.shared.delete(key)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() to fill it on a miss.
+        Concurrent misses for the same key share a single loader() call"""
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                self.hits += 1
+                return value
+            if expires_at + self.stale_ttl > now:
+                self.stale_hits += 1
+                self._refresh_in_background(key, loader)
+                return value
+
+        self.misses += 1
+        with self._lock:
+            pending = self._loading.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._loading[key] = _PendingLoad()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            pending.done.wait()
+            if pending.error:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = self._load(key, loader)
+            return pending.value
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+            pending.done.set()
+
+    def _load(self, key, loader):
+        """Call loader() and store the value. With a shared tier, workers take turns on the key's
+        lock, and one that waited uses the value stored by the worker before it"""
+        if not self.shared:
+            value = loader()
+            self.set(key, value)
+            return value
+
+        with self.shared.lock(key):
+            entry = self.shared.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.coalesced += 1
+                self.memory.set(key, *entry)
+                return entry[0]
+            value = loader()
+            self.set(key, value)
+            return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._load(key, loader)
+            except Exception:
+                self.load_errors += 1
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            'coalesced': self.coalesced,
+            'load_errors': self.load_errors,
+            'evictions': self.memory.evictions,
+            'shared_evictions': self.shared.evictions if self.shared else 0,
+            'size': len(self.memory)
+        }
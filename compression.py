@@ -0,0 +1,60 @@
+import zlib
+
+import brotli
+from flask import request
+
+# Brotli is smaller, so it's picked when the client takes both
+ENCODINGS = ('br', 'gzip')
+
+# Types worth compressing. Images are compressed already
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'
+}
+
+# Smaller bodies don't shrink enough to be worth the time
+MIN_COMPRESS_SIZE = 500
+
+# Pages are compressed on every request, so with fast settings. Static files are compressed once at build time, as small as they go
+DYNAMIC_LEVELS = {'br': 5, 'gzip': 6}
+BUILD_LEVELS = {'br': 11, 'gzip': 9}
+
+
+def compress(data, encoding, level):
+    """Compress bytes as brotli or gzip. The gzip header has no timestamp, so the same input always gives the same bytes"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepted_encodings():
+    """The encodings the client takes, preferred first"""
+    return [encoding for encoding in ENCODINGS if request.accept_encodings[encoding] > 0]
+
+
+def init_compression(app):
+    """Compress dynamic responses for clients that accept it. Register before any other after_request hook so it runs
+    last, on the finished body and headers. Files, streams and responses that are already encoded are left alone"""
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encodings = accepted_encodings()
+        data = response.get_data()
+        if not encodings or len(data) < MIN_COMPRESS_SIZE:
+            return response
+
+        encoding = encodings[0]
+        response.set_data(compress(data, encoding, DYNAMIC_LEVELS[encoding]))
+        response.content_encoding = encoding
+        # The compressed body isn't byte for byte what a strong ETag promises. Weak ETags still answer If-None-Match
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
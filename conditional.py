@@ -0,0 +1,69 @@
+import hashlib
+from datetime import timezone
+
+from flask import abort, current_app, g, make_response, request, session
+
+from fragments import templates_version
+
+
+def page_etag(entity):
+    """Strong ETag for a page showing one versioned row. The page also depends on its URL, on who's looking
+    and on the built static files it links to"""
+    viewer = g.user.id if g.user else None
+    parts = [request.full_path, viewer, templates_version(), current_app.config.get('ASSET_VERSION'),
+        entity.__tablename__, entity.id, entity.version]
+    return hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+
+
+def is_current(etag, last_modified):
+    """Whether the client's copy matches. If-None-Match wins when both validators are sent"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def check_not_modified(entity):
+    """Call from a GET view as soon as the row the page shows is loaded. Ends the request with a 304 before
+    anything is rendered when the client's copy is current, otherwise the page goes out with validators for next time"""
+    # A flashed message is shown once, so a page with one is neither answered from nor saved to the client's cache
+    if session.get('_flashes'):
+        return
+    etag = page_etag(entity)
+    last_modified = entity.updated_at.replace(microsecond=0, tzinfo=timezone.utc)
+    g.validators = (etag, last_modified)
+    if is_current(etag, last_modified):
+        abort(make_response('', 304))
+
+
+def cacheable(response, max_age):
+    """Let the client keep a JSON response for max_age seconds, then revalidate it against an ETag of the body"""
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def not_cacheable(response):
+    response.cache_control.no_store = True
+    return response
+
+
+def init_conditional(app):
+    """Add the validators set by check_not_modified to the response, whether it's the page or a 304"""
+
+    @app.after_request
+    def add_validators(response):
+        validators = g.pop('validators', None)
+        if validators is None or response.status_code not in (200, 304):
+            return response
+
+        etag, last_modified = validators
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # The browser may keep the page but has to check it's current before showing it again
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
@@ -0,0 +1,145 @@
+import csv, io, json, zlib
+from xml.sax.saxutils import escape
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from models import db, Library, PlaylistRecording, Recording, RecordingTag, Tag
+
+EXPORT_FORMATS = ('jsonl', 'csv', 'm3u', 'xspf')
+
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'm3u': 'audio/x-mpegurl; charset=utf-8',
+    'xspf': 'application/xspf+xml; charset=utf-8'
+}
+
+# Columns in every export. The CSV has the title, artist and mbid columns the importer reads, so it can be imported again
+EXPORT_FIELDS = ('id', 'mbid', 'title', 'artist', 'release', 'spotify_uri', 'comments', 'tags')
+
+# Rows are fetched from a server-side cursor and written out this many at a time,
+# so memory use depends on this and not on the size of the library
+EXPORT_BATCH_SIZE = 500
+
+MUSICBRAINZ_RECORDING_URL = 'https://musicbrainz.org/recording/'
+
+# XSPF meta elements are named by URI
+XSPF_ID_REL = 'https://musophile.herokuapp.com/xspf/id'
+
+
+def export_query(user_id, playlist_id=None, after=None):
+    """Recordings in a user library, or in one of the user's playlists, with the user's comments and their tag names,
+    ordered by id. Starts after the recording id `after` so an interrupted export can be resumed"""
+    tags = func.array_remove(func.array_agg(aggregate_order_by(Tag.name, Tag.name)), None)
+    columns = {'comments': Library.comments, 'tags': tags.label('tags')}
+    query = select(*[columns[field] if field in columns else getattr(Recording, field) for field in EXPORT_FIELDS])
+    in_library = and_(Library.recording_id == Recording.id, Library.user_id == user_id)
+    if playlist_id is None:
+        query = query.join(Library, in_library)
+    else:
+        # A song can stay on a playlist after leaving the library, it just has no comments then
+        query = (query.join(PlaylistRecording, and_(PlaylistRecording.recording_id == Recording.id, PlaylistRecording.playlist_id == playlist_id))
+            .outerjoin(Library, in_library))
+    query = (query.outerjoin(RecordingTag, RecordingTag.recording_id == Recording.id)
+        .outerjoin(Tag, Tag.id == RecordingTag.tag_id)
+        .group_by(Recording.id, Library.comments)
+        .order_by(Recording.id))
+    if after is not None:
+        query = query.where(Recording.id > after)
+    return query
+
+
+def library_export_query(user_id, after=None):
+    return export_query(user_id, after=after)
+
+
+def playlist_export_query(playlist, after=None):
+    return export_query(playlist.user_id, playlist.id, after=after)
+
+
+def stream_rows(query, batch_size=None):
+    """Run the query on a server-side cursor and yield lists of row dicts, EXPORT_BATCH_SIZE at a time"""
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    result = db.session.execute(query.execution_options(stream_results=True, max_row_buffer=batch_size))
+    for rows in result.mappings().partitions(batch_size):
+        yield [dict(row) for row in rows]
+
+
+def track_location(row):
+    """Spotify URI of the track, or its MusicBrainz page when it isn't on Spotify"""
+    if row['spotify_uri']:
+        return f'spotify:track:{row["spotify_uri"]}'
+    return MUSICBRAINZ_RECORDING_URL + row['mbid']
+
+
+def write_jsonl(batches, title, resumed):
+    for rows in batches:
+        yield ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def write_csv(batches, title, resumed):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    # A resumed export is appended to the first part, which already has the header
+    if not resumed:
+        writer.writerow(EXPORT_FIELDS)
+    for rows in batches:
+        for row in rows:
+            writer.writerow([', '.join(row[f]) if f == 'tags' else row[f] for f in EXPORT_FIELDS])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def write_m3u(batches, title, resumed):
+    if not resumed:
+        yield f'#EXTM3U\n#PLAYLIST:{title}\n'
+    for rows in batches:
+        # The id attribute is the cursor for resuming, like tvg-id in IPTV playlists
+        yield ''.join(
+            f'#EXTINF:-1 musophile-id="{row["id"]}",{row["artist"]} - {row["title"]}\n{track_location(row)}\n'
+            for row in rows
+        )
+
+
+def write_xspf(batches, title, resumed):
+    # Every part is a complete playlist document, resumed or not
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+        f'  <title>{escape(title)}</title>\n  <trackList>\n')
+    for rows in batches:
+        yield ''.join(
+            '    <track>\n'
+            f'      <location>{escape(track_location(row))}</location>\n'
+            f'      <identifier>{escape(MUSICBRAINZ_RECORDING_URL + row["mbid"])}</identifier>\n'
+            f'      <title>{escape(row["title"])}</title>\n'
+            f'      <creator>{escape(row["artist"])}</creator>\n'
+            + (f'      <album>{escape(row["release"])}</album>\n' if row['release'] else '')
+            + (f'      <annotation>{escape(row["comments"])}</annotation>\n' if row['comments'] else '')
+            + f'      <meta rel="{XSPF_ID_REL}">{row["id"]}</meta>\n'
+            '    </track>\n'
+            for row in rows
+        )
+    yield '  </trackList>\n</playlist>\n'
+
+
+WRITERS = {'jsonl': write_jsonl, 'csv': write_csv, 'm3u': write_m3u, 'xspf': write_xspf}
+
+
+def export_chunks(query, fmt, title, resumed=False):
+    """Yield the export a batch at a time as text. Raises ValueError for an unknown format"""
+    if fmt not in WRITERS:
+        raise ValueError(f'Format must be one of {", ".join(EXPORT_FORMATS)}')
+    return (chunk for chunk in WRITERS[fmt](stream_rows(query), title, resumed) if chunk)
+
+
+def gzip_chunks(chunks):
+    """Compress text chunks into one gzip stream as they're produced"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf8'))
+        if data:
+            yield data
+    yield compressor.flush()
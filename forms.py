@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SelectField
+from flask_wtf.file import FileField, FileRequired
+from wtforms import StringField, PasswordField, SelectField, SelectMultipleField
 from wtforms.fields.simple import TextAreaField
 from wtforms.validators import InputRequired, Email, Optional, Length
 
@@ -48,6 +49,16 @@ class PlaylistForm(FlaskForm):
     description = StringField("Describe your playlist", validators=[Optional()])
     
 class AddToPlaylistForm(FlaskForm):
-    """Add a song to a playlist"""
+    """Add songs to a playlist"""
 
-    recording = SelectField("Pick a song from your library", choices=[], coerce=int)
\ No newline at end of file
+    recording = SelectMultipleField("Pick songs from your library", choices=[], coerce=int, validators=[InputRequired()])
+
+class ImportForm(FlaskForm):
+    """Import many songs into a library at once"""
+
+    file = FileField("File to import", validators=[FileRequired()])
+    format = SelectField("File format", choices=[
+        ('mbids', 'MusicBrainz ids, one per line'),
+        ('csv', 'CSV with an mbid column, or title and artist columns'),
+        ('jsonl', 'JSON lines with an mbid, or a title and artist')
+    ], validators=[InputRequired()])
@@ -0,0 +1,89 @@
+import hashlib, os, threading, time
+from functools import lru_cache
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from cache import Cache, CACHE_DIR
+
+# Keys include the version of the row shown, so a write never has to delete anything here
+# and the memory tier can't serve another worker's outdated HTML
+FRAGMENT_TTL = 60 * 60 * 24
+
+fragment_cache = Cache(
+    'fragments',
+    ttl=FRAGMENT_TTL,
+    max_size=256,
+    directory=os.path.join(CACHE_DIR, 'fragments'),
+    max_files=10000
+)
+
+
+class RenderStats:
+    """Time spent rendering fragments on misses and the time hits saved"""
+
+    def __init__(self):
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def rendered(self, seconds):
+        with self._lock:
+            self.renders += 1
+            self.render_seconds += seconds
+
+    def reused(self, seconds):
+        with self._lock:
+            self.saved_seconds += seconds
+
+
+render_stats = RenderStats()
+
+
+@lru_cache()
+def templates_version():
+    """Hash of every template's source, so HTML made by an older release is never reused after a deploy"""
+    env = current_app.jinja_env
+    digest = hashlib.sha1()
+    for name in sorted(env.list_templates()):
+        digest.update(env.loader.get_source(env, name)[0].encode('utf8'))
+    return digest.hexdigest()[:12]
+
+
+def fragment_key(template, entity, variant):
+    args = ','.join(f'{name}={value}' for name, value in sorted(variant.items()))
+    return f'{template}:{templates_version()}:{entity.__tablename__}:{entity.id}:{entity.version}:{args}'
+
+
+def render_fragment(template, entity, load, **variant):
+    """Render the part of a page that shows one versioned row, like a playlist's songs, or reuse the HTML saved
+    for the row's current version. entity should be loaded before anything load() reads, so data from after
+    a write is never saved under the version from before it.
+    load() returns the template context and only runs on a miss, so its queries are skipped on a hit too.
+    variant is anything else the HTML depends on, like page arguments. It's part of the key and passed to the template"""
+    key = fragment_key(template, entity, variant)
+    entry = fragment_cache.get(key)
+    if entry is not None:
+        render_stats.reused(entry['seconds'])
+        return Markup(entry['html'])
+
+    start = time.perf_counter()
+    html = render_template(template, **load(), **variant)
+    seconds = time.perf_counter() - start
+    fragment_cache.set(key, {'html': html, 'seconds': seconds})
+    render_stats.rendered(seconds)
+    return Markup(html)
+
+
+def fragment_stats():
+    """Hit rate of the fragment cache and how much render time it saved this worker"""
+    stats = fragment_cache.stats()
+    return {
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'hit_rate': stats['hit_rate'],
+        'renders': render_stats.renders,
+        'render_seconds': round(render_stats.render_seconds, 3),
+        'render_seconds_saved': round(render_stats.saved_seconds, 3)
+    }
@@ -1,14 +1,104 @@
-import requests
+import os, re
+from datetime import datetime
 import musicbrainzngs as mb
+import requests
+from concurrent.futures import ThreadPoolExecutor
 
-from models import db, Tag
-from _startup import CLIENT_ID, CLIENT_SECRET
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+import http_client
+from models import db, Library, Playlist, Recording, Tag, RecordingTag, PlaylistRecording, User
+from cache import Cache, CACHE_DIR, CACHES
+from rate_limit import RateGovernor
+from spotify_tokens import get_app_token
 
 SPOTIFY_API_SEARCH = 'https://api.spotify.com/v1/search/'
-SPOTIFY_REFRESH_URL = 'https://accounts.spotify.com/api/token/'
+SPOTIFY_API_TRACKS = 'https://api.spotify.com/v1/tracks'
+
+# Spotify's several-tracks endpoint takes at most this many ids per request
+SPOTIFY_TRACKS_BATCH_SIZE = 50
+
+# Spotify ids are 22 base62 characters
+SPOTIFY_TRACK_ID_RE = re.compile(r'[0-9A-Za-z]{22}')
+
+# Album art comes in a few sizes. Cards use the smallest at least this wide, twice the size they show it at for dense screens
+SPOTIFY_CARD_IMAGE_WIDTH = 128
+
+# Upper bound on concurrent Spotify searches made for one batch request
+SPOTIFY_BATCH_WORKERS = 8
+
+# Matches are kept for a week. "Not on Spotify" is cached for a shorter time since the track may be added later
+SPOTIFY_MATCH_TTL = 60 * 60 * 24 * 7
+SPOTIFY_MISS_TTL = 60 * 60 * 24
+
+# "feat." after the title or artist, or in brackets. Band names like Little Feat, and names starting with Ft., are left alone
+FEATURED_ARTIST_RE = re.compile(r'\s*[\(\[](feat|ft|featuring)\b.*$|\s+(feat\.|ft\.|featuring\s).*$')
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+# MusicBrainz allows about one request a second per client. musicbrainzngs only limits each process on its own,
+# so its limiter is turned off and every call goes through a governor shared by all workers on the host
+MUSICBRAINZ_RATE = 1.0
+MUSICBRAINZ_SEARCH_TYPES = ('recording', 'artist', 'release', 'tag')
+MUSICBRAINZ_SEARCH_TTL = 60 * 60
+
+mb.set_rate_limit(False)
+mb_governor = RateGovernor('musicbrainz', rate=MUSICBRAINZ_RATE)
+
+# Text search configuration for library search vectors and queries
+SEARCH_CONFIG = 'english'
+
+# MusicBrainz recording data rarely changes, so keep it for a day and serve it stale for up to a week while refreshing
+RECORDING_CACHE_TTL = 60 * 60 * 24
+RECORDING_CACHE_STALE_TTL = 60 * 60 * 24 * 7
+
+recording_cache = Cache(
+    'musicbrainz-recordings',
+    ttl=RECORDING_CACHE_TTL,
+    stale_ttl=RECORDING_CACHE_STALE_TTL,
+    max_size=2048,
+    directory=os.path.join(CACHE_DIR, 'musicbrainz-recordings'),
+    max_files=50000
+)
+
+search_cache = Cache(
+    'musicbrainz-searches',
+    ttl=MUSICBRAINZ_SEARCH_TTL,
+    max_size=512,
+    directory=os.path.join(CACHE_DIR, 'musicbrainz-searches'),
+    max_files=10000
+)
+
+spotify_cache = Cache(
+    'spotify-matches',
+    ttl=SPOTIFY_MATCH_TTL,
+    max_size=4096,
+    directory=os.path.join(CACHE_DIR, 'spotify-matches'),
+    max_files=50000
+)
+
+# Tag counts per playlist. They're dropped whenever the playlist's songs or those songs' tags change,
+# which has to reach every worker, so they're kept in the shared tier only
+PLAYLIST_TAGS_TTL = 60 * 60 * 24
+
+playlist_tags_cache = Cache(
+    'playlist-tags',
+    ttl=PLAYLIST_TAGS_TTL,
+    max_size=0,
+    directory=os.path.join(CACHE_DIR, 'playlist-tags'),
+    max_files=10000
+)
 
 def get_recording_info(id):
+    """Helper function to get recording info, cached by MBID so MusicBrainz is only hit once per recording"""
+    return recording_cache.get_or_load(id, lambda: fetch_recording_info(id))
+
+
+def fetch_recording_info(id):
     """Helper function to get recording info from MusicBrainz"""
+    mb_governor.acquire()
     recording = mb.get_recording_by_id(id, includes=['artists', 'releases', 'tags'])
 
     title = recording['title']
@@ -32,8 +122,97 @@ def get_recording_info(id):
     return data
 
 
-def get_spotify_info(title, artist, token):
-    """Helper function to get recording info from Spotify"""
+def search_musicbrainz(search_type, term, limit):
+    """Helper function to search MusicBrainz recordings by title, artist, release or tag.
+    Results are cached and identical searches running at the same time share one MusicBrainz call"""
+    query = term if search_type == 'recording' else f'{search_type}:{term}'
+    key = f'{search_type}|{limit}|{" ".join(term.casefold().split())}'
+
+    def search():
+        mb_governor.acquire()
+        return mb.search_recordings(query=query, limit=limit)['recordings']
+
+    return search_cache.get_or_load(key, search)
+
+
+def get_or_create_recording(mbid, spotify_uri=None):
+    """Return the Recording for an MBID. MusicBrainz is only asked for data when no row exists yet"""
+    recording = Recording.query.filter_by(mbid=mbid).one_or_none()
+    if recording:
+        if spotify_uri and not recording.spotify_uri:
+            recording.spotify_uri = spotify_uri
+            recording.spotify_fetched_at = None
+        return recording
+
+    recording_data = get_recording_info(mbid)
+    recording = Recording(
+        mbid = mbid,
+        title = recording_data['title'],
+        artist = recording_data['artist'],
+        release = recording_data['release'] if recording_data['release'] else None,
+        spotify_uri = spotify_uri
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(recording)
+    except IntegrityError:
+        # Another request created the same recording in the meantime
+        return Recording.query.filter_by(mbid=mbid).one()
+
+    # Also builds the new recording's search vector, with or without tags
+    add_tags(recording, recording_data['tags'])
+
+    return recording
+
+
+def search_catalog(term, search_type=None, limit=25):
+    """Typo-tolerant search of the recordings already on Musophile, using pg_trgm similarity.
+    search_type 'recording' matches titles, 'artist' matches artists, anything else both.
+    Returns (recording, similarity) pairs, best first"""
+    columns = {'recording': [Recording.title], 'artist': [Recording.artist]}.get(search_type, [Recording.title, Recording.artist])
+    score = func.greatest(*[func.similarity(column, term) for column in columns])
+
+    # % is pg_trgm's similarity operator, which the trigram indexes can answer
+    return (db.session.query(Recording, score)
+        .filter(or_(*[column.op('%')(term) for column in columns]))
+        .options(selectinload(Recording.tags))
+        .order_by(score.desc(), Recording.id)
+        .limit(limit)
+        .all())
+
+
+def normalize_search_key(title, artist):
+    """Helper function to build the Spotify cache key for a title and artist.
+    Case, punctuation and featured-artist suffixes are ignored so equivalent searches share an entry"""
+    def normalize(text):
+        text = FEATURED_ARTIST_RE.sub('', text.casefold())
+        return ' '.join(PUNCTUATION_RE.sub(' ', text).split())
+
+    return f'{normalize(title)}|{normalize(artist)}'
+
+
+def get_spotify_info(title, artist, token=None):
+    """Helper function to get recording info from Spotify. Both matches and misses are cached.
+    Without a user token the shared client-credentials app token is used"""
+    key = normalize_search_key(title, artist)
+    spotify_info = spotify_cache.get(key)
+    if spotify_info is not None:
+        return spotify_info
+
+    spotify_info = search_spotify(title, artist, token or get_app_token())
+    if token is None and spotify_info.get('error', {}).get('status') == 401:
+        spotify_info = search_spotify(title, artist, get_app_token(force_refresh=True))
+
+    # Errors (expired tokens, rate limits) aren't cached so the next call retries
+    if 'tracks' in spotify_info:
+        ttl = SPOTIFY_MATCH_TTL if spotify_info['tracks']['items'] else SPOTIFY_MISS_TTL
+        spotify_cache.set(key, spotify_info, ttl=ttl)
+
+    return spotify_info
+
+
+def search_spotify(title, artist, token):
+    """Helper function to search Spotify for a recording"""
     params = {
         'q': f'{title} {artist}',
         'type': 'track',
@@ -43,44 +222,289 @@ def get_spotify_info(title, artist, token):
         'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
-    res = requests.get(f'{SPOTIFY_API_SEARCH}', params=params, headers=headers)
+    res = http_client.get(SPOTIFY_API_SEARCH, params=params, headers=headers)
 
     return res.json()
 
 
-def get_refresh_token(refresh_token):
-    """Helper function to get refresh token"""
-    data = {
-        "grant_type" : "refresh_token",
-        "refresh_token" : refresh_token,
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET
+def get_spotify_info_batch(items, token=None, workers=SPOTIFY_BATCH_WORKERS):
+    """Helper function to search Spotify for several recordings concurrently.
+    items is a list of dicts with mbid, title and artist. Returns a dict of mbid -> Spotify search response,
+    or None for a lookup that failed so one bad item doesn't lose the rest"""
+    def lookup(item):
+        try:
+            return get_spotify_info(item['title'], item['artist'], token)
+        except (requests.RequestException, ValueError):
+            return None
+
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+        return {item['mbid']: res for item, res in zip(items, pool.map(lookup, items))}
+
+
+def get_spotify_track(spotify_info):
+    """Helper function to pull the first track out of a Spotify search response, or None if nothing matched or the lookup failed"""
+    try:
+        return spotify_info['tracks']['items'][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def get_spotify_track_id(spotify_info):
+    """Helper function to pull the track id out of a Spotify search response, or None if nothing matched"""
+    track = get_spotify_track(spotify_info)
+    return track['uri'].split(':')[-1] if track else None
+
+
+def spotify_track_metadata(track):
+    """Recording columns for the card from a Spotify track object, as found in search and track responses.
+    None for a track Spotify doesn't know still counts as fetched"""
+    track = track or {}
+    images = (track.get('album') or {}).get('images') or []
+    large_enough = [image for image in images if (image.get('width') or 0) >= SPOTIFY_CARD_IMAGE_WIDTH]
+    image = min(large_enough, key=lambda image: image['width']) if large_enough else next(iter(images), None)
+    return {
+        'spotify_image_url': image['url'] if image else None,
+        'spotify_duration_ms': track.get('duration_ms'),
+        'spotify_preview_url': track.get('preview_url'),
+        'spotify_fetched_at': datetime.utcnow()
     }
 
+
+def get_spotify_tracks(track_ids, token=None):
+    """Helper function to get up to SPOTIFY_TRACKS_BATCH_SIZE tracks from Spotify in one request.
+    Returns a dict of track id -> track object, or None for ids Spotify doesn't know. Returns None if the request failed,
+    and raises ValueError if Spotify rejected an id"""
+    spotify_info = fetch_spotify_tracks(track_ids, token or get_app_token())
+    if token is None and spotify_info.get('error', {}).get('status') == 401:
+        spotify_info = fetch_spotify_tracks(track_ids, get_app_token(force_refresh=True))
+    if spotify_info.get('error', {}).get('status') == 400:
+        raise ValueError(spotify_info['error'].get('message', 'invalid id'))
+    if 'tracks' not in spotify_info:
+        return None
+    return dict(zip(track_ids, spotify_info['tracks']))
+
+
+def fetch_spotify_tracks(track_ids, token):
+    """Helper function to look up several tracks on Spotify by id"""
     headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
     }
-    resp = requests.post(f'{SPOTIFY_REFRESH_URL}', data=data, headers=headers)
-    json = resp.json()
-    new_token_data = [
-        json['access_token'],
-        {'Authorization': f"Bearer {json['access_token']}"},
-        json['expires_in'],
-        refresh_token
-    ]
-    return new_token_data
-
-
-def create_tag(tag, recording):
-    """Function to add a tag to a song. Checks if the tag exists already and creates a new one if it doesn't"""
-    try_tag = Tag.query.filter_by(name=tag).one_or_none()
-    if try_tag:
-        recording.tags.append(try_tag)
-        db.session.commit()
-    else:
-        new_tag = Tag(name=tag)
-        db.session.add(new_tag)
-        db.session.commit()
-
-        recording.tags.append(new_tag)
-        db.session.commit()
\ No newline at end of file
+    res = http_client.get(SPOTIFY_API_TRACKS, params={'ids': ','.join(track_ids)}, headers=headers)
+    try:
+        return res.json()
+    except ValueError:
+        # Gateway errors come back as HTML
+        return {'error': {'status': res.status_code}}
+
+
+def set_spotify_metadata(recording, track):
+    """Helper function to copy a Spotify track's card metadata onto a recording"""
+    for column, value in spotify_track_metadata(track).items():
+        setattr(recording, column, value)
+
+
+def update_spotify_tracks(recordings):
+    """Store Spotify metadata on the recordings that have a track but haven't been looked up yet,
+    SPOTIFY_TRACKS_BATCH_SIZE to a request. Batches that fail are left for next time. Returns how many were updated. Doesn't commit"""
+    def lookup_each(track_ids):
+        # One id Spotify rejects fails the whole batch, so each is tried alone. Rejected ids count as
+        # looked up with no track so they aren't retried forever, ids that fail for other reasons wait for next time
+        tracks = {}
+        for track_id in track_ids:
+            try:
+                tracks.update(get_spotify_tracks([track_id]) or {})
+            except ValueError:
+                tracks[track_id] = None
+            except requests.RequestException:
+                pass
+        return tracks
+
+    updated = []
+    to_fetch = []
+    for recording in recordings:
+        if not recording.spotify_uri or recording.spotify_fetched_at is not None:
+            continue
+        # A recording found through a search that's still cached gets its track from the search response, without a request
+        spotify_info = spotify_cache.get(normalize_search_key(recording.title, recording.artist))
+        if get_spotify_track_id(spotify_info) == recording.spotify_uri:
+            set_spotify_metadata(recording, get_spotify_track(spotify_info))
+            updated.append(recording)
+        else:
+            to_fetch.append(recording)
+
+    for start in range(0, len(to_fetch), SPOTIFY_TRACKS_BATCH_SIZE):
+        batch = to_fetch[start:start + SPOTIFY_TRACKS_BATCH_SIZE]
+        try:
+            tracks = get_spotify_tracks([r.spotify_uri for r in batch])
+        except requests.RequestException:
+            tracks = None
+        except ValueError:
+            tracks = lookup_each([r.spotify_uri for r in batch])
+        if tracks is None:
+            continue
+        for recording in batch:
+            if recording.spotify_uri in tracks:
+                set_spotify_metadata(recording, tracks[recording.spotify_uri])
+                updated.append(recording)
+    db.session.flush()
+    bump_card_versions(r.id for r in updated)
+    return len(updated)
+
+
+def search_vector():
+    """SQL expression for a recording's search vector. Titles and artists weigh the most, then releases and tags"""
+    tag_names = (select(func.string_agg(Tag.name, ' '))
+        .join(RecordingTag, RecordingTag.tag_id == Tag.id)
+        .where(RecordingTag.recording_id == Recording.id)
+        .scalar_subquery())
+
+    return (weighted(Recording.title, 'A')
+        .op('||')(weighted(Recording.artist, 'A'))
+        .op('||')(weighted(Recording.release, 'B'))
+        .op('||')(weighted(tag_names, 'B')))
+
+
+def weighted(text, weight):
+    return func.setweight(func.to_tsvector(SEARCH_CONFIG, func.coalesce(text, '')), weight)
+
+
+def library_search_match(tsquery):
+    """SQL condition for a user library search, for queries joined to Library. Each side is matched against its own
+    indexed vector, so nothing is rebuilt per row"""
+    return or_(Recording.search_vector.op('@@')(tsquery), Library.comments_vector.op('@@')(tsquery))
+
+
+def library_search_rank(tsquery):
+    """SQL expression ranking a library search match by the recording's fields and the user's comments together"""
+    return func.ts_rank(Recording.search_vector.op('||')(Library.comments_vector), tsquery)
+
+
+def update_search_vectors(recording_ids):
+    """Rebuild the search vectors of some recordings in one statement. Call after their fields or tags change. Doesn't commit"""
+    recording_ids = list(recording_ids)
+    if not recording_ids:
+        return
+    db.session.flush()
+    Recording.query.filter(Recording.id.in_(recording_ids)).update(
+        {Recording.search_vector: search_vector()}, synchronize_session=False
+    )
+
+
+def add_tags_to_recordings(tags_by_recording):
+    """Function to add tags by name to several recordings ({recording id: [names]}) without committing"""
+    tags_by_recording = {
+        recording_id: list(dict.fromkeys(name.strip() for name in names if name and name.strip()))
+        for recording_id, names in tags_by_recording.items()
+    }
+    # Kept in order so new tags get their ids in the order they were given
+    names = list(dict.fromkeys(name for names in tags_by_recording.values() for name in names))
+    if names:
+        db.session.execute(insert(Tag.__table__).on_conflict_do_nothing(index_elements=['name']), [{'name': name} for name in names])
+        tag_ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+        db.session.execute(insert(RecordingTag.__table__).on_conflict_do_nothing(), [
+            {'recording_id': recording_id, 'tag_id': tag_ids[name]}
+            for recording_id, names in tags_by_recording.items() for name in names
+        ])
+        invalidate_playlist_tags_for_recordings(tags_by_recording)
+        bump_versions(Tag, tag_ids.values())
+        bump_recording_versions(tags_by_recording)
+    update_search_vectors(tags_by_recording)
+
+
+def add_tags(recording, names):
+    """Function to add tags to a song by name and commit once"""
+    add_tags_to_recordings({recording.id: names})
+    db.session.commit()
+
+
+###########
+# Cache invalidation
+###########
+
+def invalidate_on_commit(cache, keys):
+    """Drop cache keys once the current transaction commits. Dropping them any earlier
+    would let another request cache the old data again before the change is visible"""
+    db.session.info.setdefault('invalidate', set()).update((cache.name, key) for key in keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    for name, key in session.info.pop('invalidate', ()):
+        CACHES[name].delete(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('invalidate', None)
+
+
+def get_playlist_tags(playlist_id):
+    """Distinct tags on a playlist's songs with how many songs have each, most used first, from one query.
+    Returns a list of dicts with id, name and count"""
+    def load():
+        count = func.count(RecordingTag.recording_id)
+        rows = (db.session.query(Tag.id, Tag.name, count)
+            .join(RecordingTag, RecordingTag.tag_id == Tag.id)
+            .join(PlaylistRecording, PlaylistRecording.recording_id == RecordingTag.recording_id)
+            .filter(PlaylistRecording.playlist_id == playlist_id)
+            .group_by(Tag.id, Tag.name)
+            .order_by(count.desc(), Tag.name)
+            .all())
+        return [{'id': id, 'name': name, 'count': n} for id, name, n in rows]
+
+    return playlist_tags_cache.get_or_load(str(playlist_id), load)
+
+
+def invalidate_playlist_tags(playlist_ids):
+    """Call when songs are added to or removed from playlists. Also bumps the playlists' versions"""
+    playlist_ids = list(playlist_ids)
+    invalidate_on_commit(playlist_tags_cache, [str(id) for id in playlist_ids])
+    bump_versions(Playlist, playlist_ids)
+
+
+def invalidate_playlist_tags_for_recordings(recording_ids):
+    """Call when recordings' tags change. Finds the playlists they're on with one query"""
+    recording_ids = list(recording_ids)
+    if not recording_ids:
+        return
+    playlist_ids = db.session.query(PlaylistRecording.playlist_id).filter(
+        PlaylistRecording.recording_id.in_(recording_ids)
+    ).distinct()
+    invalidate_playlist_tags(id for (id,) in playlist_ids)
+
+
+def bump_versions(model, ids):
+    """Call when users, playlists, recordings or tags change, or anything shown with them does. Bumps their revision
+    and change time in the current transaction, so fragments and ETags made from the old version stop being used"""
+    ids = list(ids)
+    if not ids:
+        return
+    model.query.filter(model.id.in_(ids)).update(
+        {model.revision: model.revision + 1, model.updated_at: datetime.utcnow()}, synchronize_session=False
+    )
+
+
+def bump_recording_versions(recording_ids):
+    """Call when recordings' tags change. Also bumps the users whose libraries show them, found with one query"""
+    recording_ids = list(recording_ids)
+    if not recording_ids:
+        return
+    bump_versions(Recording, recording_ids)
+    user_ids = db.session.query(Library.user_id).filter(Library.recording_id.in_(recording_ids)).distinct()
+    bump_versions(User, [id for (id,) in user_ids])
+
+
+def bump_card_versions(recording_ids):
+    """Call when what recordings' cards show changes. Bumps them, the users whose libraries show them,
+    and the playlists and tags whose pages list them"""
+    recording_ids = list(recording_ids)
+    if not recording_ids:
+        return
+    bump_recording_versions(recording_ids)
+    playlist_ids = db.session.query(PlaylistRecording.playlist_id).filter(PlaylistRecording.recording_id.in_(recording_ids)).distinct()
+    bump_versions(Playlist, [id for (id,) in playlist_ids])
+    tag_ids = db.session.query(RecordingTag.tag_id).filter(RecordingTag.recording_id.in_(recording_ids)).distinct()
+    bump_versions(Tag, [id for (id,) in tag_ids])
@@ -0,0 +1,114 @@
+import random, threading, time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds so a slow upstream can't hang a worker
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Keep-alive connections kept open per upstream host
+POOL_SIZE = 10
+
+# Retries are only made for idempotent methods unless a caller asks for them
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 8
+# A Retry-After longer than this isn't waited out, the 429 is returned to the caller instead
+MAX_RETRY_AFTER = 30
+
+_sessions = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def _session_for(host):
+    """Return the pooled session for an upstream host, creating it on first use"""
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+            _stats[host] = {'requests': 0, 'retries': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+        return session
+
+
+def _record(host, **counts):
+    with _lock:
+        stats = _stats[host]
+        for name, value in counts.items():
+            stats[name] += value
+        stats['max_seconds'] = max(stats['max_seconds'], counts.get('total_seconds', 0))
+
+
+def _backoff(attempt, response=None):
+    """Seconds to wait before the next attempt, or None if Retry-After asks for too long"""
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            retry_after = float(response.headers['Retry-After'])
+        except ValueError:
+            retry_after = None
+        if retry_after is not None:
+            return retry_after if retry_after <= MAX_RETRY_AFTER else None
+    # Full jitter so workers that failed together don't retry together
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method, url, retries=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """Make an outbound request over the host's keep-alive pool, retrying failures with jittered backoff"""
+    method = method.upper()
+    if retries is None:
+        retries = MAX_RETRIES if method in IDEMPOTENT_METHODS else 0
+
+    host = urlsplit(url).netloc
+    session = _session_for(host)
+
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            _record(host, requests=1, errors=1, total_seconds=time.monotonic() - start)
+            if attempt == retries:
+                raise
+            _record(host, retries=1)
+            time.sleep(_backoff(attempt))
+            continue
+
+        _record(host, requests=1, total_seconds=time.monotonic() - start)
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+
+        wait = _backoff(attempt, response)
+        if wait is None:
+            return response
+        _record(host, retries=1)
+        time.sleep(wait)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def http_stats():
+    """Request counts, latency and pool usage for each upstream host"""
+    report = {}
+    with _lock:
+        for host, stats in _stats.items():
+            pools = _sessions[host].get_adapter(f'https://{host}').poolmanager.pools
+            report[host] = {
+                **stats,
+                'avg_seconds': stats['total_seconds'] / stats['requests'] if stats['requests'] else 0.0,
+                'pool_size': POOL_SIZE,
+                'connections_opened': sum(pools[key].num_connections for key in pools.keys())
+            }
+    return report
@@ -0,0 +1,235 @@
+import csv, io, json, re, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import musicbrainzngs as mb
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, ImportJob, ImportItem, Recording, Library, User
+from helpers import add_tags_to_recordings, bump_versions, get_recording_info, get_spotify_info_batch, get_spotify_track, get_spotify_track_id, search_musicbrainz, spotify_track_metadata, SPOTIFY_BATCH_WORKERS
+
+IMPORT_FORMATS = ('mbids', 'csv', 'jsonl')
+MAX_IMPORT_ROWS = 10000
+
+# Items are written to the database this many at a time, and progress is saved after each batch
+BATCH_SIZE = 50
+
+# MusicBrainz scores search hits out of 100. Title/artist rows whose best hit scores lower aren't imported
+MIN_MATCH_SCORE = 90
+
+LUCENE_SPECIAL_RE = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/])')
+
+# A running job whose progress hasn't been saved for this long is taken to have died with its worker
+STALL_TIMEOUT = timedelta(minutes=10)
+
+# Concurrency per stage. MusicBrainz calls also wait on the shared rate governor,
+# so more workers there only keep a request queued up, they don't go faster.
+MUSICBRAINZ_WORKERS = 2
+SPOTIFY_WORKERS = SPOTIFY_BATCH_WORKERS
+
+
+def parse_import(text, fmt):
+    """Turn an uploaded file into import rows: dicts with an mbid, or a title and artist.
+    Raises ValueError for an unknown format or a row that has neither"""
+    # Each row goes with where it came from, so errors can point at it
+    if fmt == 'mbids':
+        rows = [(f'Line {n}', {'mbid': line}) for n, line in enumerate(text.splitlines(), start=1) if line.strip()]
+    elif fmt == 'csv':
+        rows = [(f'Row {n}', row) for n, row in enumerate(csv.DictReader(io.StringIO(text)), start=1)]
+    elif fmt == 'jsonl':
+        rows = []
+        for n, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                rows.append((f'Line {n}', json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f'Line {n} is not valid JSON: {e}')
+    else:
+        raise ValueError(f'Format must be one of {", ".join(IMPORT_FORMATS)}')
+
+    if len(rows) > MAX_IMPORT_ROWS:
+        raise ValueError(f'Imports are limited to {MAX_IMPORT_ROWS} rows')
+
+    cleaned = []
+    for where, row in rows:
+        if not isinstance(row, dict):
+            raise ValueError(f'{where} is not an object')
+        for field in ('mbid', 'title', 'artist'):
+            if not isinstance(row.get(field) or '', str):
+                raise ValueError(f'{where}: {field} must be a string')
+        row = {field: (row.get(field) or '').strip() or None for field in ('mbid', 'title', 'artist')}
+        if not row['mbid'] and not row['title']:
+            raise ValueError(f'{where} needs an mbid or a title')
+        cleaned.append(row)
+    return cleaned
+
+
+def create_import_job(user_id, rows):
+    """Save a new import job and its rows"""
+    job = ImportJob(user_id=user_id, total=len(rows))
+    db.session.add(job)
+    db.session.flush()
+    if rows:
+        db.session.execute(ImportItem.__table__.insert(), [
+            {'job_id': job.id, 'position': n, 'status': 'pending', **row} for n, row in enumerate(rows)
+        ])
+    db.session.commit()
+    return job
+
+
+def lucene_phrase(text):
+    """Quote text as a phrase in a MusicBrainz (Lucene) query, escaping characters the query syntax would read"""
+    return '"' + LUCENE_SPECIAL_RE.sub(r'\\\1', text) + '"'
+
+
+def _resolve(item):
+    """Stage 1: find the MBID of a title/artist row. A top hit that scores too low counts as no match"""
+    if item['mbid']:
+        return item['mbid']
+    term = f'recording:{lucene_phrase(item["title"])}'
+    if item['artist']:
+        term += f' AND artist:{lucene_phrase(item["artist"])}'
+    try:
+        results = search_musicbrainz('recording', term, 1)
+    except mb.WebServiceError:
+        return None
+    if not results or int(results[0].get('ext:score', 0)) < MIN_MATCH_SCORE:
+        return None
+    return results[0]['id']
+
+
+def _enrich(mbid):
+    """Stage 2: get recording data from MusicBrainz"""
+    try:
+        return get_recording_info(mbid)
+    except mb.WebServiceError:
+        return None
+
+
+def process_batch(job, items):
+    """Run one batch of items through resolve, enrich, Spotify match and write, then save progress"""
+    rows = [{'mbid': i.mbid, 'title': i.title, 'artist': i.artist} for i in items]
+    with ThreadPoolExecutor(max_workers=MUSICBRAINZ_WORKERS) as pool:
+        mbids = list(pool.map(_resolve, rows))
+
+    found = {mbid for mbid in mbids if mbid}
+    existing = {r.mbid for r in db.session.query(Recording.mbid).filter(Recording.mbid.in_(found))}
+
+    # Recordings that are already in the database don't go back to MusicBrainz or Spotify
+    new_mbids = sorted(found - existing)
+    with ThreadPoolExecutor(max_workers=MUSICBRAINZ_WORKERS) as pool:
+        infos = {mbid: info for mbid, info in zip(new_mbids, pool.map(_enrich, new_mbids)) if info}
+
+    spotify = get_spotify_info_batch(
+        [{'mbid': mbid, 'title': info['title'], 'artist': info['artist']} for mbid, info in infos.items()],
+        workers=SPOTIFY_WORKERS
+    )
+
+    if infos:
+        # Search results carry the whole track, so the card metadata comes without another request
+        db.session.execute(insert(Recording.__table__).on_conflict_do_nothing(index_elements=['mbid']), [{
+            'mbid': mbid,
+            'title': info['title'],
+            'artist': info['artist'],
+            'release': info['release'] or None,
+            'spotify_uri': get_spotify_track_id(spotify.get(mbid)),
+            **spotify_track_metadata(get_spotify_track(spotify.get(mbid)))
+        } for mbid, info in infos.items()])
+
+    recordings = {r.mbid: r for r in Recording.query.filter(Recording.mbid.in_(found))}
+    add_tags_to_recordings({recordings[mbid].id: info['tags'] for mbid, info in infos.items()})
+
+    in_library = {
+        recording_id for (recording_id,) in db.session.query(Library.recording_id).filter(
+            Library.user_id == job.user_id,
+            Library.recording_id.in_([r.id for r in recordings.values()])
+        )
+    }
+
+    new_links = set()
+    for item, mbid in zip(items, mbids):
+        recording = recordings.get(mbid)
+        if recording is None:
+            item.status = 'failed'
+            item.error = 'No MusicBrainz match' if mbid is None else 'MusicBrainz lookup failed'
+            job.failed += 1
+        elif recording.id in in_library or recording.id in new_links:
+            item.status = 'skipped'
+            job.skipped += 1
+        else:
+            item.status = 'done'
+            item.mbid = mbid
+            new_links.add(recording.id)
+            job.added += 1
+
+    if new_links:
+        db.session.execute(insert(Library.__table__).on_conflict_do_nothing(), [
+            {'user_id': job.user_id, 'recording_id': recording_id} for recording_id in new_links
+        ])
+        bump_versions(User, [job.user_id])
+    db.session.commit()
+
+
+def claim_import(job_id):
+    """Mark a job as running. Returns False if it's done or another worker is still running it.
+    The check and the update are one statement, so two workers can't both claim a job"""
+    now = datetime.utcnow()
+    claimed = ImportJob.query.filter(
+        ImportJob.id == job_id,
+        or_(
+            ImportJob.status.in_(('pending', 'failed')),
+            and_(ImportJob.status == 'running', ImportJob.updated_at < now - STALL_TIMEOUT)
+        )
+    ).update({'status': 'running', 'error': None, 'updated_at': now}, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def run_import(job_id):
+    """Claim a job and work through its pending items. A job that is done or already running is returned as it is"""
+    if not claim_import(job_id):
+        return ImportJob.query.get(job_id)
+    return _run_claimed_import(job_id)
+
+
+def _run_claimed_import(job_id):
+    """Work through a job's pending items batch by batch. Progress is committed after every batch,
+    so a job that stopped part way through picks up where it left off when run again"""
+    job = ImportJob.query.get(job_id)
+    try:
+        while True:
+            items = (ImportItem.query
+                .filter_by(job_id=job.id, status='pending')
+                .order_by(ImportItem.position)
+                .limit(BATCH_SIZE)
+                .all())
+            if not items:
+                break
+            process_batch(job, items)
+        job.status = 'done'
+    except Exception as e:
+        db.session.rollback()
+        job.status = 'failed'
+        job.error = str(e)
+    db.session.commit()
+    return job
+
+
+def start_import(app, job_id):
+    """Claim an import and run it on a background thread. Returns None, without starting anything,
+    if the job is done or another worker is still running it"""
+    if not claim_import(job_id):
+        return None
+
+    def run():
+        with app.app_context():
+            try:
+                _run_claimed_import(job_id)
+            finally:
+                db.session.remove()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
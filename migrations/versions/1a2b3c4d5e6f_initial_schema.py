@@ -0,0 +1,87 @@
+"""initial schema
+
+Revision ID: 1a2b3c4d5e6f
+Revises: 
+Create Date: 2021-08-20 12:00:00.000000
+
+Databases created with db.create_all() before migrations existed already have
+this schema: run `flask db stamp 1a2b3c4d5e6f` on them instead of upgrading.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a2b3c4d5e6f'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('username', sa.Text(), nullable=False),
+        sa.Column('password', sa.Text(), nullable=False),
+        sa.Column('email', sa.Text(), nullable=False),
+        sa.Column('role', sa.Text(), nullable=False),
+        sa.Column('img_url', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('username')
+    )
+    op.create_table('recordings',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('mbid', sa.String(), nullable=False),
+        sa.Column('title', sa.String(), nullable=False),
+        sa.Column('artist', sa.String(), nullable=False),
+        sa.Column('release', sa.String(), nullable=True),
+        sa.Column('spotify_uri', sa.String(), nullable=True),
+        sa.Column('comments', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('tags',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name')
+    )
+    op.create_table('playlists',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('libraries',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('recording_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['recording_id'], ['recordings.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'recording_id')
+    )
+    op.create_table('playlist_recordings',
+        sa.Column('playlist_id', sa.Integer(), nullable=False),
+        sa.Column('recording_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['playlist_id'], ['playlists.id'], ),
+        sa.ForeignKeyConstraint(['recording_id'], ['recordings.id'], ),
+        sa.PrimaryKeyConstraint('playlist_id', 'recording_id')
+    )
+    op.create_table('recording_tags',
+        sa.Column('recording_id', sa.Integer(), nullable=False),
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['recording_id'], ['recordings.id'], ),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ),
+        sa.PrimaryKeyConstraint('recording_id', 'tag_id')
+    )
+
+
+def downgrade():
+    op.drop_table('recording_tags')
+    op.drop_table('playlist_recordings')
+    op.drop_table('libraries')
+    op.drop_table('playlists')
+    op.drop_table('tags')
+    op.drop_table('recordings')
+    op.drop_table('users')
@@ -0,0 +1,98 @@
+"""merge duplicate recordings and make recordings.mbid unique
+
+Revision ID: 2b3c4d5e6f70
+Revises: 1a2b3c4d5e6f
+Create Date: 2026-10-18 09:00:00.000000
+
+Every add used to insert a new Recording row, so the same MBID can appear many
+times. The lowest id for each MBID is kept; library, playlist and tag links of
+the duplicates are moved onto it before the duplicates are deleted.
+
+Comments were written by the user who added each row, so they move onto that
+user's library row instead of being merged onto the shared recording.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b3c4d5e6f70'
+down_revision = '1a2b3c4d5e6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE TEMPORARY TABLE recording_merges AS
+        SELECT r.id AS old_id, keep.id AS keep_id
+        FROM recordings r
+        JOIN (SELECT mbid, MIN(id) AS id FROM recordings GROUP BY mbid HAVING COUNT(*) > 1) keep
+            ON keep.mbid = r.mbid
+        WHERE r.id <> keep.id
+    """)
+
+    op.add_column('libraries', sa.Column('comments', sa.Text(), nullable=True))
+    op.execute("""
+        UPDATE libraries l SET comments = r.comments
+        FROM recordings r
+        WHERE r.id = l.recording_id AND r.comments IS NOT NULL
+    """)
+
+    # A user who added the same song twice keeps the comments from both
+    op.execute("""
+        INSERT INTO libraries (user_id, recording_id, comments)
+        SELECT l.user_id, m.keep_id, STRING_AGG(DISTINCT l.comments, E'\\n\\n')
+        FROM libraries l JOIN recording_merges m ON m.old_id = l.recording_id
+        GROUP BY l.user_id, m.keep_id
+        ON CONFLICT (user_id, recording_id) DO UPDATE SET comments = CASE
+            WHEN excluded.comments IS NULL OR excluded.comments = libraries.comments THEN libraries.comments
+            WHEN libraries.comments IS NULL THEN excluded.comments
+            ELSE libraries.comments || E'\\n\\n' || excluded.comments
+        END
+    """)
+    op.execute("DELETE FROM libraries WHERE recording_id IN (SELECT old_id FROM recording_merges)")
+
+    for table, owner in (('playlist_recordings', 'playlist_id'), ('recording_tags', 'tag_id')):
+        op.execute(f"""
+            INSERT INTO {table} ({owner}, recording_id)
+            SELECT DISTINCT t.{owner}, m.keep_id
+            FROM {table} t JOIN recording_merges m ON m.old_id = t.recording_id
+            ON CONFLICT DO NOTHING
+        """)
+        op.execute(f"DELETE FROM {table} WHERE recording_id IN (SELECT old_id FROM recording_merges)")
+
+    # Keep the Spotify track if only a duplicate had one
+    op.execute("""
+        UPDATE recordings r
+        SET spotify_uri = COALESCE(r.spotify_uri, d.spotify_uri)
+        FROM (
+            SELECT m.keep_id, MIN(dup.spotify_uri) AS spotify_uri
+            FROM recording_merges m JOIN recordings dup ON dup.id = m.old_id
+            GROUP BY m.keep_id
+        ) d
+        WHERE r.id = d.keep_id
+    """)
+    op.execute("DELETE FROM recordings WHERE id IN (SELECT old_id FROM recording_merges)")
+    op.execute("DROP TABLE recording_merges")
+
+    # Shared rows no longer hold comments
+    op.drop_column('recordings', 'comments')
+
+    op.create_index(op.f('ix_recordings_mbid'), 'recordings', ['mbid'], unique=True)
+
+
+def downgrade():
+    # Merged rows can't be split apart again, only the constraint is removed
+    op.drop_index(op.f('ix_recordings_mbid'), table_name='recordings')
+    op.add_column('recordings', sa.Column('comments', sa.Text(), nullable=True))
+    op.execute("""
+        UPDATE recordings r SET comments = l.comments
+        FROM (
+            SELECT recording_id, STRING_AGG(comments, E'\\n\\n' ORDER BY user_id) AS comments
+            FROM libraries WHERE comments IS NOT NULL
+            GROUP BY recording_id
+        ) l
+        WHERE r.id = l.recording_id
+    """)
+    op.drop_column('libraries', 'comments')
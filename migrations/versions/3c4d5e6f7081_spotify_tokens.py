@@ -0,0 +1,31 @@
+"""store spotify tokens per user
+
+Revision ID: 3c4d5e6f7081
+Revises: 2b3c4d5e6f70
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c4d5e6f7081'
+down_revision = '2b3c4d5e6f70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('spotify_tokens',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('access_token', sa.Text(), nullable=False),
+        sa.Column('refresh_token', sa.Text(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('spotify_tokens')
@@ -0,0 +1,37 @@
+"""index reverse association lookups and playlists.user_id
+
+Revision ID: 5e6f70819203
+Revises: 4d5e6f708192
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e6f70819203'
+down_revision = '4d5e6f708192'
+branch_labels = None
+depends_on = None
+
+# The composite primary keys only serve lookups on their first column
+INDEXES = [
+    ('ix_libraries_recording_id', 'libraries', 'recording_id'),
+    ('ix_playlist_recordings_recording_id', 'playlist_recordings', 'recording_id'),
+    ('ix_recording_tags_tag_id', 'recording_tags', 'tag_id'),
+    ('ix_playlists_user_id', 'playlists', 'user_id'),
+]
+
+
+def upgrade():
+    # Built concurrently so the tables stay writable. CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.create_index(name, table, [column], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,41 @@
+"""add a full-text search vector to recordings
+
+Revision ID: 6f7081920314
+Revises: 5e6f70819203
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '6f7081920314'
+down_revision = '5e6f70819203'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('recordings', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    # Same weights as helpers.update_search_vectors
+    op.execute("""
+        UPDATE recordings SET search_vector =
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(artist, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(release, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce((
+                SELECT string_agg(tags.name, ' ')
+                FROM recording_tags JOIN tags ON tags.id = recording_tags.tag_id
+                WHERE recording_tags.recording_id = recordings.id
+            ), '')), 'B')
+    """)
+    with op.get_context().autocommit_block():
+        op.create_index('ix_recordings_search_vector', 'recordings', ['search_vector'], unique=False,
+            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_recordings_search_vector', table_name='recordings')
+    op.drop_column('recordings', 'search_vector')
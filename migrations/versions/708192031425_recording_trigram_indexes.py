@@ -0,0 +1,29 @@
+"""trigram indexes on recording titles and artists
+
+Revision ID: 708192031425
+Revises: 6f7081920314
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '708192031425'
+down_revision = '6f7081920314'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for column in ('title', 'artist'):
+            op.create_index(f'ix_recordings_{column}_trgm', 'recordings', [column], unique=False,
+                postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'}, postgresql_concurrently=True)
+
+
+def downgrade():
+    for column in ('title', 'artist'):
+        op.drop_index(f'ix_recordings_{column}_trgm', table_name='recordings')
@@ -0,0 +1,31 @@
+"""revision counters and change times on users, playlists, recordings and tags
+
+Revision ID: 8192031425a6
+Revises: 708192031425
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8192031425a6'
+down_revision = '708192031425'
+branch_labels = None
+depends_on = None
+
+TABLES = ('users', 'playlists', 'recordings', 'tags')
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('revision', sa.Integer(), server_default='1', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+            server_default=sa.text("timezone('utc', now())"), nullable=False))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'revision')
@@ -0,0 +1,30 @@
+"""spotify track metadata on recordings
+
+Revision ID: 92031425a6b7
+Revises: 8192031425a6
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '92031425a6b7'
+down_revision = '8192031425a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('recordings', sa.Column('spotify_image_url', sa.String(), nullable=True))
+    op.add_column('recordings', sa.Column('spotify_duration_ms', sa.Integer(), nullable=True))
+    op.add_column('recordings', sa.Column('spotify_preview_url', sa.String(), nullable=True))
+    op.add_column('recordings', sa.Column('spotify_fetched_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('recordings', 'spotify_fetched_at')
+    op.drop_column('recordings', 'spotify_preview_url')
+    op.drop_column('recordings', 'spotify_duration_ms')
+    op.drop_column('recordings', 'spotify_image_url')
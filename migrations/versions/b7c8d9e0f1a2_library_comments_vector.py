@@ -0,0 +1,31 @@
+"""add an indexed search vector of comments to libraries
+
+Revision ID: b7c8d9e0f1a2
+Revises: 92031425a6b7
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c8d9e0f1a2'
+down_revision = '92031425a6b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Same expression as models.Library.comments_vector
+    op.add_column('libraries', sa.Column('comments_vector', postgresql.TSVECTOR(),
+        sa.Computed("setweight(to_tsvector('english', coalesce(comments, '')), 'C')", persisted=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_libraries_comments_vector', 'libraries', ['comments_vector'], unique=False,
+            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_libraries_comments_vector', table_name='libraries')
+    op.drop_column('libraries', 'comments_vector')
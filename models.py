@@ -1,8 +1,13 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from flask_migrate import Migrate
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
+migrate = Migrate()
 
 DEFAULT_IMG_URL = 'https://www.seaside3ny.com/wp/wp-content/uploads/seaside3ny.com/2015/09/Camera-Shy.png'
 
@@ -11,8 +16,22 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    migrate.init_app(app, db)
 
-class User(db.Model):
+class Versioned:
+    """Revision counter and time of the last change. helpers.bump_versions bumps them whenever anything shown with
+    the row changes, including its association rows, and cached fragments and ETags are built from them"""
+
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text("timezone('utc', now())"))
+
+    @property
+    def version(self):
+        """Changes with every bump. The time keeps it from repeating when the tables are recreated and ids start over"""
+        return f'{self.revision}-{self.updated_at:%Y%m%d%H%M%S%f}'
+
+
+class User(Versioned, db.Model):
     """User model"""
 
     __tablename__ = 'users'
@@ -26,6 +45,7 @@ class User(db.Model):
 
     library = db.relationship('Recording', secondary='libraries', backref='user')
     playlists = db.relationship('Playlist')
+    spotify_token = db.relationship('SpotifyToken', uselist=False, cascade='all, delete-orphan')
 
     @classmethod
     def register(cls, username, password, email, role, img_url):
@@ -49,7 +69,7 @@ class User(db.Model):
         return False
 
 
-class Playlist(db.Model):
+class Playlist(Versioned, db.Model):
     """Playlist model"""
 
     __tablename__ = 'playlists'
@@ -57,28 +77,57 @@ class Playlist(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
     description = db.Column(db.Text)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     recordings = db.relationship('Recording', secondary='playlist_recordings', backref='playlists')
 
 
-class Recording(db.Model):
+class Recording(Versioned, db.Model):
     """Recording model"""
 
     __tablename__ = 'recordings'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    mbid = db.Column(db.String, nullable=False)
+    mbid = db.Column(db.String, nullable=False, unique=True, index=True)
     title = db.Column(db.String, nullable=False)
     artist = db.Column(db.String, nullable=False)
     release = db.Column(db.String)
     spotify_uri = db.Column(db.String)
-    comments = db.Column(db.Text)
+    # Spotify track metadata for the static cards on listing pages, kept by helpers.update_spotify_tracks.
+    # spotify_fetched_at is set once a lookup has been made, even if Spotify had no art or preview for the track
+    spotify_image_url = db.Column(db.String)
+    spotify_duration_ms = db.Column(db.Integer)
+    spotify_preview_url = db.Column(db.String)
+    spotify_fetched_at = db.Column(db.DateTime)
+    # Comments belong to each user's Library row. Queries that join a library load them here with
+    # with_expression(Recording.comments, Library.comments), otherwise it's None
+    comments = db.query_expression()
+    # Title, artist, release and tag names for library search. Kept current by helpers.update_search_vectors
+    search_vector = db.deferred(db.Column(TSVECTOR))
 
     tags = db.relationship('Tag', secondary='recording_tags', backref='recordings')
 
+    @property
+    def spotify_duration(self):
+        """Track length as m:ss, or None when it isn't known"""
+        if self.spotify_duration_ms is None:
+            return None
+        minutes, seconds = divmod(round(self.spotify_duration_ms / 1000), 60)
+        return f'{minutes}:{seconds:02d}'
+
+    __table_args__ = (
+        db.Index('ix_recordings_search_vector', 'search_vector', postgresql_using='gin'),
+        # Trigram indexes for typo-tolerant catalog search
+        db.Index('ix_recordings_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+        db.Index('ix_recordings_artist_trgm', 'artist', postgresql_using='gin', postgresql_ops={'artist': 'gin_trgm_ops'}),
+    )
 
-class Tag(db.Model):
+
+# The trigram indexes need pg_trgm, so db.create_all installs it first
+event.listen(db.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+
+class Tag(Versioned, db.Model):
     """Tag model"""
 
     __tablename__ = 'tags'
@@ -87,6 +136,63 @@ class Tag(db.Model):
     name = db.Column(db.Text, nullable=False, unique=True)
 
 
+class SpotifyToken(db.Model):
+    """A user's Spotify OAuth tokens. expires_at is an absolute UTC time so tokens can be refreshed before they run out"""
+
+    __tablename__ = 'spotify_tokens'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    access_token = db.Column(db.Text, nullable=False)
+    refresh_token = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class ImportJob(db.Model):
+    """A bulk library import and its progress"""
+
+    __tablename__ = 'import_jobs'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    status = db.Column(db.Text, nullable=False, default='pending')
+    total = db.Column(db.Integer, nullable=False, default=0)
+    added = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        """Progress report for the import status endpoint"""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.added + self.skipped + self.failed,
+            'added': self.added,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
+
+class ImportItem(db.Model):
+    """One row of a bulk import: an MBID, or a title and artist to look up"""
+
+    __tablename__ = 'import_items'
+
+    job_id = db.Column(db.Integer, db.ForeignKey('import_jobs.id', ondelete='CASCADE'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    mbid = db.Column(db.String)
+    title = db.Column(db.String)
+    artist = db.Column(db.String)
+    status = db.Column(db.Text, nullable=False, default='pending')
+    error = db.Column(db.Text)
+
+
 # Relationship models
 
 class Library(db.Model):
@@ -95,7 +201,16 @@ class Library(db.Model):
     __tablename__ = 'libraries'
     
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    recording_id = db.Column(db.Integer, db.ForeignKey('recordings.id'), primary_key=True)
+    # The primary key only covers lookups by user, so recording -> users needs its own index
+    recording_id = db.Column(db.Integer, db.ForeignKey('recordings.id'), primary_key=True, index=True)
+    # The user's own notes on the song. Recordings are shared, so they can't go on the recording
+    comments = db.Column(db.Text)
+    # Comments for library search, weighted below everything in recordings.search_vector. Postgres keeps it current
+    comments_vector = db.deferred(db.Column(TSVECTOR, db.Computed("setweight(to_tsvector('english', coalesce(comments, '')), 'C')", persisted=True)))
+
+    __table_args__ = (
+        db.Index('ix_libraries_comments_vector', 'comments_vector', postgresql_using='gin'),
+    )
 
 class PlaylistRecording(db.Model):
     """Playlist-Recording relationship"""
@@ -103,7 +218,7 @@ class PlaylistRecording(db.Model):
     __tablename__ = 'playlist_recordings'
 
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id'), primary_key=True)
-    recording_id = db.Column(db.Integer, db.ForeignKey('recordings.id'), primary_key=True)
+    recording_id = db.Column(db.Integer, db.ForeignKey('recordings.id'), primary_key=True, index=True)
 
 class RecordingTag(db.Model):
     """Recording-Tag relationship"""
@@ -111,4 +226,4 @@ class RecordingTag(db.Model):
     __tablename__ = 'recording_tags'
 
     recording_id = db.Column(db.Integer, db.ForeignKey('recordings.id'), primary_key=True)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
\ No newline at end of file
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True, index=True)
\ No newline at end of file
@@ -0,0 +1,88 @@
+from flask import request, url_for
+from sqlalchemy import Float, and_, cast, or_
+
+# Rows per page when the request doesn't ask for a size, and the most it may ask for
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class Page:
+    """One page of a keyset-paginated listing"""
+
+    def __init__(self, items, after, next_after, limit):
+        self.items = items
+        self.after = after
+        self.next_after = next_after
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def next_url(self):
+        """Link to the following page, or None on the last page"""
+        if self.next_after is None:
+            return None
+        return self._url(after=self.next_after)
+
+    @property
+    def first_url(self):
+        return self._url()
+
+    def _url(self, **cursor):
+        """This page's URL with other query string arguments, like a search term, kept. Arguments that would clash
+        with url_for's own parameters or the view's arguments are dropped"""
+        args = {
+            k: v for k, v in request.args.items()
+            if k not in ('after', 'limit', 'endpoint') and k not in request.view_args and not k.startswith('_')
+        }
+        return url_for(request.endpoint, **request.view_args, **args, **cursor, limit=self.limit)
+
+
+def get_page_args(cursor_type=int):
+    """Read the after cursor and page size from the query string, keeping the size within limits"""
+    after = request.args.get('after', type=cursor_type)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate(query, key, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Get the rows after the cursor, ordered by a unique key column. Filtering on the key
+    instead of using OFFSET means a deep page costs the same as the first one"""
+    if after is not None:
+        query = query.filter(key > after)
+    rows = query.order_by(key).limit(limit + 1).all()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], key.key)
+    return Page(rows, after, next_after, limit)
+
+
+def rank_cursor(value):
+    """Parse a paginate_ranked cursor: the last row's rank and id"""
+    rank, key = value.split('_')
+    return float(rank), int(key)
+
+
+def paginate_ranked(query, rank, key, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Keyset pagination for results ordered by a computed rank, best first. Ties are broken by
+    the key column so the order is stable. The cursor carries both, see rank_cursor"""
+    # Ranks like ts_rank's are single precision, which doesn't survive the trip through the cursor exactly
+    rank = cast(rank, Float(precision=53))
+    if after is not None:
+        last_rank, last_key = after
+        query = query.filter(or_(rank < last_rank, and_(rank == last_rank, key > last_key)))
+    rows = query.add_columns(rank).order_by(rank.desc(), key).limit(limit + 1).all()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        item, last_rank = rows[-1]
+        next_after = f'{last_rank!r}_{getattr(item, key.key)}'
+    after = f'{after[0]!r}_{after[1]}' if after is not None else None
+    return Page([item for item, _ in rows], after, next_after, limit)
@@ -0,0 +1,154 @@
+import re, threading, time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import with_parent
+
+# Most statements a request may run before it gets logged. Views can set their own with @query_budget
+DEFAULT_QUERY_BUDGET = 25
+
+# The same statement shape this many times in one request is most likely an N+1
+REPEAT_THRESHOLD = 5
+
+# Lists of bind parameters, e.g. from IN clauses, are collapsed so their length doesn't change the shape
+PARAM_LIST_RE = re.compile(r'\((?:\?|%\(\w+\)s|%s)(?:\s*,\s*(?:\?|%\(\w+\)s|%s))*\)')
+
+_local = threading.local()
+
+
+def statement_shape(statement):
+    """Normalize a SQL statement so repeats of the same query compare equal"""
+    return PARAM_LIST_RE.sub('(...)', ' '.join(statement.split()))
+
+
+class QueryLog:
+    """Statements run while the log is active, with their total time"""
+
+    def __init__(self):
+        self.statements = []
+        self.seconds = 0.0
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def record(self, statement, seconds):
+        self.statements.append(statement)
+        self.seconds += seconds
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """Statement shapes that ran at least threshold times"""
+        shapes = Counter(statement_shape(s) for s in self.statements)
+        return {shape: n for shape, n in shapes.items() if n >= threshold}
+
+
+def _active_logs():
+    if not hasattr(_local, 'logs'):
+        _local.logs = []
+    return _local.logs
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    for log in _active_logs():
+        log.record(statement, seconds)
+
+
+@contextmanager
+def capture_queries():
+    """Collect every statement this thread runs inside the block. Used per request and by the tests"""
+    log = QueryLog()
+    _active_logs().append(log)
+    try:
+        yield log
+    finally:
+        _active_logs().remove(log)
+
+
+def query_budget(limit):
+    """Decorator setting the most statements a view is expected to run"""
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+
+def init_query_stats(app):
+    """Count statements and database time for every request, logging requests over budget and likely N+1s"""
+    app.config.setdefault('SQL_QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+
+    @app.before_request
+    def start_query_log():
+        g.query_log = QueryLog()
+        _active_logs().append(g.query_log)
+
+    @app.after_request
+    def report_queries(response):
+        log = g.get('query_log')
+        if log is None:
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', app.config['SQL_QUERY_BUDGET'])
+        if log.count > budget:
+            app.logger.warning('%s %s ran %d queries in %.1fms (budget %d)',
+                request.method, request.path, log.count, log.seconds * 1000, budget)
+        for shape, n in log.repeated().items():
+            app.logger.warning('Possible N+1 in %s %s: %d x %s', request.method, request.path, n, shape[:200])
+
+        response.headers['Server-Timing'] = f'db;dur={log.seconds * 1000:.1f};desc="{log.count} queries"'
+        return response
+
+    @app.teardown_request
+    def stop_query_log(exc):
+        log = g.pop('query_log', None)
+        if log in _active_logs():
+            _active_logs().remove(log)
+
+
+###########
+# Index checks
+###########
+
+def relationship_load_queries(db):
+    """The lazy load query of every relationship on the models, as (name, query) pairs"""
+    queries = []
+    for mapper in db.Model.registry.mappers:
+        for prop in mapper.relationships:
+            parent = mapper.class_()
+            for column in mapper.primary_key:
+                setattr(parent, mapper.get_property_by_column(column).key, 1)
+            query = db.session.query(prop.mapper.class_).filter(with_parent(parent, getattr(mapper.class_, prop.key)))
+            queries.append((f'{mapper.class_.__name__}.{prop.key}', query))
+    return sorted(queries, key=lambda q: q[0])
+
+
+def explain(db, query):
+    """The database's plan for a query, one line per row"""
+    conn = db.session.connection()
+    sql = str(query.statement.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'postgresql':
+        return [row[0] for row in conn.exec_driver_sql(f'EXPLAIN {sql}')]
+    return [row[-1] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+
+
+def _is_full_scan(line):
+    return 'Seq Scan' in line or line.startswith('SCAN ')
+
+
+def unindexed_relationship_loads(db):
+    """Relationships whose lazy load reads a whole table. Returns a dict of name -> plan"""
+    if db.session.connection().dialect.name == 'postgresql':
+        # Small tables are cheaper to scan, so make the planner use an index whenever it has one
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+    plans = {name: explain(db, query) for name, query in relationship_load_queries(db)}
+    return {name: plan for name, plan in plans.items() if any(_is_full_scan(line) for line in plan)}
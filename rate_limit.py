@@ -0,0 +1,70 @@
+import fcntl, os, threading, time
+
+from cache import CACHE_DIR
+
+
+class RateGovernor:
+    """Token bucket shared by every worker on the host.
+
+    The bucket's state lives in a small file that is locked while it is read and
+    updated, so gunicorn workers draw from one budget instead of each applying
+    the upstream's limit on its own."""
+
+    def __init__(self, name, rate, capacity=1, directory=CACHE_DIR):
+        self.rate = rate
+        self.capacity = capacity
+        self.path = os.path.join(directory, f'ratelimit-{name}')
+        os.makedirs(directory, exist_ok=True)
+
+        self.acquired = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if there is one. Returns 0, or how many seconds until one is available"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                try:
+                    tokens, updated = (float(n) for n in f.read().split())
+                except ValueError:
+                    tokens, updated = self.capacity, now
+
+                tokens = min(self.capacity, tokens + max(now - updated, 0) * self.rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+
+                f.seek(0)
+                f.truncate()
+                f.write(f'{tokens} {now}')
+                f.flush()
+                return wait
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Block until the shared budget allows another request"""
+        while True:
+            wait = self._take()
+            if not wait:
+                with self._lock:
+                    self.acquired += 1
+                return
+            with self._lock:
+                self.waits += 1
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'waited_seconds': self.waited_seconds
+        }
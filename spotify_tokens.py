@@ -0,0 +1,192 @@
+import os, threading, time
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy.orm import Session
+
+import http_client
+from cache import FileCache, CACHE_DIR, file_lock
+from models import db, SpotifyToken
+from _startup import CLIENT_ID, CLIENT_SECRET
+
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token/'
+
+# Tokens are refreshed this long before Spotify would reject them
+REFRESH_MARGIN = timedelta(minutes=5)
+
+# How long the background refresher waits after a failed app token request
+APP_TOKEN_RETRY_SECONDS = 30
+
+APP_TOKEN_KEY = 'client-credentials'
+APP_TOKEN_DIR = os.path.join(CACHE_DIR, 'spotify-app-token')
+
+_user_locks = {}
+_locks_lock = threading.Lock()
+
+# This worker's copy of the app token: (access_token, expires_at as a unix time)
+_app_token = (None, 0)
+_app_token_lock = threading.Lock()
+_app_token_store = None
+_refresher = None
+
+
+def get_refresh_token(refresh_token):
+    """Get a new access token with a refresh token. Returns Spotify's token response"""
+    data = {
+        "grant_type" : "refresh_token",
+        "refresh_token" : refresh_token,
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET
+    }
+
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    resp = http_client.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+    return resp.json()
+
+
+def _lock_for(user_id):
+    with _locks_lock:
+        return _user_locks.setdefault(user_id, threading.Lock())
+
+
+def _expires_at(expires_in):
+    return datetime.utcnow() + timedelta(seconds=int(expires_in))
+
+
+def save_token(user_id, access_token, refresh_token, expires_in):
+    """Store the tokens from a completed Spotify authorization for a user"""
+    token = SpotifyToken.query.get(user_id) or SpotifyToken(user_id=user_id)
+    token.access_token = access_token
+    token.refresh_token = refresh_token
+    token.expires_at = _expires_at(expires_in)
+    db.session.add(token)
+    db.session.commit()
+
+
+def get_access_token(user_id, force_refresh=False):
+    """Return a usable access token for the user, or None if they haven't connected Spotify or it can't be refreshed right now.
+    Tokens close to expiry are refreshed first. Concurrent refreshes for one user are collapsed
+    into a single call: a thread lock covers this worker and a row lock covers the others."""
+    token = SpotifyToken.query.get(user_id)
+    if token is None:
+        return None
+    if not force_refresh and token.expires_at - REFRESH_MARGIN > datetime.utcnow():
+        return token.access_token
+
+    with _lock_for(user_id):
+        access_token = _refresh_access_token(user_id, token.access_token, force_refresh)
+    # The caller's session still has the old row
+    db.session.expire(token)
+    return access_token
+
+
+def _refresh_access_token(user_id, stale_access_token, force_refresh):
+    """Refresh the user's token unless someone else already has. This runs in its own session, so the new token
+    is saved straight away and the caller's pending work is neither committed nor rolled back with it"""
+    with Session(db.engine) as session, session.begin():
+        token = session.query(SpotifyToken).filter_by(user_id=user_id).with_for_update().one_or_none()
+        if token is None:
+            return None
+
+        # Whoever held the lock before us may already have refreshed it
+        already_refreshed = token.access_token != stale_access_token
+        if already_refreshed or (not force_refresh and token.expires_at - REFRESH_MARGIN > datetime.utcnow()):
+            return token.access_token
+
+        try:
+            data = get_refresh_token(token.refresh_token)
+        except (requests.RequestException, ValueError):
+            # Spotify is down or sent something that isn't JSON. The token is kept for the next try
+            return None
+
+        if 'access_token' not in data:
+            if data.get('error') == 'invalid_grant':
+                # The refresh token was revoked, the user has to connect Spotify again
+                session.delete(token)
+            # Anything else (rate limits, server errors) is temporary, so the token is kept
+            return None
+
+        token.access_token = data['access_token']
+        token.refresh_token = data.get('refresh_token', token.refresh_token)
+        token.expires_at = _expires_at(data['expires_in'])
+        return token.access_token
+
+
+###########
+# App token (client credentials)
+###########
+
+# Catalog search doesn't need user scopes, so it runs on one client-credentials token that every
+# worker on the host shares through the file tier. Only one worker requests a new token at a time.
+
+def _is_fresh(expires_at):
+    return expires_at - REFRESH_MARGIN.total_seconds() > time.time()
+
+
+def _shared_app_token_store():
+    global _app_token_store
+    if _app_token_store is None:
+        _app_token_store = FileCache(APP_TOKEN_DIR)
+    return _app_token_store
+
+
+def fetch_app_token():
+    """Request a client-credentials token from Spotify. Returns (access_token, expires_at) or None"""
+    data = {"grant_type": "client_credentials"}
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    resp = http_client.post(SPOTIFY_TOKEN_URL, data=data, headers=headers, auth=(CLIENT_ID, CLIENT_SECRET))
+    json = resp.json()
+    if 'access_token' not in json:
+        return None
+    return json['access_token'], time.time() + int(json['expires_in'])
+
+
+def refresh_app_token(force=False):
+    """Replace this worker's app token, fetching a new one only if no other worker already has"""
+    global _app_token
+    store = _shared_app_token_store()
+    with _app_token_lock, file_lock(os.path.join(APP_TOKEN_DIR, 'lock')):
+        shared = store.get(APP_TOKEN_KEY)
+        # On a forced refresh, a different token from another worker counts as already refreshed
+        if shared and _is_fresh(shared[1]) and (not force or shared[0] != _app_token[0]):
+            _app_token = shared
+            return _app_token
+
+        token = fetch_app_token()
+        if token:
+            store.set(APP_TOKEN_KEY, *token)
+            _app_token = token
+        return token
+
+
+def _refresh_app_token_forever():
+    while True:
+        wait = _app_token[1] - REFRESH_MARGIN.total_seconds() - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            token = refresh_app_token()
+        except Exception:
+            token = None
+        if token is None:
+            time.sleep(APP_TOKEN_RETRY_SECONDS)
+
+
+def start_app_token_refresher():
+    """Start the background thread that renews the app token before it expires"""
+    global _refresher
+    with _locks_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_app_token_forever, daemon=True)
+            _refresher.start()
+
+
+def get_app_token(force_refresh=False):
+    """Return the shared client-credentials token, or None if Spotify won't issue one"""
+    start_app_token_refresher()
+    if not force_refresh and _is_fresh(_app_token[1]):
+        return _app_token[0]
+    token = refresh_app_token(force=force_refresh)
+    return token[0] if token else None
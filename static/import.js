@@ -0,0 +1,32 @@
+const $importForm = $('#importForm')
+const $importStatus = $('#importStatus')
+
+// How often to ask the server how far an import has got
+const POLL_MS = 2000
+
+async function startImport(evt) {
+    evt.preventDefault()
+    $importStatus.empty()
+    try {
+        const resp = await axios.post($importForm.attr('action') || window.location.pathname, new FormData($importForm[0]))
+        pollImport(resp.headers['location'])
+    } catch (err) {
+        // Proxies and crashes answer without our JSON errors, so anything else is a generic message
+        const data = err.response && err.response.data
+        const errors = data && data['errors'] ? Object.values(data['errors']).flat() : ['Something went wrong']
+        $importStatus.append($('<div>', {class: 'alert alert-danger'}).append(errors.map(error => $('<div>').text(error))))
+    }
+}
+
+async function pollImport(url) {
+    const resp = await axios.get(url)
+    const job = resp.data['job']
+    $importStatus.empty().append($('<p>').text(`Import ${job.status}: ${job.processed} of ${job.total} processed
+        (${job.added} added, ${job.skipped} already in your library, ${job.failed} not found)`))
+
+    if (job.status == 'pending' || job.status == 'running') {
+        setTimeout(() => pollImport(url), POLL_MS)
+    }
+}
+
+$importForm.on('submit', startImport)
@@ -0,0 +1,45 @@
+// Cards only become Spotify players when asked to, so a page of songs doesn't load an embed for every one
+const EMBED_URL = 'https://open.spotify.com/embed/track/'
+
+let $previewBtn = null
+let preview = null
+
+function playTrack(evt) {
+    const $card = $(evt.target).closest('.spotify-card')
+    stopPreview()
+    const $player = $('<iframe>', {
+        src: EMBED_URL + encodeURIComponent($card.attr('data-spotify-uri')),
+        width: '100%',
+        height: 80,
+        frameBorder: 0,
+        allowtransparency: true,
+        allow: 'encrypted-media; autoplay'
+    })
+    $card.empty().append($player)
+}
+
+// 30 second previews play in the page without an embed. One plays at a time
+function togglePreview(evt) {
+    const $btn = $(evt.target)
+    const wasPlaying = $btn.is($previewBtn)
+    stopPreview()
+    if (wasPlaying) {
+        return
+    }
+    preview = new Audio($btn.attr('data-preview-url'))
+    preview.addEventListener('ended', stopPreview)
+    preview.play()
+    $previewBtn = $btn.text('Stop')
+}
+
+function stopPreview() {
+    if (preview) {
+        preview.pause()
+        $previewBtn.text('Preview')
+    }
+    preview = null
+    $previewBtn = null
+}
+
+$(document).on('click', '.spotify-play', playTrack)
+$(document).on('click', '.spotify-preview', togglePreview)
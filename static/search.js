@@ -2,24 +2,57 @@ const $searchWrapper = $('#searchWrapper');
 const $searchType = $('#searchType');
 const $searchBar = $('#searchBar');
 const $searchResults = $('#searchResults');
+const $localResults = $('#localResults');
 
 const $limit = $('#limit')
 const $searchBtn = $('#searchBtn')
+const $remoteBtn = $('#remoteBtn')
 
 const $displaySearch = $('.display-search');
 
 const $addSong = $('.add-song')
 
-const $hasToken = $('#hasToken')
-
 // use this verson of SEARCH_URL when working locally
 // const SEARCH_URL = 'http://localhost:5000/search/api'
 // use this verson of SEARCH_URL when deploying
 const SEARCH_URL = 'https://musophile.herokuapp.com/search/api'
 
-const MUSICBRAINZ_API_URL = 'https://musicbrainz.org/ws/2';
-// The MusicBrainz API returns XML by default. Put this in to return JSON:
-const JSON_FMT = 'fmt=json';
+// use this verson of MB_SEARCH_URL when working locally
+// const MB_SEARCH_URL = 'http://localhost:5000/search/mb'
+// use this verson of MB_SEARCH_URL when deploying
+const MB_SEARCH_URL = 'https://musophile.herokuapp.com/search/mb'
+
+// use this verson of LOCAL_SEARCH_URL when working locally
+// const LOCAL_SEARCH_URL = 'http://localhost:5000/search/local'
+// use this verson of LOCAL_SEARCH_URL when deploying
+const LOCAL_SEARCH_URL = 'https://musophile.herokuapp.com/search/local'
+
+// Songs already on Musophile come first since they cost nothing to look up.
+// MusicBrainz is only searched when the user asks for more
+async function displayLocalResults() {
+    $localResults.empty()
+    $searchResults.empty()
+    $remoteBtn.prop('hidden', false)
+    const attr = $searchType.val();
+    const term = $searchBar.val();
+    const limit = $limit.val()
+    if (attr !== 'recording' && attr !== 'artist') {
+        $localResults.append('<p>Musophile can only be searched by recording or artist</p>')
+        return
+    }
+    const resp = await axios.get(LOCAL_SEARCH_URL, {params: {type: attr, q: term, limit}})
+    const recordings = resp.data['recordings']
+    if (!recordings.length) {
+        $localResults.append('<p>No songs on Musophile match yet</p>')
+        return
+    }
+    $localResults.append(recordings.map(generateLocalResult))
+}
+
+function generateLocalResult(recording) {
+    const tags = recording['tags'].length ? recording['tags'].join(', ') : 'N/A'
+    return generateResult(recording['mbid'], recording['title'], recording['artist'], recording['release'], tags, recording['spotify_uri'])
+}
 
 async function displayResults() {
     console.dir('displayResults')
@@ -28,84 +61,73 @@ async function displayResults() {
     const term = $searchBar.val();
     const limit = $limit.val()
     const results = await getResults(attr, term, limit);
+    const tracks = await getSpotifyTracks(results)
 
-    for (let result of results) {
-        const html = await generateResponseHTML(result)
-        console.log(html)
-        $searchResults.append(html)
-    }
+    $searchResults.append(results.map(result => generateResponseResult(result, tracks[result['id']])))
 }
 
+// MusicBrainz is searched through our server, which caches results and keeps all users under MusicBrainz's rate limit
 async function getResults(attr, term, limit) {
     console.dir('getResults')
-    let resp;
-    if (attr == 'recording'){
-        resp = await axios.get(`${MUSICBRAINZ_API_URL}/${attr}/?query=${term}&limit=${limit}&${JSON_FMT}`)
-    } else {
-        resp = await axios.get(`${MUSICBRAINZ_API_URL}/recording/?query=${attr}:${term}&limit=${limit}&${JSON_FMT}`)
-    }
+    const resp = await axios.get(MB_SEARCH_URL, {params: {type: attr, q: term, limit}})
     console.log(resp.data['recordings'])
     return resp.data['recordings']
 }
 
-async function generateResponseHTML(result) {
-    console.dir('generateResponseHTML')
-    const id = result["id"]
-    const title = result['title']
-    const artist = result['artist-credit'][0]['name']
-    const release = result['releases'] ? result['releases'][0]['title'] : '<b>N/A</b>'
-    const tags = result['tags'] ? result['tags'].map(tag => tag['name']) : 'N/A'
-
-    let html = `<div class="search-result">
-    <div class='result-info'>
-        <ul>
-            <li>Title: ${title}</li>
-            <li>Artist: ${artist}</li>
-            <li>Release: ${release}</li>
-            <li>Tags: ${tags}</li>
-        </ul>
-    </div>`
-
-    const spotify_player = await getSpotifyURIAndHTML(title, artist, id)
-    html += spotify_player
-
-    return html;
+// Looks up every result on Spotify in one request. Returns an object of MusicBrainz id -> Spotify track id (or null)
+async function getSpotifyTracks(results) {
+    const items = results.map(result => ({
+        mbid: result['id'],
+        title: result['title'],
+        artist: result['artist-credit'][0]['name']
+    }))
+    const resp = await axios.post(`${SEARCH_URL}/batch`, {items})
+    return resp.data['tracks'] || {}
 }
 
-async function getSpotifyURIAndHTML(title, artist, id) {
-    console.dir('getSpotifyURIAndHTML')
-    resp = await axios.get(`${SEARCH_URL}/${title}/${artist}`)
+function generateResponseResult(result, uri) {
+    const release = result['releases'] ? result['releases'][0]['title'] : null
+    const tags = result['tags'] ? result['tags'].map(tag => tag['name']).join(', ') : 'N/A'
+    return generateResult(result['id'], result['title'], result['artist-credit'][0]['name'], release, tags, uri)
+}
 
-    if (resp.data['reauth']) {
-        resp = await axios.get(`${SEARCH_URL}/${title}/${artist}`)
-    }
-    
-    if (resp.data['tracks']['items'].length > 0){
-        uri = resp.data['tracks']['items'][0]['uri'].slice(14)
-        return `<div class="player">
-        <iframe src="https://open.spotify.com/embed/track/${uri}" width="100%" height="80" frameBorder="0" allowtransparency="true" allow="encrypted-media"></iframe>
-            </div>
-            <aside class="search-result-options">
-                <form action="/user/add-recording/${id}/${uri}" method="POST">
-                    <button class='add-song btn btn-sm btn-outline-dark'>Add to library</button>
-                </form>
-            </aside>
-        </div>`
-    } else {
-        return `<div class="player">
-        <strong>This song wasn't found on Spotify</strong>
-    </div>
-    <aside class="search-result-options">
-                <form action="/user/add-recording/${id}/0" method="POST">
-                    <button class='add-song btn btn-sm btn-outline-dark'>Add to library</button>
-                </form>
-            </aside>
-        </div>`
+// Titles and tags come from users and MusicBrainz, so they're only ever set with .text(), never parsed as HTML
+function generateResult(id, title, artist, release, tags, uri) {
+    const $info = $('<ul>').append(
+        $('<li>').text(`Title: ${title}`),
+        $('<li>').text(`Artist: ${artist}`),
+        $('<li>').text('Release: ').append(release ? document.createTextNode(release) : $('<b>').text('N/A')),
+        $('<li>').text(`Tags: ${tags}`)
+    )
+    return $('<div>', {class: 'search-result'}).append(
+        $('<div>', {class: 'result-info'}).append($info),
+        generatePlayer(uri),
+        generateAddForm(id, uri)
+    )
+}
+
+function generatePlayer(uri) {
+    const $player = $('<div>', {class: 'player'})
+    if (!uri) {
+        return $player.append($('<strong>').text("This song wasn't found on Spotify"))
     }
+    return $player.append($('<iframe>', {
+        src: `https://open.spotify.com/embed/track/${encodeURIComponent(uri)}`,
+        width: '100%',
+        height: 80,
+        frameBorder: 0,
+        allowtransparency: true,
+        allow: 'encrypted-media'
+    }))
 }
 
-if ($hasToken.hasClass('has-token')) {
-    $searchBtn.removeAttr('disabled')
+function generateAddForm(id, uri) {
+    const $form = $('<form>', {
+        action: `/user/add-recording/${encodeURIComponent(id)}/${encodeURIComponent(uri || 0)}`,
+        method: 'POST'
+    }).append($('<button>', {class: 'add-song btn btn-sm btn-outline-dark'}).text('Add to library'))
+    return $('<aside>', {class: 'search-result-options'}).append($form)
 }
 
-$searchBtn.click(displayResults)
\ No newline at end of file
+$searchBtn.click(displayLocalResults)
+$remoteBtn.click(displayResults)
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""JSON API tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_api.py
+
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY
+from cache import FileCache
+from helpers import playlist_tags_cache
+from models import db, User, Recording, Playlist, Tag
+from query_stats import capture_queries
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Test the read-only JSON API"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Playlist ids start over with every test, so each one gets an empty tag count cache
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.tags_cache = patch.object(playlist_tags_cache, 'shared', FileCache(self.cache_dir.name))
+        self.tags_cache.start()
+
+        u = User.register('Spongebob', 'password', 'sponge@bikini-bottom.com', 'Music Fan', None)
+        other = User.register('Squidward', 'password', 'squid@bikini-bottom.com', 'Musician', None)
+        db.session.add_all([u, other])
+        db.session.commit()
+        p = Playlist(name='Jelly Jamz', description='I like jellyfishing!', user_id=u.id)
+        other_p = Playlist(name='Clarinet Classics', user_id=other.id)
+        db.session.add_all([p, other_p])
+        db.session.commit()
+
+        self.user_id = u.id
+        self.other_id = other.id
+        self.playlist_id = p.id
+        self.other_playlist_id = other_p.id
+        self.add_songs(1, 'few')
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        self.tags_cache.stop()
+        self.cache_dir.cleanup()
+        return res
+
+    def add_songs(self, n, prefix):
+        """Add n recordings, each with two tags, to the user's library and both playlists"""
+        u = User.query.get(self.user_id)
+        tag = Tag.query.filter_by(name='nautical').first() or Tag(name='nautical')
+        for i in range(n):
+            r = Recording(mbid=f'{prefix}-{i}', title=f'{prefix} {i}', artist='Spongebob Squarepants')
+            r.tags = [tag, Tag(name=f'{prefix}-tag-{i}')]
+            r.playlists = [Playlist.query.get(self.playlist_id), Playlist.query.get(self.other_playlist_id)]
+            u.library.append(r)
+        db.session.commit()
+        playlist_tags_cache.delete(str(self.playlist_id))
+
+    def get(self, url, login=True):
+        with self.client as c:
+            if login:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+            with capture_queries() as log:
+                resp = c.get(url)
+            resp.query_count = log.count
+            return resp
+
+    def test_get_user(self):
+        """Is a user's public profile returned without private fields?"""
+        resp = self.get(f'/api/v1/users/{self.user_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['data']['username'], 'Spongebob')
+        self.assertNotIn('password', resp.json['data'])
+        self.assertNotIn('email', resp.json['data'])
+
+    def test_login_required(self):
+        """Do logged out requests get a 401 in JSON?"""
+        resp = self.get(f'/api/v1/users/{self.user_id}', login=False)
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('auth', resp.json['errors'])
+
+    def test_not_found(self):
+        """Are missing rows a 404 in JSON?"""
+        resp = self.get('/api/v1/playlists/999')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('errors', resp.json)
+
+    def test_fields(self):
+        """Does ?fields pick the fields returned, always with the id?"""
+        resp = self.get(f'/api/v1/users/{self.user_id}/library?fields=title')
+        self.assertEqual(list(resp.json['data'][0]), ['id', 'title'])
+
+        resp = self.get(f'/api/v1/users/{self.user_id}/library?fields=title,password')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('password', resp.json['errors']['fields'][0])
+
+    def test_includes(self):
+        """Are tags and playlists only included when asked for, and library playlists only the user's?"""
+        resp = self.get(f'/api/v1/users/{self.user_id}/library')
+        self.assertNotIn('tags', resp.json['data'][0])
+
+        resp = self.get(f'/api/v1/users/{self.user_id}/library?include=tags,playlists')
+        recording = resp.json['data'][0]
+        self.assertEqual(sorted(t['name'] for t in recording['tags']), ['few-tag-0', 'nautical'])
+        self.assertEqual(recording['playlists'], [{'id': self.playlist_id, 'name': 'Jelly Jamz'}])
+
+        resp = self.get(f'/api/v1/playlists/{self.playlist_id}?include=tags')
+        self.assertIn({'id': 1, 'name': 'nautical', 'count': 1}, resp.json['data']['tags'])
+
+    def test_pagination(self):
+        """Does following next walk every recording once, in order?"""
+        self.add_songs(6, 'many')
+        url = '/api/v1/tags/1/recordings?limit=3&fields=title'
+        titles = []
+        while url:
+            body = self.get(url).json
+            titles += [r['title'] for r in body['data']]
+            url = body['links']['next']
+        self.assertEqual(titles, ['few 0'] + [f'many {i}' for i in range(6)])
+
+    def test_compact(self):
+        """Is the JSON sent without extra whitespace?"""
+        resp = self.get('/api/v1/tags/1')
+        self.assertNotIn(b', ', resp.data)
+        self.assertNotIn(b': ', resp.data)
+
+    def test_query_counts_are_fixed(self):
+        """Does every endpoint run the same number of queries however many rows it returns?"""
+        urls = [
+            f'/api/v1/users/{self.user_id}',
+            f'/api/v1/users/{self.user_id}/library?include=tags,playlists',
+            f'/api/v1/users/{self.user_id}/playlists',
+            f'/api/v1/playlists/{self.playlist_id}?include=tags',
+            f'/api/v1/playlists/{self.playlist_id}/recordings?include=tags,playlists',
+            '/api/v1/recordings/1?include=tags,playlists',
+            '/api/v1/tags/1',
+            '/api/v1/tags/1/recordings?include=tags,playlists'
+        ]
+        few = [self.get(url).query_count for url in urls]
+        self.add_songs(20, 'many')
+        many = [self.get(url).query_count for url in urls]
+
+        self.assertEqual(few, many)
+        for url, count in zip(urls, many):
+            endpoint = app.url_map.bind('').match(url.split('?')[0])[0]
+            self.assertLessEqual(count, app.view_functions[endpoint].query_budget, url)
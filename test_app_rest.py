@@ -3,9 +3,18 @@
 # run tests by typing in the terminal:
 # python -m unittest test_app_rest.py
 
+import re, tempfile
 from unittest import TestCase
+from unittest.mock import patch
 
-from app import app, CURR_USER_KEY
+import requests
+from flask import g
+
+from app import app, CURR_USER_KEY, CURR_USERNAME_KEY
+from cache import FileCache
+from helpers import search_cache, playlist_tags_cache, add_tags, bump_versions, invalidate_playlist_tags, update_spotify_tracks, SPOTIFY_TRACKS_BATCH_SIZE
+from fragments import fragment_stats
+from query_stats import capture_queries
 from models import  db, User, Recording, Playlist, Tag
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
@@ -24,6 +33,11 @@ class UserViewTestCase(TestCase):
 
         self.client = app.test_client()
 
+        # Playlist ids start over with every test, so each one gets an empty tag count cache
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.tags_cache = patch.object(playlist_tags_cache, 'shared', FileCache(self.cache_dir.name))
+        self.tags_cache.start()
+
         self.u = User.register(
             username="Spongebob",
             password="gary1234",
@@ -46,6 +60,8 @@ class UserViewTestCase(TestCase):
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
+        self.tags_cache.stop()
+        self.cache_dir.cleanup()
         return res
 
     def setup_playlist(self):
@@ -68,6 +84,114 @@ class UserViewTestCase(TestCase):
         self.r.tags.append(t)
         db.session.commit()
 
+    # Search tests
+
+    def test_spotify_batch_lookup(self):
+        """Does one batch request return a track for every search result, without the user connecting Spotify?"""
+        def fake_search(title, artist, token):
+            if title == 'F.U.N.':
+                return {'tracks': {'items': [{'uri': 'spotify:track:0zNdw7vzK7nVtMlNkjVRfb'}]}}
+            return {'tracks': {'items': []}}
+
+        with self.client as c, patch('helpers.get_spotify_info', side_effect=fake_search) as search:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post('/search/api/batch', json={'items': [
+                {'mbid': 'a', 'title': 'F.U.N.', 'artist': 'Spongebob Squarepants'},
+                {'mbid': 'b', 'title': 'Ripped Pants', 'artist': 'Spongebob Squarepants'}
+            ]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['tracks'], {'a': '0zNdw7vzK7nVtMlNkjVRfb', 'b': None})
+            self.assertEqual(search.call_count, 2)
+            self.assertTrue(resp.cache_control.no_store)
+
+    def test_spotify_batch_lookup_errors(self):
+        """Does a failed lookup come back as a null track without losing the others, and a bad body as a 400?"""
+        def fake_search(title, artist, token):
+            if title == 'F.U.N.':
+                raise requests.ConnectionError
+            return {'tracks': {'items': [{'uri': 'spotify:track:2v8gpZ1dGc1nzBMdzWBmKr'}]}}
+
+        with self.client as c, patch('helpers.get_spotify_info', side_effect=fake_search):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post('/search/api/batch', json={'items': [
+                {'mbid': 'a', 'title': 'F.U.N.', 'artist': 'Spongebob Squarepants'},
+                {'mbid': 'b', 'title': 'Ripped Pants', 'artist': 'Spongebob Squarepants'}
+            ]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['tracks'], {'a': None, 'b': '2v8gpZ1dGc1nzBMdzWBmKr'})
+
+            for body in [{'items': 'F.U.N.'}, {'items': ['F.U.N.']}, ['F.U.N.']]:
+                self.assertEqual(c.post('/search/api/batch', json=body).status_code, 400)
+
+    def test_spotify_lookup_cache_headers(self):
+        """Can the browser keep Spotify matches and revalidate them, but not errors?"""
+        found = {'tracks': {'items': [{'uri': 'spotify:track:0zNdw7vzK7nVtMlNkjVRfb'}]}}
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            with patch('app.get_spotify_info', return_value=found):
+                resp = c.get('/search/api/F.U.N./Spongebob')
+                again = c.get('/search/api/F.U.N./Spongebob', headers={'If-None-Match': resp.headers['ETag']})
+            with patch('app.get_spotify_info', return_value={'error': {'status': 429}}):
+                error = c.get('/search/api/F.U.N./Spongebob')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.private)
+            self.assertGreater(resp.cache_control.max_age, 0)
+            self.assertEqual(again.status_code, 304)
+            self.assertTrue(error.cache_control.no_store)
+
+    def test_musicbrainz_search_proxy(self):
+        """Are MusicBrainz searches proxied and cached?"""
+        recordings = [{'id': 'a', 'title': 'F.U.N.', 'artist-credit': [{'name': 'Spongebob Squarepants'}]}]
+        search_cache.memory.clear()
+        with self.client as c, patch.object(search_cache, 'shared', None), patch('helpers.mb.search_recordings', return_value={'recordings': recordings}) as search:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.get('/search/mb?type=artist&q=Spongebob%20Proxy&limit=5')
+            c.get('/search/mb?type=artist&q=spongebob  proxy&limit=5')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['recordings'], recordings)
+            search.assert_called_once_with(query='artist:Spongebob Proxy', limit=5)
+
+    def test_local_search(self):
+        """Are recordings already on Musophile found despite typos, best match first?"""
+        db.session.add_all([
+            Recording(mbid = 'sv', title = 'Sweet Victory', artist = 'David Glen Eisley'),
+            Recording(mbid = 'sv2', title = 'Sweet Victory (Live)', artist = 'David Glen Eisley')
+        ])
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.get('/search/local?type=recording&q=swete victory')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([r['mbid'] for r in resp.json['recordings']], ['sv', 'sv2'])
+
+            resp = c.get('/search/local?type=artist&q=spongebob squarpants')
+            self.assertEqual([r['title'] for r in resp.json['recordings']], ['F.U.N.'])
+
+            resp = c.get('/search/local?type=tag&q=rock')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_local_search_tags_stay_text(self):
+        """Does a tag with markup in it come back as plain data, and get escaped where the server renders it?"""
+        add_tags(self.r, ['<script>alert("jellyfish")</script>'])
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.get('/search/local?type=artist&q=spongebob squarepants')
+            self.assertEqual(resp.mimetype, 'application/json')
+            self.assertEqual(resp.json['recordings'][0]['tags'], ['<script>alert("jellyfish")</script>'])
+
+            html = c.get(f'/user/{self.u.id}/library').get_data(as_text=True)
+            self.assertIn('&lt;script&gt;', html)
+            self.assertNotIn('<script>alert', html)
+
     # Playlist tests
 
     def test_show_user_playlists(self):
@@ -97,6 +221,40 @@ class UserViewTestCase(TestCase):
             self.assertIn('I like jellyfishing!', html)
             self.assertIn('peanut butter jelly time!', html)
 
+    def test_playlist_tag_counts(self):
+        """Are a playlist's tags shown once each with counts, cached, and updated when tags change?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        r = Recording(mbid = '437uyn', title = 'Clarinet Concerto', artist = 'Squidward')
+        r.tags.append(Tag.query.get(1))
+        db.session.add(r)
+        p = Playlist.query.get(1)
+        p.recordings.append(r)
+        u = User.query.get(self.u_id)
+        u.library.append(r)
+        db.session.commit()
+        r_id = r.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            html = c.get('/playlists/1').get_data(as_text=True)
+            self.assertEqual(html.count('peanut butter jelly time!</a>'), 1)
+            self.assertIn('peanut butter jelly time!</a> <small>(2 songs)</small>', html)
+
+            with capture_queries() as log:
+                c.get('/playlists/1')
+            self.assertFalse([s for s in log.statements if 'count(' in s])
+
+            c.post(f'/tags/1/remove/{r_id}')
+            html = c.get('/playlists/1').get_data(as_text=True)
+            self.assertIn('peanut butter jelly time!</a> <small>(1 song)</small>', html)
+
+            c.post(f'/user/{self.u_id}/library/{r_id}/edit', data={'comments': '', 'tags': 'woodwind'})
+            html = c.get('/playlists/1').get_data(as_text=True)
+            self.assertIn('woodwind</a> <small>(1 song)</small>', html)
+
     def test_new_playlist(self):
         """Does it create a new playlist?"""
         with self.client as c:
@@ -138,6 +296,33 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Clarinet Concerto', html)
 
+    def test_add_recordings_to_playlist(self):
+        """Are only songs missing from the playlist offered, and can several be added at once?"""
+        self.setup_playlist()
+        self.u_id = self.u.id
+        u = User.query.get(self.u_id)
+        for i in range(3):
+            u.library.append(Recording(mbid = f'm{i}', title = f'Song {i}', artist = 'Squidward'))
+        db.session.commit()
+        ids = [r.id for r in Recording.query.filter(Recording.mbid.like('m%')).order_by(Recording.id)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            html = c.get('/playlists/1/add').get_data(as_text=True)
+            self.assertNotIn('F.U.N.', html)
+            self.assertIn('Song 2', html)
+
+            with capture_queries() as log:
+                resp = c.post('/playlists/1/add', data={'recording': ids[:2]}, follow_redirects=True)
+            self.assertIn('Successfully added 2 songs to Jelly Jamz', resp.get_data(as_text=True))
+            self.assertEqual(len([s for s in log.statements if 'INSERT INTO playlist_recordings' in s]), 1)
+
+            self.assertEqual({r.mbid for r in Playlist.query.get(1).recordings}, {'12345', 'm0', 'm1'})
+            html = c.get('/playlists/1/add').get_data(as_text=True)
+            self.assertNotIn('Song 0', html)
+            self.assertIn('Song 2', html)
+
     def test_remove_recording_from_playlist(self):
         """Does it remove a recording from a playlist?"""
         self.setup_playlist()
@@ -197,16 +382,390 @@ class UserViewTestCase(TestCase):
             self.assertIn('peanut butter jelly time!', html)
             self.assertIn('F.U.N.', html)
     
-    def remove_tag(self):
+    def test_remove_tag(self):
         """Does it remove a tag from a recording"""
         self.setup_tag()
-        t = Tag.query.get(1)
+        r_id = self.r.id
         with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u.id
-            resp = c.get(f'/tags/{t.id}/remove/{self.r.id}')
-            html = str(resp.data)
+            resp = c.post(f'/tags/1/remove/{r_id}', follow_redirects=True)
+            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Successfully removed peanut butter jelly time! tag from F.U.N.', html)
-            self.assertIn('F.U.N.', html)
\ No newline at end of file
+            self.assertIn('F.U.N.', html)
+
+    def test_library_loads_own_playlists(self):
+        """Does the library page only load the user's own playlists, not everyone's with the same song?"""
+        self.setup_playlist()
+        u2 = User.register('Patrick', 'rock1234', 'patrick@test.com', 'Other', None)
+        db.session.add(u2)
+        db.session.commit()
+        other = Playlist(name='Rock Collection', user_id=u2.id)
+        other.recordings.append(self.r)
+        db.session.add(other)
+        db.session.commit()
+        u_id = self.u.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u_id
+            with capture_queries() as log:
+                html = c.get(f'/user/{u_id}/library').get_data(as_text=True)
+
+            self.assertIn('Jelly Jamz', html)
+            self.assertNotIn('Rock Collection', html)
+            playlist_loads = [s for s in log.statements if 'JOIN playlists' in s]
+            self.assertTrue(playlist_loads)
+            self.assertTrue(all('playlists.user_id =' in s for s in playlist_loads))
+
+    def test_remove_tag_not_in_library(self):
+        """Can only users with the song in their library remove its tags, and only tags it has?"""
+        self.setup_tag()
+        u2 = User.register('Patrick', 'rock1234', 'patrick@test.com', 'Other', None)
+        db.session.add(u2)
+        db.session.commit()
+        u_id, u2_id, r_id = self.u.id, u2.id, self.r.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            self.assertEqual(c.post(f'/tags/1/remove/{r_id}').status_code, 403)
+            self.assertEqual([t.name for t in Recording.query.get(r_id).tags], ['peanut butter jelly time!'])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u_id
+            c.post(f'/tags/1/remove/{r_id}')
+            self.assertEqual(c.post(f'/tags/1/remove/{r_id}').status_code, 404)
+
+    # Query count tests
+
+    def add_songs(self, n, prefix):
+        """Add n tagged recordings to the user's library and playlist"""
+        u = User.query.get(self.u_id)
+        p = Playlist.query.get(1)
+        for i in range(n):
+            r = Recording(mbid = f'{prefix}-{i}', title = f'{prefix} {i}', artist = 'Squidward')
+            r.tags.append(Tag.query.get(1))
+            r.tags.append(Tag(name = f'{prefix}-tag-{i}'))
+            db.session.add(r)
+            u.library.append(r)
+            p.recordings.append(r)
+        invalidate_playlist_tags([p.id])
+        bump_versions(User, [u.id])
+        bump_versions(Tag, [1])
+        db.session.commit()
+
+    def get_query_count(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+                sess[CURR_USERNAME_KEY] = 'Spongebob'
+            with capture_queries() as log:
+                resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(log.repeated(), f'{url} repeats a query')
+            return log.count
+
+    def test_query_counts_are_fixed(self):
+        """Do the listing pages run the same number of queries however much they show?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        urls = [f'/user/{self.u_id}', f'/user/{self.u_id}/library', f'/user/{self.u_id}/playlists', '/playlists/1', '/tags/1']
+
+        self.add_songs(1, 'few')
+        few = [self.get_query_count(url) for url in urls]
+        self.add_songs(10, 'many')
+        many = [self.get_query_count(url) for url in urls]
+
+        self.assertEqual(few, many)
+        # The page's row, then the page of items and one select-in query per eager-loaded relationship
+        self.assertEqual(many, [3, 4, 3, 3, 2])
+
+    # Spotify card tests
+
+    def test_spotify_cards(self):
+        """Do listing pages show cards from the stored metadata, with no player until play is clicked?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.r.spotify_uri = '0zNdw7vzK7nVtMlNkjVRfb'
+        self.r.spotify_image_url = 'https://i.scdn.co/image/fun'
+        self.r.spotify_duration_ms = 205000
+        self.r.spotify_preview_url = 'https://p.scdn.co/mp3-preview/fun'
+        db.session.commit()
+        u_id = self.u.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u_id
+            for url in [f'/user/{u_id}/library', '/playlists/1', '/tags/1']:
+                html = c.get(url).get_data(as_text=True)
+
+                self.assertIn('data-spotify-uri="0zNdw7vzK7nVtMlNkjVRfb"', html)
+                self.assertIn('src="https://i.scdn.co/image/fun"', html)
+                self.assertIn('data-preview-url="https://p.scdn.co/mp3-preview/fun"', html)
+                self.assertIn('3:25', html)
+                self.assertIn('/static/player.js', html)
+                self.assertNotIn('<iframe', html)
+
+    def test_update_spotify_tracks(self):
+        """Is metadata fetched in batches, bumping the pages that show it, with failed batches left for next time?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(SPOTIFY_TRACKS_BATCH_SIZE + 5, 'many')
+        recordings = Recording.query.order_by(Recording.id).all()
+        for r in recordings:
+            r.spotify_uri = f'track{r.id}'
+        db.session.commit()
+        versions = [User.query.get(self.u_id).version, Playlist.query.get(1).version, Tag.query.get(1).version]
+
+        def fake_tracks(track_ids, token):
+            if 'track1' not in track_ids:
+                return {'error': {'status': 503}}
+            return {'tracks': [None if id == 'track2' else {
+                'duration_ms': 61000,
+                'preview_url': None,
+                'album': {'images': [{'url': 'big', 'width': 640}, {'url': 'medium', 'width': 300}, {'url': 'small', 'width': 64}]}
+            } for id in track_ids]}
+
+        with patch('helpers.fetch_spotify_tracks', side_effect=fake_tracks) as fetch, patch('helpers.get_app_token', return_value='token'):
+            self.assertEqual(update_spotify_tracks(recordings), SPOTIFY_TRACKS_BATCH_SIZE)
+            db.session.commit()
+
+        self.assertEqual([len(call.args[0]) for call in fetch.call_args_list], [SPOTIFY_TRACKS_BATCH_SIZE, len(recordings) - SPOTIFY_TRACKS_BATCH_SIZE])
+        first, missing, last = Recording.query.get(1), Recording.query.get(2), Recording.query.get(len(recordings))
+        self.assertEqual((first.spotify_image_url, first.spotify_duration), ('medium', '1:01'))
+        self.assertIsNotNone(missing.spotify_fetched_at)
+        self.assertIsNone(missing.spotify_image_url)
+        self.assertIsNone(last.spotify_fetched_at)
+        self.assertNotEqual([User.query.get(self.u_id).version, Playlist.query.get(1).version, Tag.query.get(1).version], versions)
+
+    def test_update_spotify_tracks_rejected_id(self):
+        """Does one id Spotify rejects leave the rest of its batch filled in, and itself not retried?"""
+        self.r.spotify_uri = 'not-a-track'
+        good = Recording(mbid='sv', title='Sweet Victory', artist='David Glen Eisley', spotify_uri='goodtrack')
+        db.session.add(good)
+        db.session.commit()
+
+        def fake_tracks(track_ids, token):
+            if 'not-a-track' in track_ids:
+                return {'error': {'status': 400, 'message': 'invalid id'}}
+            return {'tracks': [{'duration_ms': 61000, 'album': {'images': []}} for id in track_ids]}
+
+        recordings = Recording.query.order_by(Recording.id).all()
+        with patch('helpers.fetch_spotify_tracks', side_effect=fake_tracks) as fetch, patch('helpers.get_app_token', return_value='token'):
+            self.assertEqual(update_spotify_tracks(recordings), 2)
+            db.session.commit()
+            self.assertEqual(update_spotify_tracks(Recording.query.all()), 0)
+
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(Recording.query.filter_by(mbid='sv').one().spotify_duration_ms, 61000)
+        self.assertIsNotNone(Recording.query.filter_by(mbid='12345').one().spotify_fetched_at)
+
+    # Conditional GET tests
+
+    def test_not_modified(self):
+        """Do unchanged pages answer 304 without rendering, and changed ones the new page?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        r_id = self.r.id
+        urls = [f'/user/{self.u_id}', f'/user/{self.u_id}/library', f'/user/{self.u_id}/playlists', '/playlists/1', '/tags/1']
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+                sess[CURR_USERNAME_KEY] = 'Spongebob'
+            etags = {}
+            for url in urls:
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('no-cache', resp.headers['Cache-Control'])
+                etags[url] = resp.headers['ETag']
+                last_modified = resp.headers['Last-Modified']
+
+                with capture_queries() as log:
+                    resp = c.get(url, headers={'If-None-Match': etags[url]})
+                self.assertEqual(resp.status_code, 304, url)
+                self.assertEqual(resp.data, b'')
+                self.assertEqual(resp.headers['ETag'], etags[url])
+                self.assertEqual(log.count, 1)
+
+                modified = c.get(url, headers={'If-Modified-Since': last_modified})
+                self.assertEqual(modified.status_code, 304, url)
+
+            c.post(f'/playlists/1/remove/{r_id}')
+            c.get('/')
+            for url in urls:
+                resp = c.get(url, headers={'If-None-Match': etags[url]})
+                expected = 304 if url == '/tags/1' else 200
+                self.assertEqual(resp.status_code, expected, url)
+
+    def test_etag_per_viewer_and_page(self):
+        """Do other users and other pages of the same listing get their own ETags?"""
+        self.setup_tag()
+        self.u_id = self.u.id
+        other = User.register(username='Patrick', password='rock1234', email='star@test.com', role='Other', img_url=None)
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            etag = c.get('/tags/1').headers['ETag']
+            self.assertNotEqual(c.get('/tags/1?limit=5').headers['ETag'], etag)
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            self.assertEqual(c.get('/tags/1', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_no_validators_with_flashed_messages(self):
+        """Is a page showing a flashed message always sent in full?"""
+        self.setup_playlist()
+        self.u_id = self.u.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            etag = c.get('/playlists/1').headers['ETag']
+            resp = c.post('/playlists/1/edit', data={'name': 'Jelly Jamz', 'description': 'I like jellyfishing!'}, follow_redirects=True)
+            self.assertIn('Successfully edited', resp.get_data(as_text=True))
+            self.assertNotIn('ETag', resp.headers)
+            self.assertNotEqual(c.get('/playlists/1', headers={'If-None-Match': etag}).status_code, 304)
+
+    # Fragment cache tests
+
+    def test_fragments_reused(self):
+        """Is a page shown again from its saved fragment, with only the page's own row queried?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(3, 'few')
+        urls = [f'/user/{self.u_id}', f'/user/{self.u_id}/library', '/playlists/1', '/tags/1']
+
+        first = [self.get_query_count(url) for url in urls]
+        saved = fragment_stats()['render_seconds_saved']
+        again = [self.get_query_count(url) for url in urls]
+
+        self.assertEqual(first, [3, 4, 3, 2])
+        self.assertEqual(again, [1, 1, 1, 1])
+        self.assertGreater(fragment_stats()['render_seconds_saved'], saved)
+
+    def test_fragments_rendered_after_writes(self):
+        """Do the write routes bump the versions of the pages they change?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        r_id = self.r.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            for url in [f'/user/{self.u_id}/library', '/playlists/1', '/tags/1']:
+                self.assertIn('F.U.N.', c.get(url).get_data(as_text=True))
+
+            c.post(f'/user/{self.u_id}/library/{r_id}/edit', data={'comments': 'Good song', 'tags': 'nautical'})
+            self.assertIn('Good song', c.get(f'/user/{self.u_id}/library').get_data(as_text=True))
+            self.assertIn('nautical', c.get('/playlists/1').get_data(as_text=True))
+
+            c.post(f'/tags/1/remove/{r_id}')
+            self.assertNotIn('<h4>F.U.N.</h4>', c.get('/tags/1').get_data(as_text=True))
+
+            c.post('/playlists/1/edit', data={'name': 'Krabby Patties', 'description': 'Secret formula'})
+            self.assertIn('Krabby Patties', c.get(f'/user/{self.u_id}').get_data(as_text=True))
+
+            c.post(f'/playlists/1/remove/{r_id}')
+            self.assertIn('This playlist is empty', c.get('/playlists/1').get_data(as_text=True))
+
+    def test_principal_from_session(self):
+        """Do requests that only need the user's id and name skip loading the User?"""
+        self.u_id = self.u.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+                sess[CURR_USERNAME_KEY] = 'Spongebob'
+            with capture_queries() as log:
+                resp = c.get('/')
+            self.assertIn('Hello, Spongebob!', resp.get_data(as_text=True))
+            self.assertEqual(log.count, 0)
+
+            with capture_queries() as log:
+                resp = c.get('/static/style.css')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(log.count, 0)
+            self.assertNotIn('user', g)
+
+    def test_principal_loads_user_when_needed(self):
+        """Is the full User loaded once a view touches more than the session has?"""
+        self.u_id = self.u.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            c.get('/')
+            self.assertEqual(g.user.username, 'Spongebob')
+            self.assertEqual(g.user.role, self.u.role)
+
+    def test_query_budgets(self):
+        """Do the listing pages stay within the budgets their views declare?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(10, 'many')
+        pages = {
+            'user_page': f'/user/{self.u_id}',
+            'show_user_library': f'/user/{self.u_id}/library',
+            'show_user_playlists': f'/user/{self.u_id}/playlists',
+            'show_playlist': '/playlists/1',
+            'show_songs_with_tag': '/tags/1'
+        }
+        for endpoint, url in pages.items():
+            budget = app.view_functions[endpoint].query_budget
+            self.assertLessEqual(self.get_query_count(url), budget, url)
+
+    # Pagination tests
+
+    def test_keyset_pagination(self):
+        """Does following the next page links walk the whole tag listing once, in order?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(25, 'many')
+        expected = [r.title for r in sorted(Tag.query.get(1).recordings, key=lambda r: r.id)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            titles = []
+            url = '/tags/1?limit=10'
+            while url:
+                resp = c.get(url)
+                html = resp.get_data(as_text=True)
+                titles += re.findall(r'<h4>(.*?)</h4>', html)
+                next_link = re.search(r'href="([^"]*)"[^>]*>Next page', html)
+                url = next_link.group(1).replace('&amp;', '&') if next_link else None
+
+        self.assertEqual(titles, expected)
+
+    def test_page_links_ignore_clashing_args(self):
+        """Do query string arguments named like the view's arguments or url_for's own leave the page links alone?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(3, 'few')
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            resp = c.get(f'/user/{self.u_id}/library?limit=1&user_id=2&endpoint=x&_external=1&q=fun')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'/user/{self.u_id}/library?q=fun&amp;after=', html)
+
+    def test_page_size_limit(self):
+        """Is the page size kept within the allowed range?"""
+        self.setup_playlist()
+        self.setup_tag()
+        self.u_id = self.u.id
+        self.add_songs(3, 'few')
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            resp = c.get(f'/user/{self.u_id}/library?limit=0')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('limit=1', html)
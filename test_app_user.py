@@ -3,10 +3,16 @@
 # run tests by typing in the terminal:
 # python -m unittest test_app_user.py
 
+import re
+from io import BytesIO
 from unittest import TestCase
+from unittest.mock import patch
 
 from app import app, CURR_USER_KEY
-from models import  db, User, Recording
+from models import  db, User, Recording, ImportJob, Library
+from helpers import update_search_vectors, spotify_cache
+from spotify_tokens import save_token
+from importer import create_import_job, claim_import
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -80,6 +86,20 @@ class UserViewTestCase(TestCase):
 
     # User library routes
 
+    def test_search_page_spotify_connection(self):
+        """Does the search page only show a Spotify connection that still works?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            self.assertIn('Connect to Spotify', c.get('/search').get_data(as_text=True))
+
+            save_token(self.u.id, 'access', 'refresh', 3600)
+            self.assertIn("You're connected to Spotify!", c.get('/search').get_data(as_text=True))
+
+            save_token(self.u.id, 'access', 'refresh', 60)
+            with patch('spotify_tokens.get_refresh_token', return_value={'error': 'invalid_grant'}):
+                self.assertIn('Connect to Spotify', c.get('/search').get_data(as_text=True))
+
     def test_add_recording_to_library(self):
         """Is a new recording successfully displayed in a user's library?"""
         with self.client as c:
@@ -110,6 +130,49 @@ class UserViewTestCase(TestCase):
 
         return r.id
 
+    def test_add_existing_recording_to_library(self):
+        """Is a recording already in the database reused instead of duplicated?"""
+        r_id = self.setup_recording()
+        u2 = User.register('Patrick', 'rock1234', 'patrick@test.com', 'Other', None)
+        db.session.add(u2)
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2.id
+            resp = c.post(f'/user/add-recording/12345/{TEST_SPOTIFY_URI}', follow_redirects=True)
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Title: F.U.N.', html)
+            self.assertEqual(Recording.query.filter_by(mbid='12345').count(), 1)
+            self.assertEqual(Recording.query.get(r_id).spotify_uri, TEST_SPOTIFY_URI)
+
+    def test_add_recording_uses_cached_search(self):
+        """Does a recording found through a cached Spotify search get its card without another request?"""
+        r_id = self.setup_recording()
+        Library.query.filter_by(user_id=self.u.id).delete()
+        db.session.commit()
+        track = {'uri': f'spotify:track:{TEST_SPOTIFY_URI}', 'duration_ms': 120000, 'preview_url': 'https://p.scdn.co/fun', 'album': {'images': []}}
+        with self.client as c, patch.object(spotify_cache, 'get', return_value={'tracks': {'items': [track]}}), \
+                patch('helpers.get_spotify_tracks') as fetch:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post(f'/user/add-recording/12345/{TEST_SPOTIFY_URI}')
+
+            self.assertEqual(resp.status_code, 302)
+            fetch.assert_not_called()
+            recording = Recording.query.get(r_id)
+            self.assertEqual(recording.spotify_duration_ms, 120000)
+            self.assertIsNotNone(Library.query.get((self.u.id, r_id)))
+
+    def test_add_recording_bad_spotify_id(self):
+        """Is a Spotify id that isn't 22 letters and digits refused?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post(f'/user/add-recording/{TEST_GET_RECORDING}/abc,def')
+            self.assertEqual(resp.status_code, 400)
+
     def test_edit_recording(self):
         """Is a recording successfully edited?"""
         r_id = self.setup_recording()
@@ -126,6 +189,28 @@ class UserViewTestCase(TestCase):
             self.assertIn('Comments: Fun times!', html)
             self.assertIn('<a href="/tags/1">fun</a>', html)
 
+    def test_comments_are_per_user(self):
+        """Does each user's comment on a shared recording stay in their own library?"""
+        r_id = self.setup_recording()
+        u2 = User.register('Patrick', 'rock1234', 'patrick@test.com', 'Other', None)
+        db.session.add(u2)
+        db.session.commit()
+        u_id, u2_id = self.u.id, u2.id
+        db.session.add(Library(user_id=u2_id, recording_id=r_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            c.post(f'/user/{u2_id}/library/{r_id}/edit', data={'comments': 'Mine!', 'tags': ''})
+            resp = c.post(f'/user/{u_id}/library/{r_id}/edit', data={'comments': 'Hijacked', 'tags': ''})
+            self.assertEqual(resp.status_code, 403)
+
+            self.assertIn('Comments: Mine!', c.get(f'/user/{u2_id}/library').get_data(as_text=True))
+            html = c.get(f'/user/{u_id}/library').get_data(as_text=True)
+            self.assertNotIn('Mine!', html)
+            self.assertNotIn('Hijacked', html)
+
     def test_delete_recording(self):
         """Is a recording successfully deleted?"""
         r_id = self.setup_recording()
@@ -137,4 +222,85 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('F.U.N.', html)
-            self.assertIn('Successfully removed!', html)
\ No newline at end of file
+            self.assertIn('Successfully removed!', html)
+            self.assertIsNotNone(Recording.query.get(r_id))
+
+    # Library search
+
+    def test_search_library(self):
+        """Does library search cover tags and comments and stay current when they change?"""
+        r_id = self.setup_recording()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            c.post(f'/user/{self.u.id}/library/{r_id}/edit', data={
+                'comments': 'Sung at the campfire',
+                'tags': 'silly'
+            })
+
+            for q in ['squarepants', 'silly', 'campfire']:
+                resp = c.get(f'/user/{self.u.id}/library/search?q={q}')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('<h4>F.U.N.</h4>', resp.get_data(as_text=True), q)
+
+            c.post(f'/tags/1/remove/{r_id}')
+            resp = c.get(f'/user/{self.u.id}/library/search?q=silly')
+            self.assertIn('Nothing in this library matches', resp.get_data(as_text=True))
+
+    def test_search_library_ranking(self):
+        """Do title matches come before comment matches, a page at a time?"""
+        self.setup_recording()
+        for mbid, title, comments in [('2', 'Campfire Song Song', None), ('3', 'Ripped Pants', 'Not the campfire one')]:
+            r = Recording(mbid=mbid, title=title, artist='Spongebob Squarepants')
+            db.session.add(r)
+            db.session.flush()
+            db.session.add(Library(user_id=self.u.id, recording_id=r.id, comments=comments))
+        db.session.commit()
+        update_search_vectors([r.id for r in Recording.query])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            titles = []
+            url = f'/user/{self.u.id}/library/search?q=campfire&limit=1'
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                titles += re.findall(r'<h4>(.*?)</h4>', html)
+                next_link = re.search(r'href="([^"]*)"[^>]*>Next page', html)
+                url = next_link.group(1).replace('&amp;', '&') if next_link else None
+
+            self.assertEqual(titles, ['Campfire Song Song', 'Ripped Pants'])
+
+    # Bulk import routes
+
+    def test_import_to_library(self):
+        """Does uploading a file create an import job that can be polled?"""
+        with self.client as c, patch('app.start_import') as start:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post(f'/user/{self.u.id}/imports', data={
+                'format': 'mbids',
+                'file': (BytesIO(b'12345\n67890\n'), 'songs.txt')
+            })
+
+            self.assertEqual(resp.status_code, 202)
+            job = ImportJob.query.one()
+            self.assertEqual(job.total, 2)
+            start.assert_called_once_with(app, job.id)
+
+            resp = c.get(resp.headers['Location'])
+            self.assertEqual(resp.json['job']['status'], 'pending')
+
+    def test_resume_running_import(self):
+        """Is a job that is still running refused instead of started twice?"""
+        job_id = create_import_job(self.u.id, [{'mbid': '12345', 'title': None, 'artist': None}]).id
+        claim_import(job_id)
+        with self.client as c, patch('importer.threading.Thread') as thread:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+            resp = c.post(f'/user/{self.u.id}/imports/{job_id}/resume')
+
+            self.assertEqual(resp.status_code, 409)
+            self.assertEqual(resp.json['job']['status'], 'running')
+            thread.assert_not_called()
@@ -0,0 +1,137 @@
+"""Static asset build and response compression tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_assets.py
+
+import gzip, mimetypes, os, shutil, tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import brotli
+
+from app import app, CURR_USER_KEY
+from assets import build_assets, manifest_version, BUILD_DIR, STATIC_DIR
+from models import db, User
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+class AssetTestCase(TestCase):
+    """Test built static files and compressed responses"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Build a copy of static/ so the real one is left as it is
+        self.tmp = tempfile.TemporaryDirectory()
+        self.static_dir = os.path.join(self.tmp.name, 'static')
+        shutil.copytree(STATIC_DIR, self.static_dir)
+        self.manifest = build_assets(self.static_dir)
+        self.static_folder = app.static_folder
+        app.static_folder = self.static_dir
+        self.config = patch.dict(app.config, {'ASSET_MANIFEST': self.manifest, 'ASSET_VERSION': manifest_version(self.manifest)})
+        self.config.start()
+
+        u = User.register('Spongebob', 'password', 'sponge@bikini-bottom.com', 'Music Fan', None)
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        self.config.stop()
+        app.static_folder = self.static_folder
+        self.tmp.cleanup()
+        return res
+
+    def read_built(self, name, suffix=''):
+        with open(os.path.join(self.static_dir, self.manifest[name] + suffix), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """Is every file renamed with a hash, minified, and precompressed where that helps?"""
+        self.assertRegex(self.manifest['style.css'], rf'^{BUILD_DIR}/style\.[0-9a-f]{{12}}\.css$')
+        self.assertRegex(self.manifest['headphones.jpeg'], rf'^{BUILD_DIR}/headphones\.[0-9a-f]{{12}}\.jpeg$')
+
+        css = self.read_built('style.css')
+        self.assertLess(len(css), os.path.getsize(os.path.join(STATIC_DIR, 'style.css')))
+        self.assertNotIn(b'/* Home page */', css)
+        self.assertEqual(gzip.decompress(self.read_built('style.css', '.gz')), css)
+        self.assertEqual(brotli.decompress(self.read_built('style.css', '.br')), css)
+        self.assertFalse(os.path.exists(os.path.join(self.static_dir, self.manifest['headphones.jpeg'] + '.gz')))
+
+        # The same content always builds to the same names
+        self.assertEqual(build_assets(self.static_dir), self.manifest)
+
+    def test_css_urls_use_built_names(self):
+        """Does the built stylesheet point at the built image?"""
+        image = self.manifest['headphones.jpeg'][len(BUILD_DIR) + 1:]
+        self.assertIn(f'url("{image}")'.encode('utf8'), self.read_built('style.css'))
+
+    def test_url_for_static(self):
+        """Do pages link to the built files?"""
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn(f'href="/static/{self.manifest["style.css"]}"', html)
+
+    def test_serve_precompressed(self):
+        """Is the smallest variant the client accepts sent, with headers that keep it for a year?"""
+        url = f'/static/{self.manifest["search.js"]}'
+        for accept, encoding in [('gzip, deflate, br', 'br'), ('gzip', 'gzip'), ('', None)]:
+            resp = self.client.get(url, headers={'Accept-Encoding': accept})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers.get('Content-Encoding'), encoding)
+            self.assertEqual(resp.mimetype, mimetypes.guess_type('search.js')[0])
+            self.assertTrue(resp.cache_control.public)
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertEqual(resp.cache_control.max_age, 60 * 60 * 24 * 365)
+            self.assertIn('Accept-Encoding', resp.vary)
+            resp.close()
+
+    def test_unbuilt_files_served(self):
+        """Are the original files still served under their own names?"""
+        resp = self.client.get('/static/style.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+        resp.close()
+
+    def test_compress_pages(self):
+        """Are pages compressed for clients that accept it, and left alone otherwise?"""
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.vary)
+        self.assertIn(b'Welcome to Musophile!', gzip.decompress(resp.data))
+
+        resp = self.client.get('/', headers={'Accept-Encoding': 'br;q=1, gzip;q=0.5'})
+        self.assertIn(b'Welcome to Musophile!', brotli.decompress(resp.data))
+
+        resp = self.client.get('/')
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+
+    def test_compressed_pages_revalidate(self):
+        """Does a compressed page's weakened ETag still get a 304?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get(f'/user/{self.user_id}', headers={'Accept-Encoding': 'gzip'})
+            etag, weak = resp.get_etag()
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertTrue(weak)
+
+            resp = c.get(f'/user/{self.user_id}', headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'W/"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_page_etag_changes_with_build(self):
+        """Are cached pages dropped when the static files they link to are rebuilt?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            etag = c.get(f'/user/{self.user_id}').get_etag()[0]
+            with patch.dict(app.config, {'ASSET_VERSION': 'rebuilt'}):
+                resp = c.get(f'/user/{self.user_id}', headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
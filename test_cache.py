@@ -0,0 +1,171 @@
+"""Cache tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_cache.py
+
+import os, tempfile, threading, time
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import Cache
+from helpers import get_spotify_info, normalize_search_key, spotify_cache
+
+
+class CacheTestCase(TestCase):
+    """Test the two-tier cache"""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = Cache('test', ttl=60, max_size=2, directory=self.dir.name)
+        self.calls = 0
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def loader(self):
+        self.calls += 1
+        return {'title': 'Sweet Victory'}
+
+    def test_get_or_load(self):
+        """Is the loader only called on a miss?"""
+        self.assertEqual(self.cache.get_or_load('mbid', self.loader), {'title': 'Sweet Victory'})
+        self.assertEqual(self.cache.get_or_load('mbid', self.loader), {'title': 'Sweet Victory'})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        """Does the memory tier drop the least recently used entry?"""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.memory.get('a')
+        self.cache.set('c', 3)
+
+        self.assertIsNone(self.cache.memory.get('b'))
+        self.assertIsNotNone(self.cache.memory.get('a'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_shared_tier(self):
+        """Does a second cache on the same directory see the first one's entries?"""
+        self.cache.set('mbid', {'title': 'F.U.N.'})
+        other = Cache('test-other', ttl=60, directory=self.dir.name)
+
+        self.assertEqual(other.get('mbid'), {'title': 'F.U.N.'})
+
+    def test_shared_tier_size_limit(self):
+        """Does the shared tier drop its oldest entries past max_files?"""
+        cache = Cache('test-pruned', ttl=60, directory=self.dir.name, max_files=2)
+        for age, key in enumerate('cba'):
+            cache.set(key, key)
+            os.utime(cache.shared._path(key), (time.time() - age, time.time() - age))
+        cache.shared.prune()
+
+        self.assertIsNone(cache.shared.get('a'))
+        self.assertEqual(cache.shared.get('c')[0], 'c')
+        self.assertEqual(cache.stats()['shared_evictions'], 1)
+
+    def test_shared_tier_only(self):
+        """Does a delete in one worker reach another when the memory tier is off?"""
+        cache = Cache('test-shared-only', ttl=60, max_size=0, directory=self.dir.name)
+        other = Cache('test-shared-only-other', ttl=60, max_size=0, directory=self.dir.name)
+        cache.set('playlist', [1])
+        self.assertEqual(other.get('playlist'), [1])
+
+        cache.delete('playlist')
+        self.assertIsNone(other.get('playlist'))
+        self.assertEqual(other.stats()['size'], 0)
+
+    def test_expired(self):
+        """Are expired entries treated as misses?"""
+        self.cache.set('mbid', 'old', ttl=-1)
+        self.assertIsNone(self.cache.get('mbid'))
+        self.assertEqual(self.cache.get_or_load('mbid', self.loader), {'title': 'Sweet Victory'})
+
+    def test_coalesced_loads(self):
+        """Do concurrent misses for one key share a single load?"""
+        release = threading.Event()
+        def slow_loader():
+            release.wait(1)
+            return self.loader()
+
+        threads = [threading.Thread(target=self.cache.get_or_load, args=('mbid', slow_loader)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        while self.cache.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['coalesced'], 4)
+
+    def test_coalesced_loads_across_workers(self):
+        """Do misses in two workers sharing a directory make a single load?"""
+        other = Cache('test-other-worker', ttl=60, directory=self.dir.name)
+        release = threading.Event()
+        def slow_loader():
+            release.wait(1)
+            return self.loader()
+
+        threads = [threading.Thread(target=cache.get_or_load, args=('mbid', slow_loader)) for cache in (self.cache, other)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['coalesced'] + other.stats()['coalesced'], 1)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale entry served while it is reloaded in the background?"""
+        cache = Cache('test-stale', ttl=60, stale_ttl=60)
+        cache.set('mbid', 'old', ttl=-1)
+
+        self.assertEqual(cache.get_or_load('mbid', self.loader), 'old')
+        for _ in range(50):
+            if cache.get('mbid'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get('mbid'), {'title': 'Sweet Victory'})
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+
+
+class SpotifyCacheTestCase(TestCase):
+    """Test caching of Spotify search results"""
+    def setUp(self):
+        spotify_cache.memory.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        spotify_cache.shared.directory = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_normalize_search_key(self):
+        """Do equivalent searches share a key?"""
+        self.assertEqual(
+            normalize_search_key('Sweet Victory (feat. Squidward)', 'SpongeBob SquarePants!'),
+            normalize_search_key('sweet victory', 'spongebob squarepants')
+        )
+        self.assertNotEqual(normalize_search_key('Sweet Victory', 'David Glen Eisley'), normalize_search_key('Sweet Victory', 'Spongebob'))
+        self.assertEqual(normalize_search_key('Ripped Pants ft. Patrick', 'Spongebob featuring Patrick'), 'ripped pants|spongebob')
+
+    def test_normalize_search_key_feat_in_names(self):
+        """Are band names and titles that only contain "feat" or "ft." kept whole?"""
+        self.assertEqual(normalize_search_key('Dixie Chicken', 'Little Feat'), 'dixie chicken|little feat')
+        self.assertEqual(normalize_search_key('Fat Man in the Bathtub', 'Little Feat Live'), 'fat man in the bathtub|little feat live')
+        self.assertEqual(normalize_search_key('Ft. Lauderdale', 'Spongebob'), 'ft lauderdale|spongebob')
+        self.assertNotEqual(normalize_search_key('Feats of Strength', 'Larry'), normalize_search_key('Feats', 'Larry'))
+
+    def test_negative_caching(self):
+        """Is "not found on Spotify" cached, and errors not?"""
+        with patch('helpers.search_spotify', return_value={'tracks': {'items': []}}) as search:
+            get_spotify_info('Ripped Pants', 'Spongebob', 'token')
+            get_spotify_info('ripped pants', 'spongebob', 'token')
+            self.assertEqual(search.call_count, 1)
+
+        with patch('helpers.search_spotify', return_value={'error': {'status': 401}}) as search:
+            get_spotify_info('Campfire Song', 'Spongebob', 'token')
+            get_spotify_info('Campfire Song', 'Spongebob', 'token')
+            self.assertEqual(search.call_count, 2)
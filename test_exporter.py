@@ -0,0 +1,134 @@
+"""Library and playlist export tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_exporter.py
+
+import csv, gzip, io, json
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+from app import app, CURR_USER_KEY
+from models import db, User, Recording, Playlist, Tag, Library
+from importer import parse_import
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Test streaming exports"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        u = User.register('Spongebob', 'password', 'sponge@bikini-bottom.com', 'Music Fan', None)
+        fun = Recording(mbid='mbid-fun', title='F.U.N.', artist='Spongebob Squarepants', release='Spongebob Squarepants',
+            spotify_uri='0zNdw7vzK7nVtMlNkjVRfb')
+        ripped = Recording(mbid='mbid-ripped', title='Ripped Pants', artist='Spongebob Squarepants')
+        other = Recording(mbid='mbid-other', title='Clarinet Concerto', artist='Squidward')
+        fun.tags = [Tag(name='fun'), Tag(name='bubbly')]
+        db.session.add_all([u, fun, ripped, other])
+        db.session.commit()
+        u.library = [fun, ripped]
+        db.session.flush()
+        Library.query.get((u.id, fun.id)).comments = 'Fire & "coral"'
+        p = Playlist(name='Jelly Jamz', description='I like jellyfishing!', user_id=u.id)
+        p.recordings = [ripped]
+        db.session.add(p)
+        db.session.commit()
+
+        self.user_id = u.id
+        self.playlist_id = p.id
+        self.ids = [fun.id, ripped.id]
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def export(self, url, **headers):
+        """Get an export, reading the stream while the request is still open"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get(url, headers=headers)
+            resp.chunks = list(resp.response)
+            resp.set_data(b''.join(resp.chunks))
+            return resp
+
+    def test_export_jsonl(self):
+        """Is every library row exported once, in id order, with its tags?"""
+        resp = self.export(f'/user/{self.user_id}/library/export')
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([row['id'] for row in rows], self.ids)
+        self.assertEqual(rows[0]['tags'], ['bubbly', 'fun'])
+        self.assertEqual(rows[1]['tags'], [])
+
+    def test_export_csv(self):
+        """Can an exported CSV be imported again?"""
+        resp = self.export(f'/user/{self.user_id}/library/export?format=csv')
+        text = resp.get_data(as_text=True)
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        self.assertEqual(rows[0]['comments'], 'Fire & "coral"')
+        self.assertEqual(rows[0]['tags'], 'bubbly, fun')
+        self.assertEqual([row['mbid'] for row in parse_import(text, 'csv')], ['mbid-fun', 'mbid-ripped'])
+
+    def test_export_m3u(self):
+        """Do M3U entries point at Spotify, or MusicBrainz when a song isn't on Spotify?"""
+        resp = self.export(f'/user/{self.user_id}/library/export?format=m3u')
+        lines = resp.get_data(as_text=True).splitlines()
+
+        self.assertEqual(lines[0], '#EXTM3U')
+        self.assertIn('spotify:track:0zNdw7vzK7nVtMlNkjVRfb', lines)
+        self.assertIn('https://musicbrainz.org/recording/mbid-ripped', lines)
+        self.assertIn(f'#EXTINF:-1 musophile-id="{self.ids[1]}",Spongebob Squarepants - Ripped Pants', lines)
+
+    def test_export_xspf(self):
+        """Is the XSPF export well formed, with characters escaped?"""
+        resp = self.export(f'/user/{self.user_id}/library/export?format=xspf')
+        ns = {'x': 'http://xspf.org/ns/0/'}
+        playlist = ElementTree.fromstring(resp.data)
+        tracks = playlist.findall('x:trackList/x:track', ns)
+
+        self.assertEqual(playlist.find('x:title', ns).text, "Spongebob's Library")
+        self.assertEqual(len(tracks), 2)
+        self.assertEqual(tracks[0].find('x:annotation', ns).text, 'Fire & "coral"')
+
+    def test_export_playlist(self):
+        """Does a playlist export only have the playlist's songs?"""
+        resp = self.export(f'/playlists/{self.playlist_id}/export')
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['Ripped Pants'])
+
+    def test_export_resume(self):
+        """Does ?after pick up after the last row received, without repeating the header?"""
+        resp = self.export(f'/user/{self.user_id}/library/export?format=csv&after={self.ids[0]}')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith(f'{self.ids[1]},mbid-ripped'))
+
+    def test_export_gzip(self):
+        """Is the export gzipped for clients that accept it?"""
+        resp = self.export(f'/user/{self.user_id}/library/export', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(resp.data).splitlines()), 2)
+
+    def test_export_batches(self):
+        """Are rows fetched and sent a batch at a time rather than all at once?"""
+        with patch('exporter.EXPORT_BATCH_SIZE', 1):
+            resp = self.export(f'/user/{self.user_id}/library/export')
+        self.assertEqual(len(resp.chunks), 2)
+
+    def test_export_bad_format(self):
+        """Is an unknown format rejected?"""
+        resp = self.export(f'/user/{self.user_id}/library/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,57 @@
+"""Outbound HTTP client tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_http_client.py
+
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+import http_client
+
+
+def make_response(status, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    return resp
+
+
+class HTTPClientTestCase(TestCase):
+    """Test retries and metrics"""
+
+    def test_retry_after(self):
+        """Is a 429 retried after the Retry-After delay?"""
+        responses = [make_response(429, {'Retry-After': '0'}), make_response(200)]
+        with patch('requests.Session.request', side_effect=responses) as req, patch('time.sleep') as sleep:
+            resp = http_client.get('https://api.test-retry.com/v1/search')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(req.call_count, 2)
+            sleep.assert_called_once_with(0.0)
+            self.assertEqual(http_client.http_stats()['api.test-retry.com']['retries'], 1)
+
+    def test_post_not_retried(self):
+        """Are non-idempotent requests sent only once?"""
+        with patch('requests.Session.request', return_value=make_response(503)) as req:
+            resp = http_client.post('https://accounts.test-post.com/api/token')
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(req.call_count, 1)
+
+    def test_connection_errors(self):
+        """Are connection errors retried, then raised?"""
+        with patch('requests.Session.request', side_effect=requests.ConnectionError) as req, patch('time.sleep'):
+            with self.assertRaises(requests.ConnectionError):
+                http_client.get('https://api.test-down.com/v1/search')
+
+            self.assertEqual(req.call_count, http_client.MAX_RETRIES + 1)
+            self.assertEqual(http_client.http_stats()['api.test-down.com']['errors'], http_client.MAX_RETRIES + 1)
+
+    def test_timeout_is_always_set(self):
+        """Does every request carry a timeout?"""
+        with patch('requests.Session.request', return_value=make_response(200)) as req:
+            http_client.get('https://api.test-timeout.com/v1/search')
+
+            self.assertEqual(req.call_args.kwargs['timeout'], http_client.DEFAULT_TIMEOUT)
@@ -0,0 +1,125 @@
+"""Bulk import tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_importer.py
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app
+from models import db, User, Recording, ImportItem
+from importer import parse_import, create_import_job, claim_import, run_import, _resolve, STALL_TIMEOUT
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+RECORDINGS = {
+    'mbid-fun': {'title': 'F.U.N.', 'artist': 'Spongebob Squarepants', 'release': 'Spongebob Squarepants', 'tags': ['fun']},
+    'mbid-ripped': {'title': 'Ripped Pants', 'artist': 'Spongebob Squarepants', 'release': None, 'tags': []}
+}
+
+def fake_recording_info(mbid):
+    return RECORDINGS[mbid]
+
+def fake_search(search_type, term, limit):
+    return [{'id': 'mbid-ripped', 'ext:score': '100'}] if 'Ripped Pants' in term else []
+
+def fake_spotify(items, token=None, workers=None):
+    return {item['mbid']: {'tracks': {'items': [{'uri': f'spotify:track:{item["mbid"]}'}]}} for item in items}
+
+
+class ImportTestCase(TestCase):
+    """Test the bulk import pipeline"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User.register('Spongebob', 'password', 'sponge@bikini-bottom.com', 'Music Fan', None)
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+        self.patches = [
+            patch('importer.get_recording_info', side_effect=fake_recording_info),
+            patch('importer.search_musicbrainz', side_effect=fake_search),
+            patch('importer.get_spotify_info_batch', side_effect=fake_spotify)
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_parse_import(self):
+        """Are all three formats understood?"""
+        self.assertEqual(parse_import('mbid-fun\n\nmbid-ripped\n', 'mbids'), [
+            {'mbid': 'mbid-fun', 'title': None, 'artist': None},
+            {'mbid': 'mbid-ripped', 'title': None, 'artist': None}
+        ])
+        self.assertEqual(parse_import('title,artist\nRipped Pants,Spongebob\n', 'csv'), [
+            {'mbid': None, 'title': 'Ripped Pants', 'artist': 'Spongebob'}
+        ])
+        self.assertEqual(parse_import('{"mbid": "mbid-fun"}\n', 'jsonl'), [
+            {'mbid': 'mbid-fun', 'title': None, 'artist': None}
+        ])
+        with self.assertRaises(ValueError):
+            parse_import('artist\nSpongebob\n', 'csv')
+
+    def test_parse_import_bad_rows(self):
+        """Are rows of the wrong type reported with their line?"""
+        with self.assertRaisesRegex(ValueError, 'Line 3: mbid must be a string'):
+            parse_import('{"mbid": "mbid-fun"}\n\n{"mbid": 12345}\n', 'jsonl')
+        with self.assertRaisesRegex(ValueError, 'Line 2 is not an object'):
+            parse_import('{"mbid": "mbid-fun"}\n["mbid-ripped"]\n', 'jsonl')
+
+    def test_run_import(self):
+        """Are rows resolved, enriched, matched on Spotify and added to the library?"""
+        rows = parse_import('mbid,title,artist\nmbid-fun,,\n,Ripped Pants,Spongebob\nmbid-fun,,\n,Campfire Song,Spongebob\n', 'csv')
+        job = run_import(create_import_job(self.user_id, rows).id)
+
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.added, job.skipped, job.failed), (2, 1, 1))
+        user = User.query.get(self.user_id)
+        self.assertEqual(sorted(r.title for r in user.library), ['F.U.N.', 'Ripped Pants'])
+        self.assertEqual(Recording.query.filter_by(mbid='mbid-fun').one().spotify_uri, 'mbid-fun')
+        self.assertEqual([t.name for t in Recording.query.filter_by(mbid='mbid-fun').one().tags], ['fun'])
+
+    def test_resolve_escapes_and_scores(self):
+        """Are quotes and other query syntax escaped, and weak top hits treated as no match?"""
+        with patch('importer.search_musicbrainz', return_value=[{'id': 'mbid-weak', 'ext:score': '41'}]) as search:
+            self.assertIsNone(_resolve({'mbid': None, 'title': 'The "Best" Day (Ever)', 'artist': 'AC/DC'}))
+            search.assert_called_once_with('recording', r'recording:"The \"Best\" Day \(Ever\)" AND artist:"AC\/DC"', 1)
+
+    def test_claim_import(self):
+        """Is a running job left alone until it stalls?"""
+        job = create_import_job(self.user_id, parse_import('mbid-fun\n', 'mbids'))
+        self.assertTrue(claim_import(job.id))
+        self.assertFalse(claim_import(job.id))
+        self.assertEqual(run_import(job.id).status, 'running')
+
+        job.updated_at = datetime.utcnow() - STALL_TIMEOUT - timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(run_import(job.id).status, 'done')
+        self.assertFalse(claim_import(job.id))
+
+    def test_resume_import(self):
+        """Does running a job again only process the items that are still pending?"""
+        job = create_import_job(self.user_id, parse_import('mbid-fun\nmbid-ripped\n', 'mbids'))
+        item = ImportItem.query.get((job.id, 0))
+        item.status = 'done'
+        job.added = 1
+        db.session.commit()
+
+        with patch('importer.get_recording_info', side_effect=fake_recording_info) as info:
+            job = run_import(job.id)
+            info.assert_called_once_with('mbid-ripped')
+
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.added, 2)
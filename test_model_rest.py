@@ -4,9 +4,13 @@
 # python -m unittest test_model_rest.py
 
 from unittest import TestCase
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 
 from app import app
 from models import db, Recording, User, Playlist, Tag, DEFAULT_IMG_URL
+from helpers import add_tags
+from query_stats import unindexed_relationship_loads
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -57,6 +61,13 @@ class RecordingModelTestCase(TestCase):
         self.assertEqual(len(r.playlists), 0)
         self.assertEqual(len(r.user), 0)
     
+    def test_recording_unique_mbid(self):
+        """Is a second recording with the same MBID rejected?"""
+        r = Recording(mbid = '12345', title = 'F.U.N.', artist = 'Spongebob Squarepants')
+        with self.assertRaises(IntegrityError):
+            db.session.add(r)
+            db.session.commit()
+
     def test_playlist_model(self):
         """Basic playlist model functionality"""
         p = Playlist(
@@ -112,4 +123,36 @@ class RecordingModelTestCase(TestCase):
 
         self.assertEqual(len(self.r.tags), 1)
         self.assertEqual(len(t.recordings), 1)
-        self.assertEqual(self.r.tags[0].name, 'pop')
\ No newline at end of file
+        self.assertEqual(self.r.tags[0].name, 'pop')
+
+    def test_add_tags(self):
+        """Are existing tags reused, new ones created and repeats ignored?"""
+        t = Tag(name = 'pop')
+        db.session.add(t)
+        db.session.commit()
+        self.r.tags.append(t)
+        db.session.commit()
+
+        add_tags(self.r, ['pop', 'sea shanty', 'sea shanty', ' ', 'krusty krab'])
+
+        self.assertEqual(sorted(tag.name for tag in self.r.tags), ['krusty krab', 'pop', 'sea shanty'])
+        self.assertEqual(Tag.query.count(), 3)
+
+
+class IndexTestCase(TestCase):
+    """Check relationship loads against the query planner"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_relationship_loads_use_indexes(self):
+        """Does every relationship load find its rows through an index?"""
+        self.assertEqual(unindexed_relationship_loads(db), {})
+
+    def test_missing_index_is_reported(self):
+        """Is a relationship whose foreign key lost its index reported?"""
+        db.session.execute(text('DROP INDEX ix_playlists_user_id'))
+        self.assertIn('User.playlists', unindexed_relationship_loads(db))
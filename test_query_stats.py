@@ -0,0 +1,84 @@
+"""Query budget tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_query_stats.py
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+from sqlalchemy import create_engine, text
+
+from query_stats import capture_queries, init_query_stats, query_budget, statement_shape
+
+engine = create_engine('sqlite://')
+
+app = Flask(__name__)
+init_query_stats(app)
+
+@app.route('/queries/<int:n>')
+@query_budget(3)
+def run_queries(n):
+    with engine.connect() as conn:
+        for i in range(n):
+            conn.execute(text('SELECT :n'), {'n': i})
+    return 'ok'
+
+@app.route('/join')
+def run_join():
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return 'ok'
+
+
+class QueryStatsTestCase(TestCase):
+    """Test per-request query counting and N+1 detection"""
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_capture_queries(self):
+        """Are statements run inside the block collected?"""
+        with capture_queries() as log:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+                conn.execute(text('SELECT 2'))
+        self.assertEqual(log.count, 2)
+        self.assertGreaterEqual(log.seconds, 0)
+
+    def test_statement_shape(self):
+        """Do IN lists of any length have the same shape?"""
+        self.assertEqual(
+            statement_shape('SELECT * FROM tags WHERE id IN (?, ?, ?)'),
+            statement_shape('SELECT *\n  FROM tags WHERE id IN (?)')
+        )
+        self.assertEqual(
+            statement_shape('SELECT * FROM tags WHERE id IN (%(id_1_1)s, %(id_1_2)s)'),
+            'SELECT * FROM tags WHERE id IN (...)'
+        )
+
+    def test_within_budget(self):
+        """Is a request within its budget left alone apart from the Server-Timing header?"""
+        with patch.object(app.logger, 'warning') as warning:
+            resp = self.client.get('/queries/3')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('desc="3 queries"', resp.headers['Server-Timing'])
+        warning.assert_not_called()
+
+    def test_over_budget(self):
+        """Is a request over its view's budget logged?"""
+        with patch.object(app.logger, 'warning') as warning:
+            self.client.get('/queries/4')
+        self.assertIn('budget', warning.call_args_list[0][0][0])
+
+    def test_default_budget(self):
+        """Do views without their own budget use the app's?"""
+        with patch.dict(app.config, {'SQL_QUERY_BUDGET': 0}), patch.object(app.logger, 'warning') as warning:
+            self.client.get('/join')
+        self.assertEqual(warning.call_count, 1)
+
+    def test_repeated_statements(self):
+        """Is the same statement run many times in one request flagged as a likely N+1?"""
+        with patch.dict(app.config, {'SQL_QUERY_BUDGET': 100}), patch.object(app.logger, 'warning') as warning:
+            self.client.get('/queries/6')
+        messages = [call[0][0] for call in warning.call_args_list]
+        self.assertIn('Possible N+1 in %s %s: %d x %s', messages)
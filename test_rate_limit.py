@@ -0,0 +1,36 @@
+"""Rate governor tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_rate_limit.py
+
+import tempfile
+from unittest import TestCase
+
+from rate_limit import RateGovernor
+
+
+class RateGovernorTestCase(TestCase):
+    """Test the shared token bucket"""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_budget_is_shared(self):
+        """Does a second governor on the same file draw from the same bucket?"""
+        first = RateGovernor('test', rate=1.0, directory=self.dir.name)
+        second = RateGovernor('test', rate=1.0, directory=self.dir.name)
+
+        first.acquire()
+        self.assertGreater(second._take(), 0)
+
+    def test_acquire_waits(self):
+        """Does acquire sleep until a token is available?"""
+        governor = RateGovernor('test', rate=20.0, directory=self.dir.name)
+        governor.acquire()
+        governor.acquire()
+
+        self.assertEqual(governor.stats()['acquired'], 2)
+        self.assertEqual(governor.stats()['waits'], 1)
+        self.assertLessEqual(governor.stats()['waited_seconds'], 0.05 + 1e-6)
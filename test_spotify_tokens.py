@@ -0,0 +1,126 @@
+"""Spotify token store tests"""
+
+# run tests by typing in the terminal:
+# python -m unittest test_spotify_tokens.py
+
+import tempfile, time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+import spotify_tokens
+from app import app
+from models import db, User, SpotifyToken
+from cache import FileCache
+from spotify_tokens import save_token, get_access_token, get_app_token
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///musophile_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+class SpotifyTokenTestCase(TestCase):
+    """Test per-user Spotify tokens"""
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User.register('Spongebob', 'password', 'sponge@bikini-bottom.com', 'Music Fan', None)
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_save_token(self):
+        """Is a new token stored with an absolute expiry?"""
+        self.assertIsNone(SpotifyToken.query.get(self.user_id))
+        save_token(self.user_id, 'access', 'refresh', 3600)
+
+        token = SpotifyToken.query.get(self.user_id)
+        self.assertIsNotNone(token)
+        self.assertGreater(token.expires_at, datetime.utcnow() + timedelta(minutes=59))
+
+    def test_fresh_token_not_refreshed(self):
+        """Is a token that isn't close to expiry used as is?"""
+        save_token(self.user_id, 'access', 'refresh', 3600)
+        with patch('spotify_tokens.get_refresh_token') as refresh:
+            self.assertEqual(get_access_token(self.user_id), 'access')
+            refresh.assert_not_called()
+
+    def test_token_refreshed_before_expiry(self):
+        """Is a token about to expire refreshed before it's used?"""
+        save_token(self.user_id, 'access', 'refresh', 60)
+        with patch('spotify_tokens.get_refresh_token', return_value={'access_token': 'new-access', 'expires_in': 3600}) as refresh:
+            self.assertEqual(get_access_token(self.user_id), 'new-access')
+            self.assertEqual(get_access_token(self.user_id), 'new-access')
+            refresh.assert_called_once_with('refresh')
+
+    def test_revoked_token(self):
+        """Is a token that can't be refreshed removed?"""
+        save_token(self.user_id, 'access', 'refresh', 60)
+        with patch('spotify_tokens.get_refresh_token', return_value={'error': 'invalid_grant'}):
+            self.assertIsNone(get_access_token(self.user_id))
+            self.assertIsNone(SpotifyToken.query.get(self.user_id))
+
+    def test_failed_refresh_keeps_token(self):
+        """Is a token kept when Spotify is rate limiting, erroring or unreachable?"""
+        save_token(self.user_id, 'access', 'refresh', 60)
+        for failure in [{'return_value': {'error': {'status': 429}}}, {'side_effect': ValueError}, {'side_effect': requests.ConnectionError}]:
+            with patch('spotify_tokens.get_refresh_token', **failure):
+                self.assertIsNone(get_access_token(self.user_id))
+                self.assertIsNotNone(SpotifyToken.query.get(self.user_id))
+
+    def test_refresh_leaves_caller_transaction(self):
+        """Is the caller's pending work left for the caller to commit?"""
+        save_token(self.user_id, 'access', 'refresh', 60)
+        User.query.get(self.user_id).role = 'Musician'
+        with patch('spotify_tokens.get_refresh_token', return_value={'access_token': 'new-access', 'expires_in': 3600}):
+            self.assertEqual(get_access_token(self.user_id), 'new-access')
+        db.session.rollback()
+
+        self.assertEqual(User.query.get(self.user_id).role, 'Music Fan')
+        self.assertEqual(SpotifyToken.query.get(self.user_id).access_token, 'new-access')
+
+class AppTokenTestCase(TestCase):
+    """Test the shared client-credentials token"""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch('spotify_tokens.APP_TOKEN_DIR', self.dir.name),
+            patch('spotify_tokens._app_token_store', FileCache(self.dir.name)),
+            patch('spotify_tokens._app_token', (None, 0)),
+            patch('spotify_tokens.start_app_token_refresher')
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.dir.cleanup()
+
+    def test_app_token_reused(self):
+        """Is one app token fetched and then reused?"""
+        with patch('spotify_tokens.fetch_app_token', return_value=('app', time.time() + 3600)) as fetch:
+            self.assertEqual(get_app_token(), 'app')
+            self.assertEqual(get_app_token(), 'app')
+            fetch.assert_called_once()
+
+    def test_app_token_shared_between_workers(self):
+        """Does a worker pick up the token another worker already stored?"""
+        spotify_tokens._app_token_store.set(spotify_tokens.APP_TOKEN_KEY, 'from-other-worker', time.time() + 3600)
+        with patch('spotify_tokens.fetch_app_token') as fetch:
+            self.assertEqual(get_app_token(), 'from-other-worker')
+            fetch.assert_not_called()
+
+    def test_app_token_forced_refresh(self):
+        """Is a token Spotify rejected replaced on a forced refresh?"""
+        with patch('spotify_tokens.fetch_app_token', side_effect=[('old', time.time() + 3600), ('new', time.time() + 3600)]):
+            self.assertEqual(get_app_token(), 'old')
+            self.assertEqual(get_app_token(force_refresh=True), 'new')